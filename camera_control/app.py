@@ -10,32 +10,62 @@ from flask import (
     url_for,
     render_template,
     jsonify,
+    Response,
+    stream_with_context,
 )
 from slugify import slugify
-from .settings import CAPTURE_ROOT
+from werkzeug.utils import secure_filename
+from .settings import CAPTURE_ROOT, PAGE_SIZE, SIMULATE_RIG
 from .const import settings
+from .catalog import get_catalog
+from .events import get_broker, publish
+from .planner import DEFAULT_CIRCLE_OF_CONFUSION, plan_focus_brackets
+from .timeline import read_events, summarize, timeline_path, to_chrome_trace
 from .lib import (  # noqa f401
     get_camera_setting,
+    get_camera_session,
+    get_camera_sessions,
     CameraContext,
     StoppableThread,
     bulk_capture_turntable,
     mock_bulk_capture,
     move_turntable,
     get_worker_progress,
+    get_uploader,
 )
 
 app = Flask(__name__)
 CURRENT_CAPTURE_THREAD = None
 
+if SIMULATE_RIG:
+    from .simulation import install
+
+    install()
+
+# start uploading anything spooled before the last restart
+get_uploader()
+
+
+def get_page():
+    page = request.args.get("page", default=1, type=int)
+    return max(page, 1)
+
+
+def page_count(total):
+    return max((total + PAGE_SIZE - 1) // PAGE_SIZE, 1)
+
 
 @app.route("/")
 def home():
-    Path(CAPTURE_ROOT).mkdir(exist_ok=True, parents=True)
-    capture_paths = sorted([x.name for x in Path(CAPTURE_ROOT).iterdir() if x.is_dir()])
-    captures = []
-    for path in capture_paths:
-        captures.append(f"{path}")
-    return render_template("main.html", captures=captures)
+    page = get_page()
+    catalog = get_catalog()
+    captures = catalog.list_sessions(offset=(page - 1) * PAGE_SIZE, limit=PAGE_SIZE)
+    return render_template(
+        "main.html",
+        captures=captures,
+        page=page,
+        pages=page_count(catalog.count_sessions()),
+    )
 
 
 @app.route("/data/<path:path>")
@@ -54,6 +84,7 @@ def create_capture():
     capture_path = Path(CAPTURE_ROOT, capture_name)
     if not capture_path.exists():
         capture_path.mkdir(parents=True)
+    get_catalog().add_session(capture_name)
     return redirect(url_for("capture", capture_name=capture_name))
 
 
@@ -69,6 +100,7 @@ def delete_capture():
             if fp.is_file():
                 fp.unlink()
         shutil.rmtree(capture_path)
+    get_catalog().remove_session(capture_name)
     return redirect(url_for("home"))
 
 
@@ -80,22 +112,63 @@ def capture(capture_name="untitled"):
 
 @app.route("/<capture_name>/gallery")
 def gallery(capture_name="untitled"):
-    images = [
-        x.name
-        for x in Path(CAPTURE_ROOT, capture_name).iterdir()
-        if x.suffix in [".jpg", ".JPG", ".jpeg", ".JPEG"]
-    ]
+    page = get_page()
+    filters = {
+        "position": request.args.get("position", type=int),
+        "bracket": request.args.get("bracket", type=int),
+        "specular": request.args.get("specular", type=int),
+    }
+    catalog = get_catalog()
+    images = catalog.list_captures(
+        capture_name, offset=(page - 1) * PAGE_SIZE, limit=PAGE_SIZE, **filters
+    )
+    total = catalog.count_captures(capture_name, **filters)
 
-    return render_template("gallery.html", capture_name=capture_name, images=images)
+    return render_template(
+        "gallery.html",
+        capture_name=capture_name,
+        images=images,
+        filters=filters,
+        page=page,
+        pages=page_count(total),
+    )
 
 
 @app.route("/camera/get_current_focus")
 def camera_get_current_focus():
-    with CameraContext() as camera:
-        focus = get_camera_setting(camera, settings.FOCUS_DISTANCE)
+    # the operator may have moved the focus ring, so read the widget fresh
+    focus = get_camera_setting(
+        get_camera_session(), settings.FOCUS_DISTANCE, refresh=True
+    )
     return jsonify({"focus": focus})
 
 
+@app.route("/focus_plan")
+def focus_plan():
+    try:
+        focus_values = get_focus_plan(request.args)
+    except (TypeError, ValueError, ZeroDivisionError):
+        abort(400)
+    return jsonify({"focus_values": focus_values})
+
+
+def get_focus_plan(values):
+    return plan_focus_brackets(
+        float(values.get("near_distance")),
+        float(values.get("far_distance")),
+        float(values.get("aperture")),
+        float(values.get("circle_of_confusion") or DEFAULT_CIRCLE_OF_CONFUSION),
+    )
+
+
+@app.route("/camera/status")
+def camera_status():
+    sessions = get_camera_sessions()
+    status = sessions[0].status()
+    status["cameras"] = [session.status() for session in sessions]
+    return jsonify(status)
+
+
 @app.route("/mock_camera/get_current_focus")
 def mock_camera_get_current_focus():
     focus = random.randint(0, 1730)
@@ -105,7 +178,7 @@ def mock_camera_get_current_focus():
 @app.route("/start_capture", methods=["POST"])
 def start_capture():
     global CURRENT_CAPTURE_THREAD
-    if CURRENT_CAPTURE_THREAD is not None:
+    if CURRENT_CAPTURE_THREAD is not None and CURRENT_CAPTURE_THREAD.is_alive():
         return redirect("capture_status")
     starting_number = request.form.get("starting_number")
     image_count = request.form.get("image_count")
@@ -116,7 +189,10 @@ def start_capture():
     focus_start = request.form.get("focus_start")
     focus_stop = request.form.get("focus_stop")
     capture_specular = request.form.get("capture_specular")
-    if focus_bracketing:
+    prune_brackets = "prune_brackets" in request.form
+    if focus_bracketing and "focus_from_dof" in request.form:
+        focus_kwargs = {"focus_values": get_focus_plan(request.form)}
+    elif focus_bracketing:
         focus_kwargs = {
             "focus_start": int(focus_start),
             "focus_stop": int(focus_stop),
@@ -124,8 +200,16 @@ def start_capture():
         }
     else:
         focus_kwargs = None
+    processing_options = None
+    if focus_bracketing:
+        processing_options = {
+            "focus_stack": {
+                "focus_measure": request.form.get("focus_measure", "log"),
+                "precision": request.form.get("focus_precision", "float32"),
+            }
+        }
     CURRENT_CAPTURE_THREAD = StoppableThread(
-        target=bulk_capture_turntable,
+        target=publish_capture_progress,
         kwargs={
             "capture_root_dir": CAPTURE_ROOT,
             "capture_name": capture_name,
@@ -134,6 +218,9 @@ def start_capture():
             "focus_bracket_settings": focus_kwargs,
             "degree_per_capture": float(degree_per_capture),
             "capture_specular": capture_specular,
+            "prune_brackets": prune_brackets,
+            "processing_options": processing_options,
+            "priority": request.form.get("priority") or None,
         },
     )
 
@@ -141,6 +228,63 @@ def start_capture():
     return redirect("capture_status")
 
 
+def publish_capture_progress(**kwargs):
+    """Run a turntable capture and push its progress to event stream clients."""
+    result, progress = "Cancelled", 0.0
+    try:
+        for message, progress in bulk_capture_turntable(**kwargs):
+            publish(
+                "capture-progress",
+                {
+                    "message": message,
+                    "progress": round(progress * 100),
+                    "running": True,
+                },
+            )
+            yield message, progress
+        result, progress = "Complete", 1.0
+    except Exception as e:
+        result = f"Capture failed: {e}"
+        raise
+    finally:
+        publish(
+            "capture-progress",
+            {"message": result, "progress": round(progress * 100), "running": False},
+        )
+
+
+@app.route("/timeline/<capture_name>")
+def timeline_summary(capture_name):
+    """Where a session's time went, busy seconds per capture phase."""
+    path = timeline_path(CAPTURE_ROOT, secure_filename(capture_name))
+    if not path.exists():
+        abort(404)
+    return jsonify(summarize(read_events(path)))
+
+
+@app.route("/timeline/<capture_name>/trace.json")
+def timeline_trace(capture_name):
+    """The session timeline in Chrome trace format, for chrome://tracing or Perfetto."""
+    capture_name = secure_filename(capture_name)
+    path = timeline_path(CAPTURE_ROOT, capture_name)
+    if not path.exists():
+        abort(404)
+    response = jsonify(to_chrome_trace(read_events(path)))
+    response.headers["Content-Disposition"] = (
+        f"attachment; filename={capture_name}_trace.json"
+    )
+    return response
+
+
+@app.route("/events")
+def events():
+    return Response(
+        stream_with_context(get_broker().stream()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.route("/stop_capture", methods=["POST"])
 def stop_capture():
     global CURRENT_CAPTURE_THREAD
@@ -163,6 +307,9 @@ def capture_status():
                 "running": False,
                 "uploading": worker_progress["running"],
                 "upload_jobs_in_queue": worker_progress["pending_jobs"],
+                "upload_bytes_per_second": worker_progress["bytes_per_second"],
+                "upload_paused": worker_progress["paused"],
+                "spool": worker_progress["spool"],
             }
         )
     elif not CURRENT_CAPTURE_THREAD.is_alive():
@@ -175,6 +322,9 @@ def capture_status():
                 "running": False,
                 "uploading": worker_progress["running"],
                 "upload_jobs_in_queue": worker_progress["pending_jobs"],
+                "upload_bytes_per_second": worker_progress["bytes_per_second"],
+                "upload_paused": worker_progress["paused"],
+                "spool": worker_progress["spool"],
             }
         )
     else:
@@ -189,6 +339,9 @@ def capture_status():
                 "running": True,
                 "uploading": worker_progress["running"],
                 "upload_jobs_in_queue": worker_progress["pending_jobs"],
+                "upload_bytes_per_second": worker_progress["bytes_per_second"],
+                "upload_paused": worker_progress["paused"],
+                "spool": worker_progress["spool"],
             }
         )
 
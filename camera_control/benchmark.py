@@ -0,0 +1,284 @@
+"""Benchmark the capture -> upload -> process pipeline on a simulated rig.
+
+Runs a turntable session against the simulated camera and mock GPIO and
+reports positions per minute, per phase latency and how the upload spool
+and processing server queue grow. Start a local processing server and
+point ``--url`` at it to include uploads and processing:
+
+    python -m processing_server
+    python -m camera_control.benchmark --positions 20 --brackets 5 --specular
+"""
+from pathlib import Path
+from types import SimpleNamespace
+import argparse
+import json
+import statistics
+import tempfile
+import threading
+import time
+
+from . import catalog, simulation
+from .catalog import CaptureCatalog
+from .lib import bulk_capture
+from .settings import SETTLE_TIME, TURNTABLE_STEPS_PER_ROTATION
+from .spool import UploadSpool
+from .stepper import Stepper
+from .upload import Uploader
+
+# Seconds between samples of the upload spool and server queue
+SAMPLE_INTERVAL = 1.0
+
+
+def summarize(durations):
+    if not durations:
+        return None
+    durations = sorted(durations)
+    return {
+        "count": len(durations),
+        "mean": statistics.mean(durations),
+        "p50": durations[len(durations) // 2],
+        "p95": durations[min(int(len(durations) * 0.95), len(durations) - 1)],
+        "max": durations[-1],
+    }
+
+
+def growth(samples, key):
+    """Change of a sampled queue length per minute, with its peak."""
+    values = [(t, sample[key]) for t, sample in samples if sample[key] is not None]
+    if len(values) < 2:
+        return None
+    (t0, v0), (t1, v1) = values[0], values[-1]
+    return {
+        "start": v0,
+        "end": v1,
+        "max": max(v for _, v in values),
+        "per_minute": (v1 - v0) / ((t1 - t0) or 1) * 60,
+    }
+
+
+class Benchmark(object):
+    def __init__(
+        self,
+        positions=10,
+        brackets=0,
+        capture_specular=False,
+        degree_per_capture=6.0,
+        settle_time=SETTLE_TIME,
+        url=None,
+        root=None,
+        file_size=simulation.FILE_SIZE,
+        wait_for_uploads=True,
+        cameras=1,
+    ):
+        self.positions = positions
+        self.brackets = brackets
+        self.capture_specular = capture_specular
+        self.degree_per_capture = degree_per_capture
+        self.settle_time = settle_time
+        self.url = url
+        self.root = Path(root or tempfile.mkdtemp(prefix="capture-benchmark-"))
+        self.wait_for_uploads = wait_for_uploads
+        self.cameras = cameras
+        self.gp = simulation.install(cameras=cameras, file_size=file_size)
+        self.phases = {
+            "position": [],
+            "frame": [],
+            "drain": [],
+            "turntable": [],
+            "upload": [],
+        }
+        self.samples = []
+        self._submitted = {}
+        self._done = threading.Event()
+        self.uploader = None
+
+    def run(self):
+        catalog.CATALOG = CaptureCatalog(self.root / ".catalog.sqlite3", self.root)
+        if self.url:
+            base_url = self.url.rsplit("/", 1)[0]
+            self.uploader = Uploader(
+                url=self.url,
+                status_url=base_url + "/status",
+                jobs_url=base_url + "/jobs",
+                spool=UploadSpool(self.root / ".spool", capture_root=self.root),
+            )
+        focus_bracket_settings = None
+        if self.brackets:
+            focus_bracket_settings = {
+                "focus_start": 1730,
+                "focus_stop": 1500,
+                "focus_steps": self.brackets,
+            }
+        capture_name = f"benchmark_{int(time.time())}"
+        monitor = threading.Thread(target=self._monitor, daemon=True)
+        monitor.start()
+
+        with Stepper(
+            steps_per_rotation=TURNTABLE_STEPS_PER_ROTATION, cool_down=self.settle_time
+        ) as stepper:
+            moves = []
+            start = time.monotonic()
+            marks = {"position": start, "frame": start}
+
+            def advance():
+                now = time.monotonic()
+                self.phases["position"].append(now - marks["position"])
+                marks["position"] = marks["advanced"] = now
+                move = stepper.move(self.degree_per_capture)
+                moves.append(move)
+
+                def wait():
+                    move.wait()
+                    # the next frame's time starts once the turntable settled
+                    marks["frame"] = time.monotonic()
+                    # for the session timeline
+                    motion.started = move.started
+                    motion.actual_time = move.actual_time
+                    motion.cool_down = move.cool_down
+
+                motion = SimpleNamespace(wait=wait)
+                return motion
+
+            def callback(captured_images, tags=None):
+                self.phases["drain"].append(time.monotonic() - marks["advanced"])
+                if self.uploader is not None:
+                    entry_id = self.uploader.submit(
+                        capture_name, captured_images, tags=tags
+                    )
+                    self._submitted[entry_id] = time.monotonic()
+
+            for _ in bulk_capture(
+                capture_root_dir=self.root,
+                capture_name=capture_name,
+                image_count=self.positions,
+                focus_bracket_settings=focus_bracket_settings,
+                capture_specular=self.capture_specular,
+                callback=callback,
+                advance=advance,
+            ):
+                now = time.monotonic()
+                self.phases["frame"].append(now - marks["frame"])
+                marks["frame"] = now
+            stepper.wait()
+            capture_done = time.monotonic()
+            self.phases["turntable"] = [move.actual_time for move in moves]
+
+        if self.uploader is not None and self.wait_for_uploads:
+            while self.uploader.spool.pending_count():
+                time.sleep(0.5)
+        self._done.set()
+        monitor.join()
+        finished = time.monotonic()
+        if self.uploader is not None:
+            self.uploader.shutdown()
+        return self.report(start, capture_done, finished)
+
+    def _monitor(self):
+        start = time.monotonic()
+        while not self._done.is_set():
+            self._sample(time.monotonic() - start)
+            self._done.wait(SAMPLE_INTERVAL)
+        self._sample(time.monotonic() - start)
+
+    def _sample(self, elapsed):
+        sample = {"spool": None, "server_queue": None}
+        if self.uploader is not None:
+            pending = self.uploader.spool.pending_ids()
+            now = time.monotonic()
+            for entry_id in list(self._submitted):
+                if entry_id not in pending:
+                    self.phases["upload"].append(now - self._submitted.pop(entry_id))
+            sample["spool"] = len(pending)
+            sample["server_queue"] = self.uploader.progress()["server_queue_depth"]
+        self.samples.append((elapsed, sample))
+
+    def report(self, start, capture_done, finished):
+        phases = {name: summarize(values) for name, values in self.phases.items()}
+        camera_stats = {}
+        for camera in self.gp.cameras:
+            for name, values in camera.stats.items():
+                camera_stats.setdefault(name, []).extend(values)
+        for name, values in camera_stats.items():
+            phases[f"camera_{name}"] = summarize(values)
+        capture_time = capture_done - start
+        return {
+            "positions": self.positions,
+            "cameras": self.cameras,
+            "frames": len(self.phases["frame"]) * self.cameras,
+            "capture_seconds": capture_time,
+            "total_seconds": finished - start,
+            "positions_per_minute": self.positions / capture_time * 60,
+            "phases": phases,
+            "queues": {
+                "spool": growth(self.samples, "spool"),
+                "server_queue": growth(self.samples, "server_queue"),
+            },
+        }
+
+
+def print_report(report):
+    print(
+        f"\n{report['positions']} positions, {report['frames']} frames from "
+        f"{report['cameras']} camera(s) in "
+        f"{report['capture_seconds']:.1f}s "
+        f"({report['positions_per_minute']:.2f} positions/min), "
+        f"{report['total_seconds']:.1f}s including uploads"
+    )
+    print(f"{'phase':<20}{'count':>7}{'mean':>9}{'p50':>9}{'p95':>9}{'max':>9}")
+    for name, stats in report["phases"].items():
+        if stats is None:
+            continue
+        print(
+            f"{name:<20}{stats['count']:>7}{stats['mean']:>9.3f}{stats['p50']:>9.3f}"
+            f"{stats['p95']:>9.3f}{stats['max']:>9.3f}"
+        )
+    for name, stats in report["queues"].items():
+        if stats is None:
+            continue
+        print(
+            f"{name} queue: {stats['start']} -> {stats['end']} "
+            f"(max {stats['max']}, {stats['per_minute']:+.2f}/min)"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--positions", type=int, default=10)
+    parser.add_argument("--brackets", type=int, default=0)
+    parser.add_argument("--specular", action="store_true")
+    parser.add_argument("--cameras", type=int, default=1)
+    parser.add_argument("--degrees", type=float, default=6.0)
+    parser.add_argument("--settle", type=float, default=SETTLE_TIME)
+    parser.add_argument(
+        "--file-size", type=int, default=simulation.FILE_SIZE, help="bytes per frame"
+    )
+    parser.add_argument(
+        "--url", help="processing server upload url, captures aren't uploaded without"
+    )
+    parser.add_argument("--root", help="where to save captures, a temp dir by default")
+    parser.add_argument(
+        "--no-wait", action="store_true", help="don't wait for uploads to finish"
+    )
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args()
+
+    report = Benchmark(
+        positions=args.positions,
+        brackets=args.brackets,
+        capture_specular=args.specular,
+        degree_per_capture=args.degrees,
+        settle_time=args.settle,
+        url=args.url,
+        root=args.root,
+        file_size=args.file_size,
+        wait_for_uploads=not args.no_wait,
+        cameras=args.cameras,
+    ).run()
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+import time
+
+try:
+    import gphoto2 as gp
+except ImportError:
+    gp = None
+
+# How long to wait for the camera to report a new setting before moving on
+CONFIRM_TIMEOUT = 2.0
+CONFIRM_POLL_INTERVAL = 0.02
+# Fixed wait used when the camera can't be polled for a single setting
+FALLBACK_SETTLE_TIME = 0.1
+
+
+class CameraSettings(object):
+    """Cached access to camera config widgets.
+
+    Widgets are read once with ``gp_camera_get_single_config`` (or from one
+    full config read on cameras that don't support it) and kept around, so
+    repeated changes to the same setting only write that one widget back
+    with ``gp_camera_set_single_config``. The cache is only re-read when a
+    write fails.
+
+    Camera access goes through ``connection.call`` so the cache can sit on
+    top of a camera session or a bare camera.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self._widgets = {}
+        self._config = None
+
+    def clear(self):
+        self._widgets = {}
+        self._config = None
+
+    def get(self, setting_name, refresh=False):
+        """Get a setting value, re-reading the single widget if ``refresh`` is set."""
+        return self.connection.call(self._get, setting_name, refresh)
+
+    def set(self, setting_name, value, confirm=True):
+        """Write a single setting and optionally wait for the camera to report it."""
+        old_value = self.connection.call(self._set, setting_name, value)
+        print(f"Setting: {setting_name} Set to: {value}")
+        if confirm:
+            self.wait_for_value(setting_name, value, old_value=old_value)
+
+    def wait_for_value(
+        self, setting_name, value, old_value=None, timeout=CONFIRM_TIMEOUT
+    ):
+        """Poll the camera until it reports ``value`` or stops changing.
+
+        Settings that drive a motor (e.g. focus) report the current position
+        which may not land exactly on the requested value, so two matching
+        reads in a row away from ``old_value`` are treated as settled. Each
+        poll is its own camera command so other camera work can run between
+        them.
+        """
+        if self._config is not None:
+            # no single widget reads, polling would walk the whole tree
+            time.sleep(FALLBACK_SETTLE_TIME)
+            return None
+        deadline = time.monotonic() + timeout
+        previous = None
+        while time.monotonic() < deadline:
+            current = self.connection.call(self._read_single, setting_name)
+            if str(current) == str(value):
+                return current
+            if current == previous and str(current) != str(old_value):
+                return current
+            previous = current
+            time.sleep(CONFIRM_POLL_INTERVAL)
+        print(f"Setting: {setting_name} not confirmed as {value} after {timeout}s")
+        return previous
+
+    def _get(self, camera, setting_name, refresh):
+        if refresh:
+            self._widgets.pop(setting_name, None)
+        widget = self._get_widget(camera, setting_name)
+        return gp.check_result(gp.gp_widget_get_value(widget))
+
+    def _set(self, camera, setting_name, value):
+        widget = self._get_widget(camera, setting_name)
+        old_value = gp.check_result(gp.gp_widget_get_value(widget))
+        gp.check_result(gp.gp_widget_set_value(widget, value))
+        try:
+            self._write(camera, setting_name, widget)
+        except gp.GPhoto2Error as e:
+            print(f"Writing {setting_name} failed ({e}), re-reading config")
+            self.clear()
+            widget = self._get_widget(camera, setting_name)
+            gp.check_result(gp.gp_widget_set_value(widget, value))
+            self._write(camera, setting_name, widget)
+        return old_value
+
+    @staticmethod
+    def _read_single(camera, setting_name):
+        widget = gp.check_result(gp.gp_camera_get_single_config(camera, setting_name))
+        return gp.check_result(gp.gp_widget_get_value(widget))
+
+    def _write(self, camera, setting_name, widget):
+        if self._config is not None:
+            gp.check_result(gp.gp_camera_set_config(camera, self._config))
+        else:
+            gp.check_result(
+                gp.gp_camera_set_single_config(camera, setting_name, widget)
+            )
+
+    def _get_widget(self, camera, setting_name):
+        widget = self._widgets.get(setting_name)
+        if widget is not None:
+            return widget
+        if self._config is None:
+            try:
+                widget = gp.check_result(
+                    gp.gp_camera_get_single_config(camera, setting_name)
+                )
+            except gp.GPhoto2Error:
+                # camera doesn't support single widget access, read the tree once
+                self._config = gp.check_result(gp.gp_camera_get_config(camera))
+        if widget is None:
+            widget = gp.check_result(
+                gp.gp_widget_get_child_by_name(self._config, setting_name)
+            )
+        self._widgets[setting_name] = widget
+        return widget
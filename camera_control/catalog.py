@@ -0,0 +1,221 @@
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional
+import re
+import sqlite3
+import time
+
+from .settings import CAPTURE_ROOT, CATALOG_PATH
+from .thumbnails import get_source_name, get_thumbnail_path
+
+CATALOG: Optional["CaptureCatalog"] = None
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    name TEXT PRIMARY KEY,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS captures (
+    id INTEGER PRIMARY KEY,
+    session TEXT NOT NULL,
+    camera TEXT,
+    position INTEGER,
+    bracket INTEGER,
+    specular INTEGER NOT NULL DEFAULT 0,
+    path TEXT NOT NULL UNIQUE,
+    size INTEGER,
+    thumbnail TEXT,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS captures_by_position
+    ON captures (session, position, bracket);
+"""
+# Columns added since the first schema, added to older catalogs on open
+MIGRATIONS = {"captures": [("camera", "TEXT")]}
+# {capture name}_{position}[_{bracket}][_spec], used to import older sessions
+CAPTURE_NAME = re.compile(
+    r"^(?P<session>.+)_(?P<position>\d{4})(?:_(?P<bracket>\d{3}))?(?P<spec>_spec)?$"
+)
+
+
+class CaptureCatalog(object):
+    """SQLite index of capture sessions and the files captured for them.
+
+    Rows are added as the capture pipeline saves files so the home page and
+    gallery can page through a session with queries instead of listing
+    folders on the SD card.
+    """
+
+    def __init__(self, path=CATALOG_PATH, capture_root=CAPTURE_ROOT):
+        self.path = Path(path)
+        self.capture_root = Path(capture_root)
+        is_new = not self.path.exists()
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            self._migrate(conn)
+        if is_new:
+            self.import_from_disk()
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _migrate(conn):
+        for table, columns in MIGRATIONS.items():
+            rows = conn.execute(f"PRAGMA table_info({table})").fetchall()
+            existing = {row["name"] for row in rows}
+            for name, column_type in columns:
+                if name not in existing:
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {column_type}")
+
+    def add_session(self, name, created=None):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO sessions (name, created) VALUES (?, ?)",
+                (name, created or time.time()),
+            )
+
+    def remove_session(self, name):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM captures WHERE session = ?", (name,))
+            conn.execute("DELETE FROM sessions WHERE name = ?", (name,))
+
+    def list_sessions(self, offset=0, limit=50):
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT name FROM sessions ORDER BY name LIMIT ? OFFSET ?",
+                (limit, offset),
+            ).fetchall()
+        return [row["name"] for row in rows]
+
+    def count_sessions(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def add_capture(
+        self,
+        session,
+        path,
+        position=None,
+        bracket=None,
+        specular=False,
+        size=None,
+        thumbnail=None,
+        camera=None,
+    ):
+        path = Path(path)
+        if size is None and path.exists():
+            size = path.stat().st_size
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO sessions (name, created) VALUES (?, ?)",
+                (session, time.time()),
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO captures "
+                "(session, camera, position, bracket, specular, path, size, thumbnail,"
+                " created) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    session,
+                    camera,
+                    position,
+                    bracket,
+                    int(bool(specular)),
+                    self._relative(path),
+                    size,
+                    self._relative(thumbnail) if thumbnail else None,
+                    time.time(),
+                ),
+            )
+
+    def set_thumbnail(self, path, thumbnail):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE captures SET thumbnail = ? WHERE path = ?",
+                (self._relative(thumbnail), self._relative(path)),
+            )
+
+    def list_captures(
+        self, session, offset=0, limit=50, position=None, bracket=None, specular=None
+    ):
+        where, params = self._capture_filter(session, position, bracket, specular)
+        with self._connect() as conn:
+            rows = conn.execute(
+                f"SELECT * FROM captures WHERE {where} "
+                "ORDER BY position, camera, specular, bracket, path LIMIT ? OFFSET ?",
+                params + [limit, offset],
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def count_captures(self, session, position=None, bracket=None, specular=None):
+        where, params = self._capture_filter(session, position, bracket, specular)
+        with self._connect() as conn:
+            return conn.execute(
+                f"SELECT COUNT(*) FROM captures WHERE {where}", params
+            ).fetchone()[0]
+
+    def import_from_disk(self):
+        """One off scan of sessions captured before the catalog existed."""
+        if not self.capture_root.exists():
+            return
+        for session_path in self.capture_root.iterdir():
+            if not session_path.is_dir() or session_path.name.startswith("."):
+                continue
+            self.add_session(session_path.name, created=session_path.stat().st_mtime)
+            names = {x.name for x in session_path.iterdir() if x.is_file()}
+            thumbnail_root = session_path / ".thumbnails"
+            if thumbnail_root.exists():
+                names.update(get_source_name(x.name) for x in thumbnail_root.iterdir())
+            for name in names:
+                match = CAPTURE_NAME.match(Path(name).stem)
+                if not match:
+                    continue
+                path = session_path / name
+                thumbnail = get_thumbnail_path(path)
+                self.add_capture(
+                    session_path.name,
+                    path,
+                    position=int(match["position"]),
+                    bracket=int(match["bracket"]) if match["bracket"] else None,
+                    specular=bool(match["spec"]),
+                    thumbnail=thumbnail if thumbnail.exists() else None,
+                )
+
+    @staticmethod
+    def _capture_filter(session, position, bracket, specular):
+        where = ["session = ?"]
+        params = [session]
+        if position is not None:
+            where.append("position = ?")
+            params.append(position)
+        if bracket is not None:
+            where.append("bracket = ?")
+            params.append(bracket)
+        if specular is not None:
+            where.append("specular = ?")
+            params.append(int(bool(specular)))
+        return " AND ".join(where), params
+
+    def _relative(self, path):
+        path = Path(path)
+        try:
+            return path.relative_to(self.capture_root).as_posix()
+        except ValueError:
+            return path.as_posix()
+
+
+def get_catalog():
+    global CATALOG
+
+    if CATALOG is None:
+        CATALOG = CaptureCatalog()
+    return CATALOG
@@ -0,0 +1,105 @@
+from contextlib import contextmanager
+from typing import Optional
+import json
+import queue
+import threading
+import time
+
+import requests
+
+from .settings import PROCESSING_STATUS_URL
+
+BROKER: Optional["EventBroker"] = None
+
+# Seconds between keep-alive comments on idle event streams
+HEARTBEAT_INTERVAL = 15.0
+# Seconds between processing server status polls while anyone is listening
+RELAY_INTERVAL = 5.0
+SUBSCRIBER_QUEUE_SIZE = 256
+
+
+class EventBroker(object):
+    """Fan events out to server-sent-event streams.
+
+    The last event of each type is kept and replayed to new subscribers so
+    a page opened mid capture starts with the current state. While anyone
+    is subscribed the processing server status is polled and relayed as
+    ``processing-status`` events.
+    """
+
+    def __init__(self, status_url=PROCESSING_STATUS_URL):
+        self.status_url = status_url
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._last_events = {}
+        self._relay_thread = None
+
+    def publish(self, event, data):
+        with self._lock:
+            self._last_events[event] = data
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait((event, data))
+            except queue.Full:
+                # a stalled client shouldn't hold up the capture
+                pass
+
+    @contextmanager
+    def subscribe(self):
+        subscriber = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        with self._lock:
+            for event, data in self._last_events.items():
+                subscriber.put_nowait((event, data))
+            self._subscribers.add(subscriber)
+            self._start_relay()
+        try:
+            yield subscriber
+        finally:
+            with self._lock:
+                self._subscribers.discard(subscriber)
+
+    def stream(self):
+        """Yield text/event-stream messages until the client goes away."""
+        with self.subscribe() as subscriber:
+            while True:
+                try:
+                    event, data = subscriber.get(timeout=HEARTBEAT_INTERVAL)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+    def _start_relay(self):
+        if self._relay_thread is not None:
+            return
+        self._relay_thread = threading.Thread(target=self._relay_loop, daemon=True)
+        self._relay_thread.start()
+
+    def _relay_loop(self):
+        session = requests.Session()
+        while True:
+            with self._lock:
+                if not self._subscribers:
+                    self._relay_thread = None
+                    break
+            try:
+                response = session.get(self.status_url, timeout=5)
+                status = dict(response.json(), reachable=True)
+            except (requests.RequestException, ValueError):
+                status = {"reachable": False}
+            self.publish("processing-status", status)
+            time.sleep(RELAY_INTERVAL)
+        session.close()
+
+
+def get_broker():
+    global BROKER
+
+    if BROKER is None:
+        BROKER = EventBroker()
+    return BROKER
+
+
+def publish(event, data):
+    get_broker().publish(event, data)
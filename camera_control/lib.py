@@ -1,16 +1,13 @@
 from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
 from pathlib import Path
 import atexit
-import json
-import mimetypes
-import requests
 import time
 import threading
 import subprocess
 import queue
 
-from PIL import Image
-
 try:
     import gphoto2 as gp
 except ImportError:
@@ -18,16 +15,26 @@ except ImportError:
 
 from .const import settings
 from .settings import (
-    THUMBNAIL_SIZE,
     TURNTABLE_STEPPER_PIN,
     POLARIZER_DIRECTION_PIN,
     POLARIZER_STEPPER_PIN,
     TURNTABLE_STEPS_PER_ROTATION,
     POLARIZER_STEPS_PER_ROTATION,
-    POST_PROCESS_URL,
     SETTLE_TIME,
 )
 from .stepper import Stepper
+from .pipeline import CapturePipeline
+from .planner import BracketPruner, CapturePlanner, focus_positions
+from .upload import get_uploader
+from .catalog import get_catalog
+from .session import (  # noqa f401
+    as_connection,
+    get_camera,
+    get_camera_session,
+    get_camera_sessions,
+)
+from .thumbnails import can_thumbnail, make_thumbnail
+from .timeline import open_timeline, span
 
 WORKER: Optional["WorkerThread"] = None
 
@@ -48,50 +55,18 @@ class CameraContext(object):
 
 
 def upload_files(url, job_name, file_paths=[], delete_on_success=True):
-    multiple_files = []
-
-    for file_path in file_paths:
-        mimetype = mimetypes.guess_type(file_path)[0]
-        multiple_files.append(
-            ("files", (Path(file_path).name, open(file_path, "rb"), mimetype))
-        )
-    data = {"job_name": job_name}
-    multiple_files.append(("data", ("data", json.dumps(data), "application/json")))
-    print("Uploading Files")
-    response = requests.post(url, files=multiple_files)
-
-    for file in multiple_files:
-        open_file = file[1][1]
-        if hasattr(open_file, "close"):
-            open_file.close()
-    if response.status_code == 200 and delete_on_success:
-        for file_path in file_paths:
-            Path(file_path).unlink()
-    return response
-
-
-def get_camera():
-    context = gp.gp_context_new()
-    camera = gp.check_result(gp.gp_camera_new())
-    gp.check_result(gp.gp_camera_init(camera, context))
-
-    return camera
+    return get_uploader().upload(
+        job_name, file_paths, delete_on_success=delete_on_success, url=url
+    )
 
 
-def get_camera_setting(camera, setting_name):
-    config = gp.check_result(gp.gp_camera_get_config(camera))
-    setting = gp.check_result(gp.gp_widget_get_child_by_name(config, setting_name))
-    return gp.check_result(gp.gp_widget_get_value(setting))
+def get_camera_setting(camera, setting_name, refresh=False):
+    return as_connection(camera).settings.get(setting_name, refresh=refresh)
 
 
 def change_camera_setting(camera, setting_name, value):
     """Change a camera setting."""
-    config = gp.check_result(gp.gp_camera_get_config(camera))
-    setting = gp.check_result(gp.gp_widget_get_child_by_name(config, setting_name))
-    gp.check_result(gp.gp_widget_set_value(setting, value))
-    gp.check_result(gp.gp_camera_set_config(camera, config))
-    print(f"Setting: {setting_name} Set to: {value}")
-    time.sleep(0.1)
+    as_connection(camera).settings.set(setting_name, value)
 
 
 def capture_image(camera, local_path, thumbnail=True, delete_on_camera=True):
@@ -101,7 +76,7 @@ def capture_image(camera, local_path, thumbnail=True, delete_on_camera=True):
     print("Image captured:", file_path.name)
 
     # disable thumbnail if image is not valid for thumbnailing
-    if thumbnail and not file_path.name.lower().endswith("jpg"):
+    if thumbnail and not can_thumbnail(file_path.name):
         thumbnail = False
 
     # Download the image
@@ -119,15 +94,20 @@ def capture_image(camera, local_path, thumbnail=True, delete_on_camera=True):
         )
     print("Image saved as:", local_path)
     if thumbnail:
-        thumbnail_path = Path(local_path).parent / ".thumbnails" / Path(local_path).name
-        thumbnail_path.parent.mkdir(exist_ok=True, parents=True)
-        im = Image.open(local_path)
-        im.thumbnail(THUMBNAIL_SIZE)
-        im.save(thumbnail_path)
-        print("Thumbnail saved as:", thumbnail_path.as_posix())
+        make_thumbnail(local_path)
     return local_path
 
 
+@contextmanager
+def as_pipeline(camera):
+    """Use an existing capture pipeline or wrap a camera or session in one."""
+    if isinstance(camera, CapturePipeline):
+        yield camera
+    else:
+        with CapturePipeline(as_connection(camera)) as pipeline:
+            yield pipeline
+
+
 def capture_focus_bracket(
     camera,
     local_path,
@@ -136,49 +116,68 @@ def capture_focus_bracket(
     focus_stop=1500,
     focus_steps=5,
     capture_specular=False,
+    tags=None,
+    focus_values=None,
 ):
-    if int(focus_start) < int(focus_stop):
-        tmp_focus_start = focus_stop
-        tmp_focus_stop = focus_start
-        focus_start = tmp_focus_start
-        focus_stop = tmp_focus_stop
-
     base_filename = Path(local_path).name
-    step_size = (focus_start - focus_stop) / ((focus_steps - 1) or 1)
-    for step in range(focus_steps):
-        bracket_filename = f"{base_filename}_{str(step).zfill(3)}"
-        bracket_filepath = Path(local_path).with_name(bracket_filename).as_posix()
-        change_camera_setting(
-            camera, focus_settings, str(int(focus_stop + (step_size * step)))
-        )
-        if capture_specular:
-            for idx, image in enumerate(
-                capture_specular_maps(camera, bracket_filename)
-            ):
-                yield ((step + 1 + idx) / (focus_steps * 2)), image
-        else:
-            local_path = capture_image(camera, bracket_filepath)
-            yield ((step + 1) / focus_steps), local_path
+    if focus_values is not None:
+        positions = sorted(int(x) for x in focus_values)
+    else:
+        positions = focus_positions(focus_start, focus_stop, focus_steps)
+    with as_pipeline(camera) as pipeline:
+        for step, focus in enumerate(positions):
+            bracket_filename = f"{base_filename}_{str(step).zfill(3)}"
+            bracket_filepath = Path(local_path).with_name(bracket_filename).as_posix()
+            bracket_tags = dict(tags or {}, bracket=step)
+            pipeline.change_setting(focus_settings, str(focus))
+            if capture_specular:
+                for idx, image in enumerate(
+                    capture_specular_maps(pipeline, bracket_filepath, bracket_tags)
+                ):
+                    yield ((step + 1 + idx) / (len(positions) * 2)), image
+            else:
+                local_path = pipeline.capture(bracket_filepath, bracket_tags)
+                yield ((step + 1) / len(positions)), local_path
 
 
-def capture_specular_maps(camera, filepath):
-    diffuse = capture_image(camera, filepath)
-    with Stepper(
+def get_polarizer_stepper():
+    return Stepper(
         POLARIZER_STEPPER_PIN,
         direction_pin=POLARIZER_DIRECTION_PIN,
         cool_down=0,
         steps_per_rotation=POLARIZER_STEPS_PER_ROTATION,
-    ) as polarizer_stepper:
-        polarizer_stepper.advance_degrees(
-            degrees=90, direction=polarizer_stepper.FORWARD
-        )
+    )
+
+
+def rotate_polarizer(polarizer, specular, timeline=None, tags=None):
+    """Turn the polarizer 90 degrees into or out of the specular position."""
+    direction = polarizer.FORWARD if specular else polarizer.REVERSE
+    with span(timeline, "polarizer", **(tags or {})):
+        polarizer.advance_degrees(degrees=90, direction=direction)
+
+
+def record_move(timeline, move, tags):
+    """Add a finished stepper move and its settle time to the timeline."""
+    started = getattr(move, "started", None)
+    if timeline is None or started is None or move.actual_time is None:
+        return
+    timeline.record("move", started, move.actual_time, **tags)
+    timeline.record("settle", started + move.actual_time, move.cool_down, **tags)
+
+
+def capture_specular_maps(camera, filepath, tags=None, polarizer=None):
+    with ExitStack() as stack:
+        pipeline = stack.enter_context(as_pipeline(camera))
+        if polarizer is None:
+            polarizer = stack.enter_context(get_polarizer_stepper())
+        diffuse = pipeline.capture(filepath, tags)
+        rotate_polarizer(polarizer, True)
         spec_filepath = Path(
-            Path(filepath).parent, Path(filepath).stem + "_spec" + Path(filepath).suffix
+            Path(filepath).parent,
+            Path(filepath).stem + "_spec" + Path(filepath).suffix,
         ).as_posix()
-        spec = capture_image(camera, spec_filepath)
-        polarizer_stepper.advance_degrees(
-            degrees=90, direction=polarizer_stepper.REVERSE
-        )
+        spec = pipeline.capture(spec_filepath, dict(tags or {}, specular=True))
+        rotate_polarizer(polarizer, False)
     return [diffuse, spec]
 
 
@@ -190,28 +189,56 @@ def bulk_capture_turntable(
     focus_bracket_settings=None,
     degree_per_capture=6.0,
     capture_specular=False,
+    prune_brackets=False,
+    processing_options=None,
+    priority=None,
 ):
+    pruner = None
+    if prune_brackets and focus_bracket_settings is not None:
+        pruner = BracketPruner()
+
     with Stepper(
         step_pin=TURNTABLE_STEPPER_PIN,
         steps_per_rotation=TURNTABLE_STEPS_PER_ROTATION,
         cool_down=SETTLE_TIME,
     ) as stepper:
 
-        def callback(captured_images, *args, **kwargs):
-            stepper.advance_degrees(degree_per_capture)
-            process_function_background(
-                lambda: upload_files(POST_PROCESS_URL, capture_name, captured_images)
+        def advance():
+            return stepper.move(degree_per_capture)
+
+        def callback(captured_images, tags=None):
+            get_uploader().submit(
+                capture_name,
+                captured_images,
+                options=processing_options,
+                tags=tags,
+                priority=priority,
             )
+            if pruner is not None:
+                # cached, fetched in the background while the capture runs
+                pruner.update(get_uploader().focus_stats(capture_name))
 
-        yield from bulk_capture(
-            capture_root_dir=capture_root_dir,
-            capture_name=capture_name,
-            image_count=image_count,
-            start_number=start_number,
-            focus_bracket_settings=focus_bracket_settings,
-            capture_specular=capture_specular,
-            callback=callback,
-        )
+        spool = get_uploader().spool
+        try:
+            for status in bulk_capture(
+                capture_root_dir=capture_root_dir,
+                capture_name=capture_name,
+                image_count=image_count,
+                start_number=start_number,
+                focus_bracket_settings=focus_bracket_settings,
+                capture_specular=capture_specular,
+                callback=callback,
+                advance=advance,
+                pruner=pruner,
+            ):
+                yield status
+                # hold the capture while the SD card is full of unsent positions
+                while not spool.has_space():
+                    yield "Waiting for uploads to free up space", status[1]
+                    time.sleep(1.0)
+        finally:
+            if pruner is not None:
+                get_uploader().stop_focus_stats(capture_name)
 
 
 def move_turntable(degrees=15.0):
@@ -231,48 +258,137 @@ def bulk_capture(
     focus_bracket_settings=None,
     capture_specular=False,
     callback=None,
+    advance=None,
+    pruner=None,
 ):
+    """Capture a session, one position at a time.
+
+    ``advance`` is called once the frames of a position have been triggered,
+    while they are still downloading in the background. It may return a move
+    to ``wait()`` on, in which case the turntable turns while the downloads
+    finish and ``callback`` runs. ``callback`` is called with the saved paths
+    once the downloads for the position are done, along with the position's
+    tags. A ``BracketPruner`` picks which focus brackets to shoot at each
+    position. Every step is recorded in the session's timeline.
+    """
     image_count = int(image_count)
     start_number = int(start_number)
-    main_step_size = 1.0 / float(image_count)
-    with CameraContext() as camera:
+    focus_setting_name = (focus_bracket_settings or {}).get(
+        "focus_settings", settings.FOCUS_DISTANCE
+    )
+    planner = CapturePlanner(focus_bracket_settings, capture_specular)
+    catalog = get_catalog()
+    catalog.add_session(capture_name)
+    timeline = open_timeline(capture_root_dir, capture_name)
+    session_root = Path(capture_root_dir, capture_name)
+    with ExitStack() as stack:
+        # camera name: pipeline, the only camera of a single camera rig is None
+        pipelines = {
+            session.camera_name: stack.enter_context(
+                CapturePipeline(session, catalog=catalog, timeline=timeline)
+            )
+            for session in get_camera_sessions()
+        }
+        executor = None
+        if len(pipelines) > 1:
+            executor = stack.enter_context(
+                ThreadPoolExecutor(len(pipelines), thread_name_prefix="camera")
+            )
+        polarizer, polarized, focus = None, False, None
+        if capture_specular:
+            polarizer = stack.enter_context(get_polarizer_stepper())
+
+            @stack.callback
+            def reset_polarizer():
+                # leave the polarizer where the next session expects it
+                if polarized:
+                    rotate_polarizer(polarizer, False, timeline)
+
         for idx in range(image_count):
             image_id = idx + start_number
-            capture_path = Path(
-                capture_root_dir,
-                capture_name,
-                f"{capture_name}_{str(image_id).zfill(4)}",
-            ).as_posix()
-            captured_images = []
-            if focus_bracket_settings is not None:
-                for completion, local_path in capture_focus_bracket(
-                    camera,
-                    capture_path,
-                    capture_specular=capture_specular,
-                    **focus_bracket_settings,
-                ):
-                    base_completion = float(idx) / float(image_count)
-                    percent_complete = base_completion + (main_step_size * completion)
-                    captured_images.append(local_path)
-                    yield Path(capture_path).name, percent_complete
-            else:
-                if capture_specular:
-                    base_percent = float(idx) / float(image_count)
-                    for i, image in enumerate(
-                        capture_specular_maps(camera, capture_path)
-                    ):
-                        increment = 0.5 / float(image_count)
-                        percent_complete = base_percent + (increment * (1 + i))
-                        captured_images.append(image)
-                        yield image, percent_complete
-                    pass
-                else:
-                    percent_complete = float(idx + 1) / float(image_count)
-                    local_path = capture_image(camera, capture_path)
-                    captured_images.append(local_path)
-                    yield Path(capture_path).name, percent_complete
+            tags = {"session": capture_name, "position": image_id}
+            position_start, position_begin = time.time(), time.monotonic()
+            brackets = None
+            if pruner is not None and planner.focus is not None:
+                brackets = pruner.select(idx, range(len(planner.focus)))
+            steps = planner.next_position(brackets)
+            for step_idx, step in enumerate(steps):
+                frame_tags = dict(tags)
+                if step.bracket is not None:
+                    frame_tags["bracket"] = step.bracket
+                if step.specular:
+                    frame_tags["specular"] = True
+                if step.specular != polarized:
+                    rotate_polarizer(
+                        polarizer, step.specular, timeline, {"position": image_id}
+                    )
+                    polarized = step.specular
+                if step.focus is not None and step.focus != focus:
+                    on_cameras(
+                        executor,
+                        pipelines,
+                        lambda camera, pipeline: pipeline.change_setting(
+                            focus_setting_name,
+                            str(step.focus),
+                            camera_tags(frame_tags, camera),
+                        ),
+                    )
+                    focus = step.focus
+
+                def shoot(camera, pipeline):
+                    name = frame_name(
+                        capture_name, image_id, camera, step.bracket, step.specular
+                    )
+                    pipeline.capture(
+                        Path(session_root, name).as_posix(),
+                        camera_tags(frame_tags, camera),
+                    )
+                    return name
+
+                names = on_cameras(executor, pipelines, shoot)
+                percent_complete = (idx + (step_idx + 1) / len(steps)) / image_count
+                yield ", ".join(names), percent_complete
+            motion = advance() if advance else None
+            with span(timeline, "drain", position=image_id):
+                captured = on_cameras(
+                    executor, pipelines, lambda camera, pipeline: pipeline.drain()
+                )
             if callback:
-                callback(captured_images)
+                for camera, captured_images in zip(pipelines, captured):
+                    # each camera is uploaded, and stacked, on its own
+                    callback(captured_images, tags=camera_tags(tags, camera))
+            if motion is not None:
+                motion.wait()
+                record_move(timeline, motion, {"position": image_id})
+            timeline.record(
+                "position",
+                position_start,
+                time.monotonic() - position_begin,
+                position=image_id,
+            )
+
+
+def frame_name(capture_name, position, camera=None, bracket=None, specular=False):
+    """{capture name}[_{camera}]_{position}[_{bracket}][_spec]"""
+    name = f"{capture_name}_{camera}" if camera else capture_name
+    name += f"_{str(position).zfill(4)}"
+    if bracket is not None:
+        name += f"_{str(bracket).zfill(3)}"
+    if specular:
+        name += "_spec"
+    return name
+
+
+def camera_tags(tags, camera):
+    return dict(tags, camera=camera) if camera else tags
+
+
+def on_cameras(executor, pipelines, func):
+    """Call ``func(camera, pipeline)`` per camera, concurrently with several."""
+    if executor is None:
+        return [func(camera, pipeline) for camera, pipeline in pipelines.items()]
+    futures = [executor.submit(func, *item) for item in pipelines.items()]
+    return [future.result() for future in futures]
 
 
 def mock_bulk_capture(
@@ -324,11 +440,14 @@ def list_usb_drives():
 def get_worker_progress():
     global WORKER
 
+    progress = get_uploader().progress()
+    progress["spool"] = get_uploader().spool.status()
     if WORKER and WORKER.is_alive():
         if WORKER._queue.qsize() or WORKER.is_executing_job():
-            return {"running": True, "pending_jobs": WORKER._queue.qsize()}
+            progress["running"] = True
+            progress["pending_jobs"] += WORKER._queue.qsize()
 
-    return {"running": False, "pending_jobs": 0}
+    return progress
 
 
 def process_function_background(func):
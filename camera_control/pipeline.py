@@ -0,0 +1,272 @@
+from pathlib import Path
+import queue
+import threading
+import time
+
+try:
+    import gphoto2 as gp
+except ImportError:
+    gp = None
+
+from .events import publish
+from .timeline import span
+from .thumbnails import (
+    can_thumbnail,
+    get_thumbnailer,
+    make_thumbnail,
+    make_thumbnail_from_preview,
+)
+
+# How long to wait for the camera to report a new file after a trigger
+CAPTURE_TIMEOUT = 30.0
+# Poll interval on the camera event queue, in milliseconds
+EVENT_POLL_MS = 100
+# Files added with no CAPTURE_COMPLETE after this long of quiet, in seconds,
+# are taken to be the whole capture
+CAPTURE_QUIET_SECONDS = 2.0
+
+
+class CaptureError(Exception):
+    pass
+
+
+class CapturePipeline(object):
+    """Overlap frame downloads with the rest of the capture.
+
+    Captures are triggered on the calling thread and the new files are picked
+    up from the camera event queue. Downloading and saving run on a
+    background thread, and thumbnails are made on another, so the turntable
+    and focus motor can move while the previous frame is still coming off
+    the camera. Deletes on the camera are batched up and run when the
+    pipeline is drained. Each step is recorded on ``timeline`` when given.
+
+    All camera access is sent as commands through ``connection`` (a camera
+    session), so the background thread never talks to the camera at the same
+    time as the capture thread or anything else using the session.
+    """
+
+    def __init__(
+        self,
+        connection,
+        thumbnail=True,
+        delete_on_camera=True,
+        catalog=None,
+        timeline=None,
+    ):
+        self.connection = connection
+        self.catalog = catalog
+        self.timeline = timeline
+        self.settings = connection.settings
+        self.thumbnail = thumbnail
+        self.delete_on_camera = delete_on_camera
+        self._downloads = queue.Queue()
+        self._pending_deletes = []
+        self._completed = []
+        self._errors = []
+        self._thumbnails = []
+        self._thread = None
+        self._stop_event = threading.Event()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        try:
+            # still collect the frames already taken when a capture is stopped
+            if type is None or not issubclass(type, Exception):
+                self.drain()
+        finally:
+            self.stop()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._download_loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+
+    def change_setting(self, setting_name, value, tags=None):
+        """Change a camera setting and wait for the camera to act on it.
+
+        The confirmation polls are separate camera commands so pending
+        downloads can use the USB link while the focus motor moves.
+        """
+        with self._span("setting", tags, setting=setting_name):
+            self.settings.set(setting_name, value)
+
+    def capture(self, local_path, tags=None):
+        """Trigger a capture and queue its files for download.
+
+        Returns the local path the first new file will be saved to. The file
+        is only guaranteed to exist once ``drain`` has returned. ``tags``
+        (session, position, bracket, specular) are recorded in the catalog
+        with each saved file.
+        """
+        with self._span("trigger", tags):
+            file_paths = self.connection.call(self._trigger_capture)
+
+        local_paths = []
+        for file_path in file_paths:
+            print("Image captured:", file_path.name)
+            target_path = (
+                Path(local_path).with_suffix(Path(file_path.name).suffix).as_posix()
+            )
+            self._downloads.put(
+                (file_path.folder, file_path.name, target_path, tags or {})
+            )
+            local_paths.append(target_path)
+        return local_paths[0]
+
+    def drain(self):
+        """Wait for queued downloads, flush camera deletes, return the saved paths."""
+        self._downloads.join()
+        self._flush_deletes()
+        # uploads may delete the files, so thumbnails have to be done first
+        thumbnails = self._thumbnails
+        self._thumbnails = []
+        for future in thumbnails:
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Failed to make thumbnail: {e}")
+        if self._errors:
+            errors = self._errors
+            self._errors = []
+            raise CaptureError(f"{len(errors)} download(s) failed: {errors[0]}")
+        completed = self._completed
+        self._completed = []
+        return completed
+
+    @staticmethod
+    def _trigger_capture(camera):
+        CapturePipeline._discard_events(camera)
+        gp.check_result(gp.gp_camera_trigger_capture(camera))
+        file_paths = []
+        last_file = None
+        deadline = time.monotonic() + CAPTURE_TIMEOUT
+        while time.monotonic() < deadline:
+            event_type, event_data = gp.check_result(
+                gp.gp_camera_wait_for_event(camera, EVENT_POLL_MS)
+            )
+            if event_type == gp.GP_EVENT_FILE_ADDED:
+                file_paths.append(event_data)
+                last_file = time.monotonic()
+            elif event_type == gp.GP_EVENT_CAPTURE_COMPLETE and file_paths:
+                # RAW+JPEG shows up as two file events, both before this one
+                break
+            elif (
+                event_type == gp.GP_EVENT_TIMEOUT
+                and file_paths
+                and time.monotonic() - last_file >= CAPTURE_QUIET_SECONDS
+            ):
+                # for cameras that never report the capture as complete
+                break
+        if not file_paths:
+            raise CaptureError("Timed out waiting for the camera to add a file")
+        return file_paths
+
+    @staticmethod
+    def _discard_events(camera):
+        """Empty the event queue so nothing left in it is taken for the capture."""
+        deadline = time.monotonic() + EVENT_POLL_MS / 1000
+        while time.monotonic() < deadline:
+            event_type, event_data = gp.check_result(
+                gp.gp_camera_wait_for_event(camera, 0)
+            )
+            if event_type == gp.GP_EVENT_TIMEOUT:
+                return
+            if event_type == gp.GP_EVENT_FILE_ADDED:
+                print("Ignoring file added before the capture:", event_data.name)
+
+    def _download_loop(self):
+        while not self._stop_event.is_set():
+            try:
+                folder, name, local_path, tags = self._downloads.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            try:
+                self._download(folder, name, local_path, tags)
+            except Exception as e:
+                print(f"Failed to download {name}: {e}")
+                self._errors.append(e)
+            finally:
+                self._downloads.task_done()
+
+    def _download(self, folder, name, local_path, tags):
+        with self._span("file_get", tags, file=name):
+            camera_file = self.connection.call(
+                lambda camera: gp.check_result(
+                    gp.gp_camera_file_get(camera, folder, name, gp.GP_FILE_TYPE_NORMAL)
+                )
+            )
+        Path(local_path).parent.mkdir(exist_ok=True, parents=True)
+        with self._span("save", tags, file=name):
+            gp.check_result(gp.gp_file_save(camera_file, local_path))
+        print("Image saved as:", local_path)
+        if self.delete_on_camera:
+            self._pending_deletes.append((folder, name))
+        if self.catalog is not None and tags.get("session"):
+            try:
+                self.catalog.add_capture(path=local_path, **tags)
+            except Exception as e:
+                print(f"Failed to catalog {local_path}: {e}")
+        publish("frame", dict(tags, path=local_path))
+        if self.thumbnail:
+            self._queue_thumbnail(folder, name, local_path, tags)
+        self._completed.append(local_path)
+
+    def _make_thumbnail(self, local_path, tags, preview_data=None):
+        with self._span("thumbnail", tags):
+            if preview_data is None:
+                thumbnail_path = make_thumbnail(local_path)
+            else:
+                thumbnail_path = make_thumbnail_from_preview(local_path, preview_data)
+        if self.catalog is not None:
+            self.catalog.set_thumbnail(local_path, thumbnail_path)
+        publish("thumbnail", dict(tags, path=local_path, thumbnail=thumbnail_path))
+        return thumbnail_path
+
+    def _queue_thumbnail(self, folder, name, local_path, tags):
+        if can_thumbnail(local_path):
+            future = get_thumbnailer().submit(self._make_thumbnail, local_path, tags)
+        else:
+            # no preview we can read locally, ask the camera for its small one
+            with self._span("preview_get", tags, file=name):
+                preview_data = self.connection.call(self._get_preview, folder, name)
+            future = get_thumbnailer().submit(
+                self._make_thumbnail, local_path, tags, preview_data
+            )
+        self._thumbnails.append(future)
+
+    @staticmethod
+    def _get_preview(camera, folder, name):
+        camera_file = gp.check_result(
+            gp.gp_camera_file_get(camera, folder, name, gp.GP_FILE_TYPE_PREVIEW)
+        )
+        return bytes(gp.check_result(gp.gp_file_get_data_and_size(camera_file)))
+
+    def _flush_deletes(self):
+        if not self._pending_deletes:
+            return
+        pending_deletes = self._pending_deletes
+        self._pending_deletes = []
+
+        # the xt2 keeps captures in an in memory buffer which will lock I/O when full
+        def delete_files(camera):
+            for folder, name in pending_deletes:
+                gp.check_result(gp.gp_camera_file_delete(camera, folder, name))
+
+        with self._span("delete", None, files=len(pending_deletes)):
+            self.connection.call(delete_files)
+
+    def _span(self, name, tags, **extra):
+        tags = {key: value for key, value in (tags or {}).items() if key != "session"}
+        return span(self.timeline, name, **tags, **extra)
@@ -0,0 +1,218 @@
+from collections import defaultdict, deque
+from typing import NamedTuple, Optional
+
+from .const import lenses
+from .settings import BRACKET_PRUNE_THRESHOLD, BRACKET_RECHECK_INTERVAL
+
+# Acceptable circle of confusion for the X-T2's APS-C sensor, in mm
+DEFAULT_CIRCLE_OF_CONFUSION = 0.02
+DEFAULT_FOCAL_LENGTH = 35.0
+# Fraction of each bracket's depth of field shared with the next one
+DEFAULT_DOF_OVERLAP = 0.1
+MAX_DOF_BRACKETS = 64
+# Positions in a row a bracket must stay under the threshold before it's dropped
+PRUNE_WINDOW = 3
+
+
+class CaptureStep(NamedTuple):
+    bracket: Optional[int]
+    focus: Optional[int]
+    specular: bool
+
+
+def focus_positions(focus_start=1730, focus_stop=1500, focus_steps=5):
+    """Focus value of each bracket, from ``focus_stop`` to ``focus_start``."""
+    focus_start, focus_stop = int(focus_start), int(focus_stop)
+    if focus_start < focus_stop:
+        focus_start, focus_stop = focus_stop, focus_start
+    focus_steps = int(focus_steps)
+    step_size = (focus_start - focus_stop) / ((focus_steps - 1) or 1)
+    return [int(focus_stop + (step_size * step)) for step in range(focus_steps)]
+
+
+def distance_to_focus(distance, lens=lenses.x35mm):
+    """Interpolate the focus value for a subject distance in metres.
+
+    The lens table is interpolated in dioptres, which the focus motor
+    follows far more closely than distance. Distances outside the table
+    are clamped to its ends.
+    """
+    distances, focus_values = lens.value
+    dioptres = 1.0 / max(distance, distances[0])
+    if distance >= distances[-1]:
+        return focus_values[-1]
+    for (d0, f0), (d1, f1) in zip(
+        zip(distances, focus_values), zip(distances[1:], focus_values[1:])
+    ):
+        if distance <= d1:
+            t = (dioptres - 1.0 / d0) / (1.0 / d1 - 1.0 / d0)
+            return int(round(f0 + (f1 - f0) * t))
+
+
+def plan_focus_brackets(
+    near,
+    far,
+    aperture,
+    circle_of_confusion=DEFAULT_CIRCLE_OF_CONFUSION,
+    focal_length=DEFAULT_FOCAL_LENGTH,
+    lens=lenses.x35mm,
+    overlap=DEFAULT_DOF_OVERLAP,
+):
+    """Fewest focus values whose depth of field covers ``near`` to ``far``.
+
+    Distances are in metres, the circle of confusion and focal length in mm.
+    Each bracket is focused so its near limit sits ``overlap`` of the way
+    into the depth of field of the bracket before it, starting from
+    ``near``. Focus values are returned in ascending order like
+    ``focus_positions``.
+    """
+    near, far = sorted((float(near) * 1000, float(far) * 1000))
+    f = float(focal_length)
+    hyperfocal = f * f / (float(aperture) * float(circle_of_confusion)) + f
+    distances = []
+    near_limit = near
+    while len(distances) < MAX_DOF_BRACKETS:
+        if near_limit >= hyperfocal - f:
+            # everything from here on is sharp when focused at infinity
+            distances.append(far)
+            break
+        distance = near_limit * (hyperfocal - 2 * f) / (hyperfocal - f - near_limit)
+        distances.append(distance)
+        if distance >= hyperfocal:
+            break
+        far_limit = distance * (hyperfocal - f) / (hyperfocal - distance)
+        if far_limit >= far:
+            break
+        near_limit = far_limit - overlap * (far_limit - near_limit)
+    focus = {distance_to_focus(distance / 1000, lens) for distance in distances}
+    return sorted(focus)
+
+
+class CapturePlanner(object):
+    """Order the frames of each position to keep focus and polarizer moves down.
+
+    The planner remembers where the focus and polarizer were left at the end
+    of the last position. With ``serpentine`` the next focus sweep starts
+    from the bracket the last one ended on instead of driving back across
+    the whole range. With ``batch_specular`` every diffuse bracket is shot,
+    the polarizer is rotated once and the specular brackets are shot on the
+    way back, and the next position starts with whichever polarization the
+    last one finished on.
+
+    Bracket numbers always follow the focus value so frames line up across
+    positions no matter which order they were shot in.
+    """
+
+    def __init__(
+        self,
+        focus_bracket_settings=None,
+        capture_specular=False,
+        serpentine=True,
+        batch_specular=True,
+    ):
+        focus_bracket_settings = dict(focus_bracket_settings or {})
+        focus_bracket_settings.pop("focus_settings", None)
+        if "focus_values" in focus_bracket_settings:
+            self.focus = sorted(int(x) for x in focus_bracket_settings["focus_values"])
+        elif focus_bracket_settings:
+            self.focus = focus_positions(**focus_bracket_settings)
+        else:
+            self.focus = None
+        self.capture_specular = bool(capture_specular)
+        self.serpentine = serpentine
+        self.batch_specular = batch_specular
+        self.reverse = False
+        self.specular = False
+
+    def next_position(self, brackets=None):
+        """Frames to shoot at the next position, in the order to shoot them.
+
+        ``brackets`` limits the position to a subset of the focus brackets.
+        """
+        if self.focus is None:
+            brackets = [None]
+        elif brackets is None:
+            brackets = list(range(len(self.focus)))
+        else:
+            brackets = sorted(brackets)
+        if self.reverse:
+            brackets.reverse()
+
+        if not self.capture_specular:
+            steps = [self._step(bracket, False) for bracket in brackets]
+        elif self.batch_specular:
+            first, second = self.specular, not self.specular
+            steps = [self._step(bracket, first) for bracket in brackets]
+            steps += [self._step(bracket, second) for bracket in reversed(brackets)]
+            self.specular = second
+            # the sweep back leaves focus where this position started
+            return steps
+        else:
+            steps = []
+            for bracket in brackets:
+                steps.append(self._step(bracket, False))
+                steps.append(self._step(bracket, True))
+
+        if self.serpentine:
+            self.reverse = not self.reverse
+        return steps
+
+    def _step(self, bracket, specular):
+        focus = None if bracket is None else self.focus[bracket]
+        return CaptureStep(bracket, focus, specular)
+
+
+class BracketPruner(object):
+    """Stop shooting focus brackets that add next to nothing to the stack.
+
+    The processing server reports the share of the focus mask each bracket
+    won at every stacked position. A bracket that stays under ``threshold``
+    for ``window`` positions in a row is dropped for the rest of the
+    session. Every ``recheck_interval`` positions all brackets are shot
+    again, and a dropped bracket comes back as soon as it wins a share over
+    the threshold.
+    """
+
+    def __init__(
+        self,
+        threshold=BRACKET_PRUNE_THRESHOLD,
+        recheck_interval=BRACKET_RECHECK_INTERVAL,
+        window=PRUNE_WINDOW,
+    ):
+        self.threshold = threshold
+        self.recheck_interval = recheck_interval
+        self.pruned = set()
+        self._shares = defaultdict(lambda: deque(maxlen=window))
+        self._seen = set()
+
+    def update(self, positions):
+        """Take in ``{position: {bracket: share}}`` reported by the server."""
+        for position, brackets in positions.items():
+            if position in self._seen:
+                continue
+            self._seen.add(position)
+            for bracket, share in brackets.items():
+                bracket = int(bracket)
+                shares = self._shares[bracket]
+                shares.append(share)
+                if share >= self.threshold:
+                    if bracket in self.pruned:
+                        print(f"Bracket {bracket} won {share:.1%}, shooting it again")
+                    self.pruned.discard(bracket)
+                elif len(shares) == shares.maxlen and max(shares) < self.threshold:
+                    if bracket not in self.pruned:
+                        print(
+                            f"Bracket {bracket} below {self.threshold:.1%}, dropping it"
+                        )
+                    self.pruned.add(bracket)
+
+    def select(self, index, brackets):
+        """Brackets to shoot at the ``index``th position of the session."""
+        brackets = list(brackets)
+        if self.recheck_interval and index % self.recheck_interval == 0:
+            return brackets
+        active = [bracket for bracket in brackets if bracket not in self.pruned]
+        if not active:
+            # never drop the whole stack, keep whichever bracket did best lately
+            active = [max(brackets, key=lambda x: max(self._shares[x], default=0))]
+        return active
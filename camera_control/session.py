@@ -0,0 +1,295 @@
+from concurrent.futures import Future
+from typing import List, Optional
+import atexit
+import queue
+import threading
+import time
+
+try:
+    import gphoto2 as gp
+except ImportError:
+    gp = None
+
+from .camera_settings import CameraSettings
+from .settings import CAMERA_NAMES
+
+SESSION: Optional["CameraSession"] = None
+# one session per camera when more than one is attached
+SESSIONS: List["CameraSession"] = []
+
+# Seconds of idle time between health checks of the camera connection
+HEALTH_CHECK_INTERVAL = 10.0
+# Errors that mean the USB connection is gone rather than a bad request
+RECONNECT_ERRORS = (
+    "GP_ERROR_IO",
+    "GP_ERROR_IO_USB_FIND",
+    "GP_ERROR_IO_USB_CLAIM",
+    "GP_ERROR_MODEL_NOT_FOUND",
+    "GP_ERROR_CAMERA_ERROR",
+)
+
+
+def get_camera(port=None, model=None):
+    """Open the first camera found, or the ``model`` camera on a USB ``port``."""
+    context = gp.gp_context_new()
+    camera = gp.check_result(gp.gp_camera_new())
+    if port is not None:
+        port_info_list = gp.check_result(gp.gp_port_info_list_new())
+        gp.check_result(gp.gp_port_info_list_load(port_info_list))
+        index = gp.check_result(gp.gp_port_info_list_lookup_path(port_info_list, port))
+        port_info = gp.check_result(
+            gp.gp_port_info_list_get_info(port_info_list, index)
+        )
+        gp.check_result(gp.gp_camera_set_port_info(camera, port_info))
+        abilities_list = gp.check_result(gp.gp_abilities_list_new())
+        gp.check_result(gp.gp_abilities_list_load(abilities_list, context))
+        index = gp.check_result(
+            gp.gp_abilities_list_lookup_model(abilities_list, model)
+        )
+        abilities = gp.check_result(
+            gp.gp_abilities_list_get_abilities(abilities_list, index)
+        )
+        gp.check_result(gp.gp_camera_set_abilities(camera, abilities))
+    gp.check_result(gp.gp_camera_init(camera, context))
+
+    return camera
+
+
+def detect_cameras():
+    """(model, port) of every attached camera, in port order."""
+    context = gp.gp_context_new()
+    camera_list = gp.check_result(gp.gp_camera_autodetect(context))
+    cameras = []
+    for index in range(gp.check_result(gp.gp_list_count(camera_list))):
+        cameras.append(
+            (
+                gp.check_result(gp.gp_list_get_name(camera_list, index)),
+                gp.check_result(gp.gp_list_get_value(camera_list, index)),
+            )
+        )
+    return sorted(cameras, key=lambda camera: camera[1])
+
+
+def camera_name(index):
+    if index < len(CAMERA_NAMES):
+        return CAMERA_NAMES[index]
+    return f"cam{index + 1}"
+
+
+def is_connection_error(error):
+    codes = [getattr(gp, name, None) for name in RECONNECT_ERRORS]
+    return getattr(error, "code", None) in codes
+
+
+class CameraConnection(object):
+    """Run camera commands on the calling thread, one at a time.
+
+    Has the same ``call`` interface as ``CameraSession`` for code that was
+    handed a bare gphoto2 camera.
+    """
+
+    def __init__(self, camera):
+        self.camera = camera
+        self.lock = threading.RLock()
+        self.settings = CameraSettings(self)
+
+    def call(self, func, *args, **kwargs):
+        with self.lock:
+            return func(self.camera, *args, **kwargs)
+
+
+class CameraSession(threading.Thread):
+    """Long lived camera connection owned by a single thread.
+
+    Everything that talks to the camera sends a command with ``call`` or
+    ``submit``. Commands are functions taking the camera as their first
+    argument and run in order on the session thread, so status queries and
+    capture jobs interleave instead of opening competing sessions. Lost
+    connections are re-opened on the next command or health check.
+    """
+
+    def __init__(
+        self,
+        health_check_interval=HEALTH_CHECK_INTERVAL,
+        port=None,
+        model=None,
+        name=None,
+    ):
+        super().__init__(daemon=True)
+        self.health_check_interval = health_check_interval
+        # which camera to open when several are attached, the first otherwise
+        self.port = port
+        self.model = model
+        self.camera_name = name
+        self.camera = None
+        self.settings = CameraSettings(self)
+        self.last_error = None
+        self._commands = queue.Queue()
+        self._stop_event = threading.Event()
+
+    @property
+    def connected(self):
+        return self.camera is not None
+
+    def status(self):
+        return {
+            "name": self.camera_name,
+            "port": self.port,
+            "connected": self.connected,
+            "pending_commands": self._commands.qsize(),
+            "last_error": str(self.last_error) if self.last_error else None,
+        }
+
+    def submit(self, func, *args, **kwargs):
+        future = Future()
+        if self.stopped():
+            future.set_exception(RuntimeError("Camera session is stopped"))
+        else:
+            self._commands.put((future, func, args, kwargs))
+        return future
+
+    def call(self, func, *args, **kwargs):
+        if threading.current_thread() is self:
+            # commands issued from inside another command run straight away
+            return self._execute(func, args, kwargs)
+        return self.submit(func, *args, **kwargs).result()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def stopped(self):
+        return self._stop_event.is_set()
+
+    def run(self):
+        while not self.stopped():
+            try:
+                future, func, args, kwargs = self._commands.get(
+                    timeout=self.health_check_interval
+                )
+            except queue.Empty:
+                self._health_check()
+                continue
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(self._execute(func, args, kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+        self._disconnect()
+        while not self._commands.empty():
+            future = self._commands.get()[0]
+            future.set_exception(RuntimeError("Camera session is stopped"))
+
+    def _execute(self, func, args, kwargs):
+        self._connect()
+        try:
+            return func(self.camera, *args, **kwargs)
+        except gp.GPhoto2Error as e:
+            if not is_connection_error(e):
+                raise
+            print(f"Lost camera connection ({e}), reconnecting")
+            self._disconnect()
+            self._connect()
+            return func(self.camera, *args, **kwargs)
+
+    def _health_check(self):
+        try:
+            self._connect()
+            # also clears out events from shots taken on the camera itself
+            gp.check_result(gp.gp_camera_wait_for_event(self.camera, 10))
+            self.last_error = None
+        except gp.GPhoto2Error as e:
+            self.last_error = e
+            self._disconnect()
+
+    def _connect(self):
+        if self.camera is not None:
+            return
+        try:
+            self.camera = get_camera(self.port, self.model)
+        except gp.GPhoto2Error as e:
+            self.last_error = e
+            raise
+        self.last_error = None
+        name = f" {self.camera_name}" if self.camera_name else ""
+        print(f"Camera{name} connected")
+
+    def _disconnect(self):
+        self.settings.clear()
+        if self.camera is None:
+            return
+        camera = self.camera
+        self.camera = None
+        try:
+            camera.exit()
+        except gp.GPhoto2Error:
+            time.sleep(2)
+            try:
+                camera.exit()
+            except gp.GPhoto2Error as e:
+                print(f"Failed to close camera: {e}")
+
+
+def as_connection(camera):
+    """Return something with a ``call`` interface for a camera or session."""
+    if hasattr(camera, "call"):
+        return camera
+    return CameraConnection(camera)
+
+
+def get_camera_session():
+    """The camera session, the first camera's on a multi camera rig."""
+    global SESSION
+
+    if SESSIONS:
+        return SESSIONS[0]
+    if not SESSION or not SESSION.is_alive():
+        SESSION = CameraSession()
+        SESSION.start()
+    return SESSION
+
+
+def get_camera_sessions():
+    """A session for every attached camera, named with ``camera_name``.
+
+    With a single camera this is just ``[get_camera_session()]`` and its
+    session has no name.
+    """
+    global SESSIONS
+
+    if SESSIONS and all(session.is_alive() for session in SESSIONS):
+        return SESSIONS
+    cleanup_camera_sessions()
+    cameras = detect_cameras()
+    if len(cameras) <= 1:
+        return [get_camera_session()]
+    # the single session would hold on to one of the cameras
+    cleanup_camera_session()
+    print(f"Found {len(cameras)} cameras")
+    sessions = []
+    for index, (model, port) in enumerate(cameras):
+        session = CameraSession(port=port, model=model, name=camera_name(index))
+        session.start()
+        sessions.append(session)
+    SESSIONS = sessions
+    return SESSIONS
+
+
+@atexit.register
+def cleanup_camera_session():
+    global SESSION
+
+    if SESSION:
+        SESSION.stop()
+        SESSION.join()
+        SESSION = None
+
+
+@atexit.register
+def cleanup_camera_sessions():
+    global SESSIONS
+
+    sessions, SESSIONS = SESSIONS, []
+    for session in sessions:
+        session.stop()
+        session.join()
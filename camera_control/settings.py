@@ -15,3 +15,32 @@ Stepper steps is 400 for a total of 1920 steps for a total rotation
 """
 POST_PROCESS_URL = os.getenv("POST_PROCESS_URL") or "http://192.168.1.183:5000/upload"
 SETTLE_TIME = float(os.getenv("SETTLE_TIME", 3))
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY") or 2)
+UPLOAD_RETRIES = int(os.getenv("UPLOAD_RETRIES") or 5)
+UPLOAD_BACKOFF = float(os.getenv("UPLOAD_BACKOFF") or 1.0)
+PROCESSING_STATUS_URL = (
+    os.getenv("PROCESSING_STATUS_URL") or POST_PROCESS_URL.rsplit("/", 1)[0] + "/status"
+)
+UPLOAD_PAUSE_QUEUE_DEPTH = int(os.getenv("UPLOAD_PAUSE_QUEUE_DEPTH") or 20)
+UPLOAD_RESUME_QUEUE_DEPTH = int(os.getenv("UPLOAD_RESUME_QUEUE_DEPTH") or 10)
+SPOOL_ROOT = os.getenv("UPLOAD_SPOOL_ROOT") or os.path.expanduser("~/.upload_spool")
+SPOOL_MAX_BYTES = int(os.getenv("UPLOAD_SPOOL_MAX_BYTES") or 20 * 1024**3)
+SPOOL_MIN_FREE_BYTES = int(os.getenv("UPLOAD_SPOOL_MIN_FREE_BYTES") or 2 * 1024**3)
+CATALOG_PATH = os.getenv("CAPTURE_CATALOG_PATH") or os.path.join(
+    CAPTURE_ROOT, ".catalog.sqlite3"
+)
+PAGE_SIZE = int(os.getenv("PAGE_SIZE") or 48)
+PROCESSING_JOBS_URL = (
+    os.getenv("PROCESSING_JOBS_URL") or POST_PROCESS_URL.rsplit("/", 1)[0] + "/jobs"
+)
+BRACKET_PRUNE_THRESHOLD = float(os.getenv("BRACKET_PRUNE_THRESHOLD") or 0.02)
+BRACKET_RECHECK_INTERVAL = int(os.getenv("BRACKET_RECHECK_INTERVAL") or 10)
+# Names for the cameras of a multi camera rig, in USB port order, used in
+# file names. Cameras without one are named cam1, cam2, ...
+CAMERA_NAMES = [
+    name.strip()
+    for name in (os.getenv("CAMERA_NAMES") or "").split(",")
+    if name.strip()
+]
+# Run the web app against the simulated camera instead of a real X-T2
+SIMULATE_RIG = bool(os.getenv("SIMULATE_RIG"))
@@ -0,0 +1,265 @@
+from collections import defaultdict
+from types import SimpleNamespace
+import io
+import itertools
+import threading
+import time
+
+from PIL import Image, ImageDraw
+
+# Rough X-T2 timings, in seconds unless noted
+SHUTTER_TIME = 0.15
+# Time from the shutter closing to the file showing up on the camera
+WRITE_TIME = 0.6
+# USB 2 transfer rate off the camera, in bytes per second
+TRANSFER_RATE = 25 * 1024**2
+# Focus drive time, a fixed overhead plus time per d171 unit moved
+FOCUS_OVERHEAD = 0.05
+FOCUS_TIME_PER_UNIT = 0.0004
+CONFIG_TIME = 0.01
+DELETE_TIME = 0.02
+# Size of each simulated capture, about a fine X-T2 JPEG
+FILE_SIZE = 12 * 1024**2
+SAMPLE_SIZE = (1200, 800)
+PREVIEW_SIZE = (160, 120)
+MODEL = "Fujifilm X-T2"
+
+
+class SimulatedError(Exception):
+    def __init__(self, code):
+        super().__init__(f"Simulated gphoto2 error {code}")
+        self.code = code
+
+
+class SimulatedCamera(object):
+    """Camera state shared by the simulated gphoto2 calls."""
+
+    def __init__(self, file_size=FILE_SIZE, timings=None):
+        self.file_size = file_size
+        self.timings = dict(
+            shutter=SHUTTER_TIME,
+            write=WRITE_TIME,
+            transfer_rate=TRANSFER_RATE,
+            focus_overhead=FOCUS_OVERHEAD,
+            focus_per_unit=FOCUS_TIME_PER_UNIT,
+            config=CONFIG_TIME,
+            delete=DELETE_TIME,
+        )
+        self.timings.update(timings or {})
+        self.model = MODEL
+        # set when opened on a given port, the first camera found otherwise
+        self.port = None
+        self.config = {"d171": "1000"}
+        self.files = {}
+        self.stats = defaultdict(list)
+        self._events = []
+        self._counter = itertools.count(1)
+        self._lock = threading.Lock()
+        self._sample = None
+
+    def record(self, phase, duration):
+        with self._lock:
+            self.stats[phase].append(duration)
+
+    def sample(self):
+        """JPEG padded out to ``file_size`` so uploads move realistic sizes."""
+        if self._sample is None:
+            im = Image.linear_gradient("L").resize(SAMPLE_SIZE).convert("RGB")
+            ImageDraw.Draw(im).text((20, 20), "simulated capture", fill="red")
+            data = io.BytesIO()
+            im.save(data, "JPEG")
+            data = data.getvalue()
+            self._sample = data + b"\0" * max(self.file_size - len(data), 0)
+        return self._sample
+
+    def preview(self):
+        im = Image.new("RGB", PREVIEW_SIZE, "gray")
+        data = io.BytesIO()
+        im.save(data, "JPEG")
+        return data.getvalue()
+
+    def exit(self):
+        pass
+
+
+class SimulatedGPhoto2(object):
+    """The slice of the python-gphoto2 API the capture code uses.
+
+    Calls sleep for about as long as the X-T2 takes over USB so the
+    pipeline, uploads and processing can be benchmarked without the rig.
+    ``cameras`` X-T2s are reported as attached, each on its own USB port.
+    """
+
+    GP_EVENT_UNKNOWN = 0
+    GP_EVENT_TIMEOUT = 1
+    GP_EVENT_FILE_ADDED = 2
+    GP_EVENT_FOLDER_ADDED = 3
+    GP_EVENT_CAPTURE_COMPLETE = 4
+    GP_FILE_TYPE_PREVIEW = 0
+    GP_FILE_TYPE_NORMAL = 1
+    GP_CAPTURE_IMAGE = 0
+    GP_ERROR_BAD_PARAMETERS = -2
+    GP_ERROR_IO = -7
+    GP_ERROR_DIRECTORY_NOT_FOUND = -107
+    GPhoto2Error = SimulatedError
+
+    def __init__(self, cameras=1, **camera_options):
+        self.camera_options = camera_options
+        self.ports = [f"usb:001,{index + 4:03d}" for index in range(cameras)]
+        self.cameras = []
+
+    @staticmethod
+    def check_result(result):
+        return result
+
+    def gp_context_new(self):
+        return None
+
+    def gp_camera_new(self):
+        camera = SimulatedCamera(**self.camera_options)
+        self.cameras.append(camera)
+        return camera
+
+    def gp_camera_init(self, camera, context):
+        if camera.port is None:
+            camera.port = self.ports[0]
+
+    def gp_camera_autodetect(self, context):
+        return [(MODEL, port) for port in self.ports]
+
+    def gp_list_count(self, camera_list):
+        return len(camera_list)
+
+    def gp_list_get_name(self, camera_list, index):
+        return camera_list[index][0]
+
+    def gp_list_get_value(self, camera_list, index):
+        return camera_list[index][1]
+
+    def gp_port_info_list_new(self):
+        return []
+
+    def gp_port_info_list_load(self, port_info_list):
+        port_info_list.extend(self.ports)
+
+    def gp_port_info_list_lookup_path(self, port_info_list, path):
+        return port_info_list.index(path)
+
+    def gp_port_info_list_get_info(self, port_info_list, index):
+        return port_info_list[index]
+
+    def gp_camera_set_port_info(self, camera, port_info):
+        camera.port = port_info
+
+    def gp_abilities_list_new(self):
+        return []
+
+    def gp_abilities_list_load(self, abilities_list, context):
+        abilities_list.append(MODEL)
+
+    def gp_abilities_list_lookup_model(self, abilities_list, model):
+        return abilities_list.index(model)
+
+    def gp_abilities_list_get_abilities(self, abilities_list, index):
+        return abilities_list[index]
+
+    def gp_camera_set_abilities(self, camera, abilities):
+        camera.model = abilities
+
+    def gp_camera_trigger_capture(self, camera):
+        shutter = camera.timings["shutter"]
+        time.sleep(shutter)
+        camera.record("shutter", shutter)
+        name = f"DSCF{next(camera._counter) % 10000:04d}.JPG"
+        path = SimpleNamespace(folder="/store_10000001/DCIM/100_FUJI", name=name)
+        camera.files[(path.folder, name)] = camera.sample()
+        ready = time.monotonic() + camera.timings["write"]
+        with camera._lock:
+            camera._events.append((ready, self.GP_EVENT_FILE_ADDED, path))
+            camera._events.append((ready, self.GP_EVENT_CAPTURE_COMPLETE, None))
+
+    def gp_camera_capture(self, camera, capture_type):
+        self.gp_camera_trigger_capture(camera)
+        while True:
+            event_type, data = self.gp_camera_wait_for_event(camera, 1000)
+            if event_type == self.GP_EVENT_FILE_ADDED:
+                return data
+
+    def gp_camera_wait_for_event(self, camera, timeout):
+        deadline = time.monotonic() + timeout / 1000
+        with camera._lock:
+            ready = camera._events[0][0] if camera._events else None
+        if ready is not None and ready <= deadline:
+            time.sleep(max(ready - time.monotonic(), 0))
+            with camera._lock:
+                _, event_type, data = camera._events.pop(0)
+            return event_type, data
+        time.sleep(max(deadline - time.monotonic(), 0))
+        return self.GP_EVENT_TIMEOUT, None
+
+    def gp_camera_file_get(self, camera, folder, name, file_type):
+        try:
+            data = camera.files[(folder, name)]
+        except KeyError:
+            raise SimulatedError(self.GP_ERROR_DIRECTORY_NOT_FOUND)
+        if file_type == self.GP_FILE_TYPE_PREVIEW:
+            data = camera.preview()
+        duration = len(data) / camera.timings["transfer_rate"]
+        time.sleep(duration)
+        camera.record("transfer", duration)
+        return SimpleNamespace(data=data)
+
+    def gp_file_save(self, camera_file, local_path):
+        with open(local_path, "wb") as f:
+            f.write(camera_file.data)
+
+    def gp_file_get_data_and_size(self, camera_file):
+        return camera_file.data
+
+    def gp_camera_file_delete(self, camera, folder, name):
+        time.sleep(camera.timings["delete"])
+        camera.record("delete", camera.timings["delete"])
+        camera.files.pop((folder, name), None)
+
+    def gp_camera_get_single_config(self, camera, name):
+        if name not in camera.config:
+            raise SimulatedError(self.GP_ERROR_BAD_PARAMETERS)
+        time.sleep(camera.timings["config"])
+        return SimpleNamespace(name=name, value=camera.config[name])
+
+    def gp_camera_set_single_config(self, camera, name, widget):
+        duration = camera.timings["config"]
+        if name == "d171":
+            distance = abs(int(widget.value) - int(camera.config[name]))
+            duration += (
+                camera.timings["focus_overhead"]
+                + camera.timings["focus_per_unit"] * distance
+            )
+        time.sleep(duration)
+        camera.record("focus" if name == "d171" else "config", duration)
+        camera.config[name] = widget.value
+
+    def gp_camera_get_config(self, camera):
+        return camera
+
+    def gp_camera_set_config(self, camera, config):
+        return None
+
+    def gp_widget_get_child_by_name(self, config, name):
+        return self.gp_camera_get_single_config(config, name)
+
+    def gp_widget_get_value(self, widget):
+        return widget.value
+
+    def gp_widget_set_value(self, widget, value):
+        widget.value = value
+
+
+def install(cameras=1, **camera_options):
+    """Swap gphoto2 for ``cameras`` simulated cameras in the capture modules."""
+    from . import camera_settings, lib, pipeline, session
+
+    simulated = SimulatedGPhoto2(cameras, **camera_options)
+    for module in (camera_settings, lib, pipeline, session):
+        module.gp = simulated
+    return simulated
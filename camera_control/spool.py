@@ -0,0 +1,151 @@
+from pathlib import Path
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+
+from .settings import (
+    CAPTURE_ROOT,
+    SPOOL_MAX_BYTES,
+    SPOOL_MIN_FREE_BYTES,
+    SPOOL_ROOT,
+)
+
+INDEX_NAME = "index.json"
+
+
+class UploadSpool(object):
+    """Crash safe list of positions waiting to be uploaded.
+
+    Captured files stay where they were saved, the spool only keeps an index
+    of which files still need to go to the server. The index is rewritten
+    atomically on every change so pending uploads survive a crash or restart
+    and get replayed on startup.
+
+    The spool also tracks how much unsent data sits on the SD card so the
+    capture can wait for uploads instead of filling the card.
+    """
+
+    def __init__(
+        self,
+        root=SPOOL_ROOT,
+        max_bytes=SPOOL_MAX_BYTES,
+        min_free_bytes=SPOOL_MIN_FREE_BYTES,
+        capture_root=CAPTURE_ROOT,
+    ):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.min_free_bytes = min_free_bytes
+        self.capture_root = capture_root
+        self._lock = threading.Lock()
+        self._claimed = set()
+        self.root.mkdir(exist_ok=True, parents=True)
+        self._entries = self._load()
+
+    @property
+    def index_path(self):
+        return self.root / INDEX_NAME
+
+    def add(self, job_name, file_paths, options=None, tags=None, priority=None):
+        file_paths = [Path(file_path).as_posix() for file_path in file_paths]
+        entry = {
+            "id": uuid.uuid4().hex,
+            "job_name": job_name,
+            "files": file_paths,
+            "options": options,
+            "tags": tags,
+            "priority": priority,
+            "bytes": sum(
+                os.path.getsize(file_path)
+                for file_path in file_paths
+                if os.path.exists(file_path)
+            ),
+            "created": time.time(),
+            "attempts": 0,
+            "retry_after": 0,
+        }
+        with self._lock:
+            self._entries.append(entry)
+            self._save()
+        return entry["id"]
+
+    def claim(self):
+        """Take the oldest entry that isn't being uploaded or backing off."""
+        now = time.time()
+        with self._lock:
+            for entry in self._entries:
+                if entry["id"] in self._claimed or entry["retry_after"] > now:
+                    continue
+                self._claimed.add(entry["id"])
+                return dict(entry)
+        return None
+
+    def release(self, entry_id, retry_after=0):
+        """Give an entry back after a failed upload."""
+        with self._lock:
+            self._claimed.discard(entry_id)
+            for entry in self._entries:
+                if entry["id"] == entry_id:
+                    entry["attempts"] += 1
+                    entry["retry_after"] = time.time() + retry_after
+            self._save()
+
+    def remove(self, entry_id):
+        with self._lock:
+            self._claimed.discard(entry_id)
+            self._entries = [
+                entry for entry in self._entries if entry["id"] != entry_id
+            ]
+            self._save()
+
+    def pending_ids(self):
+        with self._lock:
+            return {entry["id"] for entry in self._entries}
+
+    def pending_count(self):
+        with self._lock:
+            return len(self._entries)
+
+    def pending_bytes(self):
+        with self._lock:
+            return sum(entry["bytes"] for entry in self._entries)
+
+    def free_bytes(self):
+        Path(self.capture_root).mkdir(exist_ok=True, parents=True)
+        return shutil.disk_usage(self.capture_root).free
+
+    def has_space(self):
+        """True while the spool and the SD card have room for more captures."""
+        if self.max_bytes and self.pending_bytes() >= self.max_bytes:
+            return False
+        return self.free_bytes() >= self.min_free_bytes
+
+    def status(self):
+        return {
+            "pending": self.pending_count(),
+            "bytes": self.pending_bytes(),
+            "free_bytes": self.free_bytes(),
+            "has_space": self.has_space(),
+        }
+
+    def _load(self):
+        if not self.index_path.exists():
+            return []
+        try:
+            with open(self.index_path) as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Could not read upload spool index {self.index_path}: {e}")
+            return []
+        print(f"Replaying {len(entries)} spooled uploads")
+        return entries
+
+    def _save(self):
+        tmp_path = self.index_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self._entries, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.index_path)
@@ -1,6 +1,9 @@
+from functools import lru_cache
 import time
 import math
 import atexit
+import queue
+import threading
 
 # import RPi.GPIO as GPIO
 try:
@@ -28,11 +31,63 @@ except ImportError:
 
     GPIO = mock_gpio()
 
+try:
+    import pigpio
+except ImportError:
+    pigpio = None
+
 GPIO.setmode(GPIO.BOARD)
 atexit.register(GPIO.cleanup)
 
+# pigpio addresses pins by BCM number while RPi.GPIO is set up with board numbers
+BOARD_TO_BCM = {
+    3: 2, 5: 3, 7: 4, 8: 14, 10: 15, 11: 17, 12: 18, 13: 27, 15: 22, 16: 23,
+    18: 24, 19: 10, 21: 9, 22: 25, 23: 11, 24: 8, 26: 7, 27: 0, 28: 1, 29: 5,
+    31: 6, 32: 12, 33: 13, 35: 19, 36: 16, 37: 26, 38: 20, 40: 21,
+}  # fmt: skip
+# Sleep until this close to a step deadline, then spin for the rest
+SPIN_TIME = 0.0005
+# Largest number of steps sent to pigpio as a single waveform
+MAX_WAVE_STEPS = 2000
+
+
+class Move(object):
+    """A queued stepper move, finished once the move and cool down are done."""
+
+    def __init__(self, steps, direction, profile, cool_down):
+        self.steps = steps
+        self.direction = direction
+        self.profile = profile
+        self.cool_down = cool_down
+        self.planned_time = sum(profile)
+        self.actual_time = None
+        # unix time the motion started, for timelines
+        self.started = None
+        self.error = None
+        self._done = threading.Event()
+
+    def wait(self, timeout=None):
+        if not self._done.wait(timeout):
+            return False
+        if self.error is not None:
+            raise self.error
+        return True
+
+    def done(self):
+        return self._done.is_set()
+
 
 class Stepper:
+    """Drive a stepper with eased moves on a dedicated timing thread.
+
+    ``move`` queues a move and returns straight away so capture work can
+    overlap the motion, ``wait`` blocks until every queued move and its
+    cool down have finished. Step timings come from a cached profile and
+    are sent through pigpio waveforms when the pigpio daemon is available,
+    otherwise they are timed against absolute deadlines on the timing
+    thread.
+    """
+
     FORWARD = 0
     REVERSE = 1
 
@@ -55,6 +110,11 @@ class Stepper:
         self.cool_down = cool_down
         self.direction_pin = direction_pin
         self._board = None
+        self._pi = None
+        self._moves = queue.Queue()
+        self._pending = []
+        self._thread = None
+        self.last_move = None
 
     def __enter__(self):
         self.setup()
@@ -78,8 +138,20 @@ class Stepper:
             GPIO.setup(self.direction_pin, GPIO.OUT)
             GPIO.output(self.direction_pin, self.FORWARD)
 
+        if pigpio is not None and self.step_pin in BOARD_TO_BCM:
+            pi = pigpio.pi()
+            if pi.connected:
+                self._pi = pi
+
     def cleanup(self):
-        pass
+        if self._thread is not None:
+            self.wait()
+            self._moves.put(None)
+            self._thread.join()
+            self._thread = None
+        if self._pi is not None:
+            self._pi.stop()
+            self._pi = None
 
     def one_step(self, speed, direction=FORWARD):
         if self.direction_pin is not None:
@@ -88,21 +160,93 @@ class Stepper:
         time.sleep(speed)
         GPIO.output(self.step_pin, GPIO.LOW)
 
-    def advance_degrees(self, degrees=6.0, direction=FORWARD):
+    def move(self, degrees=6.0, direction=FORWARD, cool_down=None):
+        """Queue a move and return without waiting for it."""
         print(f"Advancing Stepper {degrees} degrees")
         steps_per_degree = self.steps_per_rotation / 360.0
         steps = int(degrees * steps_per_degree)
+        profile = step_profile(steps, self.max_speed, self.min_speed, self.ease_length)
+        move = Move(
+            steps,
+            direction,
+            profile,
+            self.cool_down if cool_down is None else cool_down,
+        )
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._motion_loop, daemon=True)
+            self._thread.start()
+        self._pending.append(move)
+        self._moves.put(move)
+        return move
+
+    def wait(self):
+        """Block until every queued move and its cool down are done."""
+        pending = self._pending
+        self._pending = []
+        for move in pending:
+            move.wait()
+
+    def advance_degrees(self, degrees=6.0, direction=FORWARD):
+        self.move(degrees, direction=direction)
+        self.wait()
 
-        half_steps = steps / 2
-        for step in range(steps):
-            if step < half_steps:
-                x = (step + 1) / self.ease_length
-                step_time = exp_interp(self.max_speed, self.min_speed, x)
-            else:
-                x = (steps - step) / self.ease_length
-                step_time = exp_interp(self.max_speed, self.min_speed, x)
-            self.one_step(step_time, direction=direction)
-        time.sleep(self.cool_down)
+    def _motion_loop(self):
+        while True:
+            move = self._moves.get()
+            if move is None:
+                break
+            try:
+                move.started = time.time()
+                start = time.perf_counter()
+                if self._pi is not None:
+                    self._run_waveform(move)
+                else:
+                    self._run_timed(move)
+                move.actual_time = time.perf_counter() - start
+                print(
+                    f"Stepper moved {move.steps} steps in {move.actual_time:.3f}s "
+                    f"(planned {move.planned_time:.3f}s)"
+                )
+                self.last_move = move
+                time.sleep(move.cool_down)
+            except Exception as e:
+                move.error = e
+            finally:
+                move._done.set()
+
+    def _run_timed(self, move):
+        if self.direction_pin is not None:
+            GPIO.output(self.direction_pin, move.direction)
+        # step against absolute deadlines so scheduling delays don't add up
+        deadline = time.perf_counter()
+        for step_time in move.profile:
+            GPIO.output(self.step_pin, GPIO.HIGH)
+            deadline += step_time
+            remaining = deadline - time.perf_counter()
+            if remaining > SPIN_TIME:
+                time.sleep(remaining - SPIN_TIME)
+            while time.perf_counter() < deadline:
+                pass
+            GPIO.output(self.step_pin, GPIO.LOW)
+
+    def _run_waveform(self, move):
+        pi = self._pi
+        step_gpio = BOARD_TO_BCM[self.step_pin]
+        if self.direction_pin is not None:
+            pi.write(BOARD_TO_BCM[self.direction_pin], move.direction)
+        for start in range(0, move.steps, MAX_WAVE_STEPS):
+            pulses = []
+            for step_time in move.profile[start : start + MAX_WAVE_STEPS]:
+                high_time = max(int(step_time * 1e6) - 10, 1)
+                pulses.append(pigpio.pulse(1 << step_gpio, 0, high_time))
+                pulses.append(pigpio.pulse(0, 1 << step_gpio, 10))
+            pi.wave_clear()
+            pi.wave_add_generic(pulses)
+            wave_id = pi.wave_create()
+            pi.wave_send_once(wave_id)
+            while pi.wave_tx_busy():
+                time.sleep(0.001)
+            pi.wave_delete(wave_id)
 
 
 def advance_stepper(degree):
@@ -110,6 +254,20 @@ def advance_stepper(degree):
         stepper.advance_degrees(degree)
 
 
+@lru_cache(maxsize=128)
+def step_profile(steps, max_speed, min_speed, ease_length):
+    """Time of each step in a move, eased in at the start and out at the end."""
+    half_steps = steps / 2
+    profile = []
+    for step in range(steps):
+        if step < half_steps:
+            x = (step + 1) / ease_length
+        else:
+            x = (steps - step) / ease_length
+        profile.append(exp_interp(max_speed, min_speed, x))
+    return tuple(profile)
+
+
 def exp_interp(a, b, x, power=1, flip=True):
     if x <= 0:
         if flip:
@@ -0,0 +1,88 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional
+import io
+import struct
+
+from PIL import Image
+
+from .settings import THUMBNAIL_SIZE
+
+THUMBNAILER: Optional[ThreadPoolExecutor] = None
+
+JPEG_SUFFIXES = [".jpg", ".jpeg"]
+RAF_MAGIC = b"FUJIFILMCCD-RAW"
+# RAF header fields holding the offset and length of the embedded JPEG
+RAF_JPEG_OFFSET = 84
+
+
+def get_thumbnail_path(local_path):
+    local_path = Path(local_path)
+    if local_path.suffix.lower() in JPEG_SUFFIXES:
+        name = local_path.name
+    else:
+        name = local_path.name + ".jpg"
+    return local_path.parent / ".thumbnails" / name
+
+
+def get_source_name(thumbnail_name):
+    """Name of the capture a thumbnail was made from."""
+    stem = Path(thumbnail_name).stem
+    if Path(stem).suffix:
+        return stem
+    return thumbnail_name
+
+
+def can_thumbnail(local_path):
+    return Path(local_path).suffix.lower() in JPEG_SUFFIXES or is_raf(local_path)
+
+
+def is_raf(local_path):
+    return Path(local_path).suffix.lower() == ".raf"
+
+
+def read_raf_embedded_jpeg(local_path):
+    """Read only the embedded JPEG preview out of a Fuji RAF."""
+    with open(local_path, "rb") as f:
+        header = f.read(RAF_JPEG_OFFSET + 8)
+        if not header.startswith(RAF_MAGIC):
+            raise ValueError(f"{local_path} is not a RAF file")
+        offset, length = struct.unpack(">II", header[RAF_JPEG_OFFSET:])
+        f.seek(offset)
+        return f.read(length)
+
+
+def save_thumbnail(image_file, thumbnail_path):
+    im = Image.open(image_file)
+    # let the JPEG decoder scale down while decoding instead of decoding full size
+    im.draft("RGB", THUMBNAIL_SIZE)
+    im.thumbnail(THUMBNAIL_SIZE)
+    thumbnail_path = Path(thumbnail_path)
+    thumbnail_path.parent.mkdir(exist_ok=True, parents=True)
+    im.convert("RGB").save(thumbnail_path, "JPEG")
+    print("Thumbnail saved as:", thumbnail_path.as_posix())
+    return thumbnail_path.as_posix()
+
+
+def make_thumbnail(local_path):
+    thumbnail_path = get_thumbnail_path(local_path)
+    if is_raf(local_path):
+        return save_thumbnail(
+            io.BytesIO(read_raf_embedded_jpeg(local_path)), thumbnail_path
+        )
+    return save_thumbnail(local_path, thumbnail_path)
+
+
+def make_thumbnail_from_preview(local_path, preview_data):
+    """Make a thumbnail from the preview image the camera sent for a capture."""
+    return save_thumbnail(
+        io.BytesIO(bytes(preview_data)), get_thumbnail_path(local_path)
+    )
+
+
+def get_thumbnailer():
+    global THUMBNAILER
+
+    if THUMBNAILER is None:
+        THUMBNAILER = ThreadPoolExecutor(max_workers=1, thread_name_prefix="thumbnail")
+    return THUMBNAILER
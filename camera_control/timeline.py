@@ -0,0 +1,164 @@
+"""Record where the time goes during a capture session.
+
+Every phase of a position (focus and other setting changes, triggers,
+downloads, saves, camera deletes, thumbnails, turntable moves, settling,
+polarizer turns and uploads) is written as a span to
+``<session>/.timeline.jsonl``, one JSON object per line:
+
+    {"name": "file_get", "start": 1718000000.12, "duration": 0.84,
+     "thread": "Thread-3", "position": 12, "bracket": 2}
+
+Downloads and uploads run on their own threads, so spans overlap and the
+summary reports busy time per phase next to the session's wall time. The
+file can be exported in Chrome's trace event format and opened in
+chrome://tracing or Perfetto.
+"""
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Optional
+import json
+import threading
+import time
+
+TIMELINE_NAME = ".timeline.jsonl"
+
+TIMELINES: Dict[str, "Timeline"] = {}
+TIMELINES_LOCK = threading.Lock()
+
+
+class Timeline(object):
+    def __init__(self, path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name, **tags):
+        start = time.time()
+        begin = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.monotonic() - begin, **tags)
+
+    def record(self, name, start, duration, **tags):
+        """Add a span that was timed elsewhere, ``start`` is a unix time."""
+        event = {
+            "name": name,
+            "start": start,
+            "duration": duration,
+            "thread": threading.current_thread().name,
+        }
+        event.update((key, value) for key, value in tags.items() if value is not None)
+        line = json.dumps(event) + "\n"
+        with self._lock:
+            self.path.parent.mkdir(exist_ok=True, parents=True)
+            with open(self.path, "a") as f:
+                f.write(line)
+
+    def events(self):
+        return read_events(self.path)
+
+
+def open_timeline(capture_root_dir, session):
+    """Start recording a session, later spans for it go to the same file."""
+    timeline = Timeline(timeline_path(capture_root_dir, session))
+    with TIMELINES_LOCK:
+        TIMELINES[session] = timeline
+    return timeline
+
+
+def get_timeline(session) -> Optional[Timeline]:
+    """The timeline of a session this process is recording, if any."""
+    with TIMELINES_LOCK:
+        return TIMELINES.get(session)
+
+
+@contextmanager
+def span(timeline, name, **tags):
+    """``timeline.span`` that does nothing without a timeline."""
+    if timeline is None:
+        yield
+    else:
+        with timeline.span(name, **tags):
+            yield
+
+
+def timeline_path(capture_root_dir, session):
+    return Path(capture_root_dir).expanduser() / session / TIMELINE_NAME
+
+
+def read_events(path):
+    events = []
+    if not Path(path).exists():
+        return events
+    with open(path) as f:
+        for line in f:
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                # a line cut short by a crash
+                continue
+    return events
+
+
+def summarize(events):
+    """Busy seconds per phase and how much of the session's wall time they cover."""
+    if not events:
+        return {"wall_seconds": 0.0, "positions": 0, "phases": []}
+    start = min(event["start"] for event in events)
+    end = max(event["start"] + event["duration"] for event in events)
+    wall = end - start
+    phases = {}
+    for event in events:
+        phase = phases.setdefault(
+            event["name"],
+            {"name": event["name"], "count": 0, "seconds": 0.0, "max": 0.0},
+        )
+        phase["count"] += 1
+        phase["seconds"] += event["duration"]
+        phase["max"] = max(phase["max"], event["duration"])
+    for phase in phases.values():
+        phase["mean"] = phase["seconds"] / phase["count"]
+        phase["share"] = phase["seconds"] / wall if wall else 0.0
+    return {
+        "wall_seconds": wall,
+        "positions": len({e["position"] for e in events if "position" in e}),
+        "phases": sorted(phases.values(), key=lambda p: p["seconds"], reverse=True),
+    }
+
+
+def to_chrome_trace(events):
+    """Chrome trace event format, one track per thread."""
+    threads = {}
+    trace_events = []
+    for event in events:
+        thread = event.get("thread", "main")
+        if thread not in threads:
+            threads[thread] = len(threads) + 1
+            trace_events.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": 1,
+                    "tid": threads[thread],
+                    "args": {"name": thread},
+                }
+            )
+        args = {
+            key: value
+            for key, value in event.items()
+            if key not in ("name", "start", "duration", "thread")
+        }
+        trace_events.append(
+            {
+                "name": event["name"],
+                "cat": "capture",
+                "ph": "X",
+                "ts": event["start"] * 1e6,
+                "dur": event["duration"] * 1e6,
+                "pid": 1,
+                "tid": threads[thread],
+                "args": args,
+            }
+        )
+    return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
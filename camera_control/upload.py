@@ -0,0 +1,473 @@
+from collections import deque
+from pathlib import Path
+from typing import Optional
+import atexit
+import hashlib
+import json
+import mimetypes
+import os
+import threading
+import time
+import uuid
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .settings import (
+    POST_PROCESS_URL,
+    PROCESSING_JOBS_URL,
+    PROCESSING_STATUS_URL,
+    UPLOAD_BACKOFF,
+    UPLOAD_CONCURRENCY,
+    UPLOAD_PAUSE_QUEUE_DEPTH,
+    UPLOAD_RESUME_QUEUE_DEPTH,
+    UPLOAD_RETRIES,
+)
+from .spool import UploadSpool
+from .events import publish
+from .timeline import get_timeline, span
+
+UPLOADER: Optional["Uploader"] = None
+
+READ_CHUNK_SIZE = 1024 * 1024
+# Window used for the reported upload throughput, in seconds
+THROUGHPUT_WINDOW = 10.0
+# How often to ask a busy server for its queue depth, in seconds
+SERVER_STATUS_POLL_INTERVAL = 5.0
+# How often to fetch focus stats for the sessions being captured, in seconds
+FOCUS_STATS_POLL_INTERVAL = 5.0
+
+
+class UploadError(Exception):
+    pass
+
+
+class MultipartStream(object):
+    """multipart/form-data body that reads files from disk as it is sent.
+
+    The total length is known up front so the request goes out with a
+    Content-Length instead of being buffered or chunked. ``on_read`` is
+    called with the number of bytes handed to the connection. Files are
+    hashed as they are read so the upload can be checked against the
+    hashes the server reports.
+    """
+
+    def __init__(self, fields, file_paths, on_read=None):
+        self.boundary = uuid.uuid4().hex
+        self.on_read = on_read
+        self._parts = []
+        for name, (filename, content, content_type) in fields:
+            self._add_part(name, filename, content_type, content.encode("utf-8"))
+        for file_path in file_paths:
+            content_type = (
+                mimetypes.guess_type(file_path)[0] or "application/octet-stream"
+            )
+            self._add_part("files", Path(file_path).name, content_type, file_path)
+        self._parts.append(f"--{self.boundary}--\r\n".encode("utf-8"))
+        self._length = sum(
+            len(part) if isinstance(part, bytes) else os.path.getsize(part)
+            for part in self._parts
+        )
+        self._current = None
+        self._current_hash = None
+        self._buffer = b""
+        self.hashes = {}
+
+    @property
+    def content_type(self):
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self):
+        return self._length
+
+    def _add_part(self, name, filename, content_type, content):
+        header = (
+            f"--{self.boundary}\r\n"
+            f'Content-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+            f"Content-Type: {content_type}\r\n\r\n"
+        )
+        self._parts.append(header.encode("utf-8"))
+        self._parts.append(content)
+        self._parts.append(b"\r\n")
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = READ_CHUNK_SIZE
+        chunks = []
+        remaining = size
+        while remaining > 0:
+            if self._buffer:
+                chunk = self._buffer[:remaining]
+                self._buffer = self._buffer[remaining:]
+            elif self._current is not None:
+                chunk = self._current.read(remaining)
+                if not chunk:
+                    self._current.close()
+                    self._current = None
+                    continue
+                self._current_hash.update(chunk)
+            elif self._parts:
+                part = self._parts.pop(0)
+                if isinstance(part, bytes):
+                    self._buffer = part
+                else:
+                    self._current = open(part, "rb")
+                    self._current_hash = hashlib.sha256()
+                    self.hashes[Path(part).name] = self._current_hash
+                continue
+            else:
+                break
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        data = b"".join(chunks)
+        if self.on_read and data:
+            self.on_read(len(data))
+        return data
+
+    def verify(self, received):
+        """Raise if the server's sha256 of a file differs from what was sent."""
+        for name, digest in (received or {}).items():
+            sent = self.hashes.get(name)
+            if sent is not None and sent.hexdigest() != digest:
+                raise UploadError(f"{name} was corrupted in transit")
+
+    def close(self):
+        if self._current is not None:
+            self._current.close()
+            self._current = None
+
+
+class Uploader(object):
+    """Upload captured positions to the processing server.
+
+    Positions are written to an ``UploadSpool`` first and a bounded set of
+    upload threads work through it, sharing a pooled keep-alive
+    ``requests.Session``. Positions captured earlier upload while the
+    turntable keeps capturing, and anything left over after a crash is
+    picked up again on startup. Failed uploads are retried with exponential
+    backoff.
+
+    The server reports its queue depth with every response. Above
+    ``resume_queue_depth`` only one upload runs at a time and at
+    ``pause_queue_depth`` uploads stop until the server has caught up.
+
+    Focus stats for the sessions being captured are fetched on a thread of
+    their own, so the capture never waits on the server for them.
+    """
+
+    def __init__(
+        self,
+        url=POST_PROCESS_URL,
+        max_workers=UPLOAD_CONCURRENCY,
+        retries=UPLOAD_RETRIES,
+        backoff=UPLOAD_BACKOFF,
+        spool=None,
+        status_url=PROCESSING_STATUS_URL,
+        pause_queue_depth=UPLOAD_PAUSE_QUEUE_DEPTH,
+        resume_queue_depth=UPLOAD_RESUME_QUEUE_DEPTH,
+        jobs_url=PROCESSING_JOBS_URL,
+    ):
+        self.url = url
+        self.status_url = status_url
+        self.jobs_url = jobs_url
+        self.retries = retries
+        self.backoff = backoff
+        self.pause_queue_depth = pause_queue_depth
+        self.resume_queue_depth = resume_queue_depth
+        self.spool = spool or UploadSpool()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._lock = threading.Lock()
+        self._throttle = threading.Lock()
+        self._wake = threading.Event()
+        self._stop_event = threading.Event()
+        self._running = 0
+        self._bytes_sent = 0
+        self._samples = deque()
+        self._server_queue_depth = None
+        self._paused = False
+        # job name: last {position: {bracket: share}} the server reported
+        self._focus_stats = {}
+        self._threads = [
+            threading.Thread(target=self._upload_loop, name=f"upload-{i}", daemon=True)
+            for i in range(max_workers)
+        ]
+        self._threads.append(
+            threading.Thread(
+                target=self._focus_stats_loop, name="focus-stats", daemon=True
+            )
+        )
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, job_name, file_paths, options=None, tags=None, priority=None):
+        """Spool a position for upload and return its spool entry id.
+
+        ``options`` are per stage keyword arguments for the processing
+        server, e.g. ``{"focus_stack": {"focus_measure": "tenengrad"}}``.
+        ``tags`` (position, ...) label the upload in the session's timeline.
+        ``priority`` is ``interactive``, ``preview`` or ``batch`` (the
+        server's default), how urgently the server should process it.
+        """
+        entry_id = self.spool.add(
+            job_name, file_paths, options=options, tags=tags, priority=priority
+        )
+        self._wake.set()
+        self._publish_progress()
+        return entry_id
+
+    def upload(self, job_name, file_paths, delete_on_success=True, url=None):
+        """Upload files for a job, retrying with backoff. Returns the response."""
+        attempt = 0
+        while True:
+            try:
+                response = self._post(job_name, file_paths, url=url)
+                if response.status_code < 500:
+                    break
+                error = UploadError(f"Server responded {response.status_code}")
+            except (requests.RequestException, UploadError) as e:
+                error = e
+            attempt += 1
+            if attempt > self.retries:
+                raise UploadError(f"Upload of {job_name} failed: {error}")
+            delay = self.retry_delay(attempt)
+            print(f"Upload of {job_name} failed ({error}), retrying in {delay}s")
+            time.sleep(delay)
+
+        if response.status_code == 200 and delete_on_success:
+            for file_path in file_paths:
+                Path(file_path).unlink()
+        return response
+
+    def focus_stats(self, job_name):
+        """Per position share of the focus mask each bracket won on the server.
+
+        Returns what was last fetched without waiting. The first call starts
+        fetching for the job in the background, until ``stop_focus_stats``.
+        """
+        with self._lock:
+            return dict(self._focus_stats.setdefault(job_name, {}))
+
+    def stop_focus_stats(self, job_name):
+        with self._lock:
+            self._focus_stats.pop(job_name, None)
+
+    def retry_delay(self, attempt):
+        return self.backoff * (2 ** (attempt - 1))
+
+    def progress(self):
+        pending = self.spool.pending_count()
+        with self._lock:
+            return {
+                "running": bool(self._running or pending),
+                "pending_jobs": pending,
+                "bytes_sent": self._bytes_sent,
+                "bytes_per_second": self._throughput(),
+                "paused": self._paused,
+                "server_queue_depth": self._server_queue_depth,
+            }
+
+    def shutdown(self, wait=True):
+        self._stop_event.set()
+        self._wake.set()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+        self.session.close()
+
+    def _upload_loop(self):
+        while not self._stop_event.is_set():
+            self._wait_for_server()
+            entry = self.spool.claim()
+            if entry is None:
+                self._wake.wait(timeout=1.0)
+                self._wake.clear()
+                continue
+            with self._lock:
+                self._running += 1
+            self._publish_progress()
+            try:
+                self._upload_entry(entry)
+            except Exception as e:
+                print(f"Upload of {entry['job_name']} failed: {e}")
+                self.spool.release(entry["id"], retry_after=self.retry_delay(1))
+            finally:
+                with self._lock:
+                    self._running -= 1
+                self._publish_progress()
+
+    def _upload_entry(self, entry):
+        missing = [path for path in entry["files"] if not Path(path).exists()]
+        if missing:
+            print(f"Dropping upload of {entry['job_name']}, missing {missing}")
+            self.spool.remove(entry["id"])
+            return
+        throttled = self._slow_down()
+        if throttled:
+            self._throttle.acquire()
+        tags = {
+            key: value
+            for key, value in (entry.get("tags") or {}).items()
+            if key != "session"
+        }
+        try:
+            with span(
+                get_timeline(entry["job_name"]),
+                "upload",
+                files=len(entry["files"]),
+                queued=time.time() - entry["created"],
+                **tags,
+            ):
+                response = self._post(
+                    entry["job_name"],
+                    entry["files"],
+                    options=entry.get("options"),
+                    priority=entry.get("priority"),
+                )
+        except (requests.RequestException, UploadError) as e:
+            response = None
+            error = e
+        finally:
+            if throttled:
+                self._throttle.release()
+        if response is not None and response.status_code < 500:
+            self.spool.remove(entry["id"])
+            if response.status_code == 200:
+                for file_path in entry["files"]:
+                    Path(file_path).unlink()
+            else:
+                print(f"Upload of {entry['job_name']} rejected: {response.status_code}")
+            return
+        if response is not None:
+            error = UploadError(f"Server responded {response.status_code}")
+        attempt = min(entry["attempts"] + 1, self.retries)
+        delay = self.retry_delay(attempt)
+        print(f"Upload of {entry['job_name']} failed ({error}), retrying in {delay}s")
+        self.spool.release(entry["id"], retry_after=delay)
+
+    def _post(self, job_name, file_paths, url=None, options=None, priority=None):
+        data = {"job_name": job_name}
+        if options:
+            data["options"] = options
+        if priority:
+            data["priority"] = priority
+        fields = [("data", ("data", json.dumps(data), "application/json"))]
+        body = MultipartStream(fields, file_paths, on_read=self._record_bytes)
+        try:
+            print(f"Uploading {len(file_paths)} files for {job_name}")
+            start = time.monotonic()
+            response = self.session.post(
+                url or self.url, data=body, headers={"Content-Type": body.content_type}
+            )
+        finally:
+            body.close()
+        elapsed = time.monotonic() - start
+        print(
+            f"Uploaded {len(body) / 1e6:.1f}MB for {job_name} in {elapsed:.1f}s "
+            f"({len(body) / 1e6 / (elapsed or 1):.1f}MB/s)"
+        )
+        self._record_server_status(response)
+        if response.status_code == 200:
+            try:
+                received = response.json().get("files")
+            except ValueError:
+                received = None
+            body.verify(received)
+        return response
+
+    def _slow_down(self):
+        depth = self._server_queue_depth
+        return depth is not None and depth >= self.resume_queue_depth
+
+    def _wait_for_server(self):
+        while not self._stop_event.is_set():
+            depth = self._server_queue_depth
+            if depth is None:
+                break
+            if self._paused and depth < self.resume_queue_depth:
+                print(f"Processing server queue at {depth}, resuming uploads")
+                self._paused = False
+                self._publish_progress()
+            elif not self._paused and depth >= self.pause_queue_depth:
+                print(f"Processing server queue at {depth}, pausing uploads")
+                self._paused = True
+                self._publish_progress()
+            if not self._paused:
+                break
+            self._stop_event.wait(SERVER_STATUS_POLL_INTERVAL)
+            self._poll_server_status()
+
+    def _focus_stats_loop(self):
+        while not self._stop_event.wait(FOCUS_STATS_POLL_INTERVAL):
+            with self._lock:
+                job_names = list(self._focus_stats)
+            for job_name in job_names:
+                positions = self._fetch_focus_stats(job_name)
+                if positions is None:
+                    continue
+                with self._lock:
+                    if job_name in self._focus_stats:
+                        self._focus_stats[job_name] = positions
+
+    def _fetch_focus_stats(self, job_name):
+        try:
+            response = self.session.get(
+                f"{self.jobs_url}/{job_name}/focus_stats", timeout=5
+            )
+            response.raise_for_status()
+            return response.json().get("positions", {})
+        except (requests.RequestException, ValueError) as e:
+            print(f"Could not get focus stats for {job_name}: {e}")
+            return None
+
+    def _publish_progress(self):
+        publish("upload-queue", dict(self.progress(), spool=self.spool.status()))
+
+    def _poll_server_status(self):
+        try:
+            response = self.session.get(self.status_url, timeout=5)
+        except requests.RequestException as e:
+            print(f"Could not reach processing server: {e}")
+            return
+        self._record_server_status(response)
+
+    def _record_server_status(self, response):
+        try:
+            self._server_queue_depth = response.json().get("queue_depth")
+        except ValueError:
+            pass
+
+    def _record_bytes(self, count):
+        now = time.monotonic()
+        with self._lock:
+            self._bytes_sent += count
+            self._samples.append((now, count))
+            while self._samples and now - self._samples[0][0] > THROUGHPUT_WINDOW:
+                self._samples.popleft()
+
+    def _throughput(self):
+        now = time.monotonic()
+        while self._samples and now - self._samples[0][0] > THROUGHPUT_WINDOW:
+            self._samples.popleft()
+        if not self._samples:
+            return 0.0
+        return sum(count for _, count in self._samples) / THROUGHPUT_WINDOW
+
+
+def get_uploader():
+    global UPLOADER
+
+    if UPLOADER is None:
+        UPLOADER = Uploader()
+    return UPLOADER
+
+
+@atexit.register
+def cleanup_uploader():
+    global UPLOADER
+
+    if UPLOADER:
+        UPLOADER.shutdown()
+        UPLOADER = None
@@ -1,7 +1,41 @@
+import os
+
+HOST = os.getenv("SERVER_HOST") or "0.0.0.0"
+PORT = int(os.getenv("SERVER_PORT") or 5000)
+# Uploads from several rigs are handled at once, one thread each
+SERVER_THREADS = int(os.getenv("SERVER_THREADS") or 8)
+
+
 def start_server():
-    from .app import app
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        from .app import app
+
+        app.run(host=HOST, port=PORT, threaded=True)
+        return
+
+    class Server(BaseApplication):
+        """gunicorn hands the request body to the app as it arrives off the
+        socket, so uploads stream to disk without being buffered first.
+
+        A single worker process keeps one ``WorkerPool`` for the server.
+        """
+
+        def load_config(self):
+            self.cfg.set("bind", f"{HOST}:{PORT}")
+            self.cfg.set("workers", 1)
+            self.cfg.set("worker_class", "gthread")
+            self.cfg.set("threads", SERVER_THREADS)
+            # a 50MB RAF over wifi can take a while
+            self.cfg.set("timeout", 300)
+
+        def load(self):
+            from .app import app
+
+            return app
 
-    app.run(host="0.0.0.0", port=5000)
+    Server().run()
 
 
 start_server()
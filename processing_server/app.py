@@ -5,36 +5,124 @@ from flask import (
     request,
     jsonify,
 )
-from werkzeug.utils import secure_filename
-
+from .ingest import UploadIngest
+from .scheduler import get_priority
+from .storage import UPLOAD_ROOT, StorageManager
 from .worker import WorkerPool
 from .logging_utils import logger
 
 app = Flask(__name__)
 
-app.config["UPLOAD_FOLDER"] = "/uploads"
+app.config["UPLOAD_FOLDER"] = UPLOAD_ROOT
 
 WORKER_POOL = WorkerPool()
 WORKER_POOL.start()
+STORAGE = StorageManager(active_jobs=WORKER_POOL.scheduler.job_names)
+STORAGE.start()
 
 
 @app.route("/upload", methods=["POST", "GET"])
 def create_capture():
-    data = json.load(request.files["data"])
-    job_name = data.get("job_name", "default_job")
-    post_processes = data.get("post_processes")
-    logger.info(f"Received upload request for {job_name}")
-    files = request.files.getlist("files")
-    local_paths = []
-    for file in files:
-        if not file.filename == "":
-            filename = secure_filename(file.filename)
-            file_path = Path(app.config["UPLOAD_FOLDER"], job_name, "source", filename)
-            file_path.parent.mkdir(exist_ok=True, parents=True)
-            file.save(file_path)
-            local_paths.append(file_path.as_posix())
-
-    WORKER_POOL.add_to_pool(
-        {"job_name": job_name, "post_processes": post_processes, "files": local_paths}
+    ingest = UploadIngest(app.config["UPLOAD_FOLDER"])
+    try:
+        ingest.parse(request.environ)
+        priority = get_priority(ingest.data.get("priority"))
+        local_paths, hashes = ingest.save()
+    except ValueError as e:
+        ingest.discard()
+        return jsonify({"error": str(e)}), 400
+    except Exception:
+        ingest.discard()
+        raise
+    job_name = ingest.job_name
+    post_processes = ingest.data.get("post_processes")
+    options = ingest.data.get("options") or {}
+    logger.info(f"Received {len(local_paths)} {priority} files for {job_name}")
+
+    job_id, superseded = WORKER_POOL.add_to_pool(
+        {
+            "job_name": job_name,
+            "post_processes": post_processes,
+            "options": options,
+            "priority": priority,
+            "files": local_paths,
+        }
+    )
+    return jsonify(
+        {
+            "job_id": job_id,
+            "superseded": superseded,
+            "queue_depth": WORKER_POOL.queue_depth(),
+            "files": hashes,
+        }
+    )
+
+
+@app.route("/jobs/<job_name>/focus_stats")
+def focus_stats(job_name):
+    """Share of the focus mask each bracket won, for every stacked position."""
+    positions = {}
+    stats_root = Path(app.config["UPLOAD_FOLDER"], job_name, "focus_stats")
+    if stats_root.exists():
+        for stats_file in sorted(stats_root.glob("*.json")):
+            try:
+                with open(stats_file) as f:
+                    stats = json.load(f)
+            except ValueError:
+                # still being written
+                continue
+            positions[stats["position"]] = stats["brackets"]
+    return jsonify({"job_name": job_name, "positions": positions})
+
+
+@app.route("/status")
+def status():
+    return jsonify(
+        {
+            "queue_depth": WORKER_POOL.queue_depth(),
+            "worker_count": WORKER_POOL.worker_count,
+            "ready": WORKER_POOL.is_ready(),
+            **WORKER_POOL.scheduler.status(),
+        }
+    )
+
+
+@app.route("/jobs")
+def jobs():
+    """Jobs with stages left to run, in the order they were received."""
+    return jsonify({"jobs": WORKER_POOL.scheduler.jobs()})
+
+
+@app.route("/jobs/<job_id>/cancel", methods=["POST"])
+def cancel_job(job_id):
+    """Drop a queued job, or stop a running one at the end of its stage."""
+    job = WORKER_POOL.cancel(job_id)
+    if job is None:
+        return jsonify({"error": f"No queued or running job {job_id}"}), 404
+    return jsonify(job.status())
+
+
+@app.route("/storage")
+def storage():
+    """Disk use per root and storage class as of the last collection."""
+    return jsonify(STORAGE.usage() or {})
+
+
+@app.route("/storage/collect", methods=["POST"])
+def collect_storage():
+    """Apply the retention policy and quotas now instead of waiting."""
+    return jsonify(STORAGE.collect())
+
+
+@app.route("/ready")
+def ready():
+    """200 once every worker has warmed up, 503 until then."""
+    is_ready = WORKER_POOL.is_ready()
+    response = jsonify(
+        {
+            "ready": is_ready,
+            "workers_ready": WORKER_POOL.ready_count(),
+            "worker_count": WORKER_POOL.worker_count,
+        }
     )
-    return jsonify({})
+    return response, 200 if is_ready else 503
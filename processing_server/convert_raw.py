@@ -1,10 +1,14 @@
 from pathlib import Path
+import atexit
 import exiftool
 import rawpy
 import lensfunpy
 import cv2
 import numpy as np
 
+from .storage import output_dir
+from .writer import get_writer
+
 try:
     from .logging_utils import logger
 except ImportError:
@@ -12,6 +16,9 @@ except ImportError:
 
     logger = logging.getLogger()
 
+LENS_DATABASE = None
+EXIFTOOL = None
+
 
 def is_raw(file_path):
     raw_types = [
@@ -65,9 +72,41 @@ def is_raw(file_path):
     return False
 
 
-def convert_raw_image(image_path, output_path):
-    with exiftool.ExifToolHelper() as et:
-        metadata = et.get_metadata(image_path)[0]
+def get_lens_database():
+    global LENS_DATABASE
+
+    if LENS_DATABASE is None:
+        LENS_DATABASE = lensfunpy.Database()
+    return LENS_DATABASE
+
+
+def get_exiftool():
+    """ExifTool process kept running between images instead of one per image."""
+    global EXIFTOOL
+
+    if EXIFTOOL is None or not EXIFTOOL.running:
+        EXIFTOOL = exiftool.ExifToolHelper()
+        EXIFTOOL.run()
+    return EXIFTOOL
+
+
+@atexit.register
+def cleanup_exiftool():
+    global EXIFTOOL
+
+    if EXIFTOOL is not None and EXIFTOOL.running:
+        EXIFTOOL.terminate()
+    EXIFTOOL = None
+
+
+def warm_up():
+    get_lens_database()
+    get_exiftool()
+
+
+def convert_raw_image(image_path, output_path, encoder=None):
+    """Convert a raw file, returns the path the image is being written to."""
+    metadata = get_exiftool().get_metadata(image_path)[0]
     logger.info(f"Metadata loaded for {image_path}")
     with rawpy.imread(image_path) as raw:
         logger.info(f"Image loaded for {image_path}")
@@ -85,12 +124,12 @@ def convert_raw_image(image_path, output_path):
         # rgb_image = rgb_image.astype("float32")
         # output_path = Path(output_path).with_suffix(".exr")
         bgr_image = cv2.cvtColor(rgb_image, code=cv2.COLOR_RGB2BGR)
-        cv2.imwrite(output_path, bgr_image, [cv2.IMWRITE_PNG_COMPRESSION, 5])
-        logger.info(f"Image written to {output_path}")
+        # encoded in the background, later stages read it from memory
+        return get_writer().submit(output_path, bgr_image, "intermediate", encoder)
 
 
 def get_cam(metadata):
-    db = lensfunpy.Database()
+    db = get_lens_database()
     cam = db.find_cameras(get_camera_make(metadata), get_camera_model(metadata))
     if not len(cam):
         raise Exception("No valid camera models found!")
@@ -98,7 +137,7 @@ def get_cam(metadata):
 
 
 def get_lens(metadata, cam):
-    db = lensfunpy.Database()
+    db = get_lens_database()
     lens = db.find_lenses(cam, get_lens_make(metadata), get_lens_model(metadata))
     if not len(lens):
         raise Exception("No valid lens models found!")
@@ -152,18 +191,16 @@ def get_focus_distance(metadata):
     return metadata["Composite:HyperfocalDistance"]
 
 
-def convert_raw(files):
+def convert_raw(files, encoder=None):
     converted_files = []
 
     for file in files:
         if is_raw(file):
-            output_path = (
-                Path(file).parent.parent / "convert_raw" / (Path(file).stem + ".png")
-            )
+            output_path = output_dir(file, "convert_raw") / (Path(file).stem + ".png")
             logger.info(f"Converting raw image {file} to {output_path}")
-            output_path.parent.mkdir(exist_ok=True, parents=True)
-            convert_raw_image(file, output_path.as_posix())
-            converted_files.append(output_path.as_posix())
+            converted_files.append(
+                convert_raw_image(file, output_path.as_posix(), encoder)
+            )
         else:
             converted_files.append(file)
     return converted_files
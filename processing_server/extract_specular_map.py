@@ -1,5 +1,11 @@
 from pathlib import Path
 import cv2
+import numpy as np
+
+from .prefetch import PREFETCH_DEPTH, ImagePrefetcher
+from .roi import read_roi
+from .storage import job_root, output_dir, position_name
+from .writer import get_writer
 
 
 def sort_files(files):
@@ -16,35 +22,44 @@ def sort_files(files):
     return diffuse, spec
 
 
-def extract_specular_from_images(diffuse_image, combined_image, output_path):
-    diffuse = cv2.imread(diffuse_image)
-    combined = cv2.imread(combined_image)
-
-    spec = cv2.subtract(combined, diffuse)
-
-    spec_gray = cv2.cvtColor(spec, cv2.COLOR_BGR2GRAY)
+def specular_map(diffuse, combined, roi=None):
+    if roi is not None and diffuse.shape[:2] != (roi.height, roi.width):
+        # full frames, nothing outside the object has any specular to find
+        spec_gray = np.zeros(diffuse.shape[:2], dtype=diffuse.dtype)
+        spec = cv2.subtract(roi.crop(combined), roi.crop(diffuse))
+        spec_gray = roi.paste(spec_gray, cv2.cvtColor(spec, cv2.COLOR_BGR2GRAY))
+    else:
+        spec = cv2.subtract(combined, diffuse)
+        spec_gray = cv2.cvtColor(spec, cv2.COLOR_BGR2GRAY)
+    return spec_gray
 
-    cv2.imwrite(output_path, spec_gray)
 
-
-def extract_specular(files):
+def extract_specular(files, encoder=None):
     diffuse, spec = sort_files(files)
 
     if not spec:
         return files
-    output_root_path = Path(files[0]).parent.parent / "extract_specular"
+    output_root_path = output_dir(files[0], "extract_specular")
     output_root_path.mkdir(exist_ok=True, parents=True)
     processed_file_paths = []
-    for diffuse_file_path, specular_file_path in zip(diffuse, spec):
-        processed_file_paths.append(diffuse_file_path)
-        output_file_path = Path(
-            output_root_path, Path(specular_file_path).name
-        ).as_posix()
-
-        extract_specular_from_images(
-            diffuse_file_path, specular_file_path, output_file_path
-        )
-        processed_file_paths.append(output_file_path)
+    # each pair decodes while the one before it is subtracted
+    images = ImagePrefetcher(
+        [path for pair in zip(diffuse, spec) for path in pair],
+        depth=2 * PREFETCH_DEPTH,
+    )
+    with images:
+        for diffuse_file_path, specular_file_path in zip(diffuse, spec):
+            processed_file_paths.append(diffuse_file_path)
+            output_file_path = Path(
+                output_root_path, Path(specular_file_path).name
+            ).as_posix()
+
+            name = position_name(diffuse_file_path)
+            roi = read_roi(job_root(diffuse_file_path), name)
+            spec_gray = specular_map(next(images), next(images), roi)
+            processed_file_paths.append(
+                get_writer().submit(output_file_path, spec_gray, "specular", encoder)
+            )
     return processed_file_paths
 
 
@@ -0,0 +1,96 @@
+"""Per pixel focus measures for focus stacking.
+
+Every measure takes a blurred 8 bit gray frame and writes a non-negative
+sharpness map straight into ``out``, a slice of the preallocated stack of
+maps. Absolute values are taken in place so no extra full frame copies are
+made, and maps are kept in float32 or int16 instead of float64, which is
+half or a quarter of the memory the stack used to take.
+"""
+import cv2
+import numpy as np
+
+DEFAULT_FOCUS_MEASURE = "log"
+DEFAULT_PRECISION = "float32"
+PRECISIONS = {
+    "float32": (np.float32, cv2.CV_32F),
+    "int16": (np.int16, cv2.CV_16S),
+}
+INT16_MAX = np.iinfo(np.int16).max
+
+
+def _int16_scale(precision, derivatives, ksize):
+    """Scale that keeps the summed 8 bit derivatives from saturating int16."""
+    if precision != "int16":
+        return 1.0
+    peak = 0
+    for dx, dy in derivatives:
+        kx, ky = cv2.getDerivKernels(dx, dy, ksize)
+        peak += 255 * np.abs(np.outer(ky, kx)).sum()
+    return min(1.0, INT16_MAX / peak)
+
+
+def abs_log(gray, out, precision, ksize=5):
+    """Absolute Laplacian of the (already Gaussian blurred) frame."""
+    _, ddepth = PRECISIONS[precision]
+    scale = _int16_scale(precision, [(2, 0), (0, 2)], ksize)
+    cv2.Laplacian(gray, ddepth, dst=out, ksize=ksize, scale=scale)
+    np.abs(out, out=out)
+    return out
+
+
+def tenengrad(gray, out, precision, ksize=3):
+    """Sobel gradient energy, gx² + gy² in float32 or |gx| + |gy| in int16."""
+    _, ddepth = PRECISIONS[precision]
+    scale = _int16_scale(precision, [(1, 0), (0, 1)], ksize)
+    cv2.Sobel(gray, ddepth, 1, 0, dst=out, ksize=ksize, scale=scale)
+    gy = cv2.Sobel(gray, ddepth, 0, 1, ksize=ksize, scale=scale)
+    if precision == "int16":
+        np.abs(out, out=out)
+        np.abs(gy, out=gy)
+    else:
+        np.multiply(out, out, out=out)
+        np.multiply(gy, gy, out=gy)
+    np.add(out, gy, out=out)
+    return out
+
+
+def local_variance(gray, out, precision, window=7):
+    """Variance of the gray level over a ``window`` square around each pixel.
+
+    Computed in float32, an 8 bit frame's variance is at most 127.5² so it
+    fits int16 without scaling.
+    """
+    gray = gray.astype(np.float32)
+    mean = cv2.boxFilter(gray, -1, (window, window))
+    np.multiply(gray, gray, out=gray)
+    variance = cv2.boxFilter(gray, -1, (window, window))
+    np.multiply(mean, mean, out=mean)
+    np.subtract(variance, mean, out=variance)
+    np.maximum(variance, 0, out=variance)
+    out[...] = variance
+    return out
+
+
+FOCUS_MEASURES = {
+    "log": abs_log,
+    "tenengrad": tenengrad,
+    "variance": local_variance,
+}
+
+
+def get_focus_measure(name):
+    try:
+        return FOCUS_MEASURES[name]
+    except KeyError:
+        raise ValueError(
+            f"Unknown focus measure {name}, expected one of {', '.join(FOCUS_MEASURES)}"
+        )
+
+
+def get_dtype(precision):
+    try:
+        return PRECISIONS[precision][0]
+    except KeyError:
+        raise ValueError(
+            f"Unknown precision {precision}, expected one of {', '.join(PRECISIONS)}"
+        )
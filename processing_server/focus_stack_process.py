@@ -5,12 +5,26 @@ http://stackoverflow.com/questions/15911783/what-are-some-common-focus-stacking-
 https://github.com/cmcguinness/focusstack
 
 """
+from itertools import chain
+import json
 import logging
 from pathlib import Path
-from typing import List, Tuple
+from typing import Iterable, Iterator, List, Optional, Tuple
 import numpy as np
 import cv2
 
+from .focus_measures import (
+    DEFAULT_FOCUS_MEASURE,
+    DEFAULT_PRECISION,
+    abs_log,
+    get_dtype,
+    get_focus_measure,
+)
+from .prefetch import ImagePrefetcher
+from .roi import ROI_OUTPUT, read_roi
+from .storage import job_root, output_dir
+from .writer import get_writer
+
 logger = logging.getLogger()
 
 DEBUG = False
@@ -19,35 +33,78 @@ DEBUG = False
 # SIFT generally produces better results, but it is not FOSS (OpenCV 4.X does not support it).
 USE_SIFT = True
 
+DETECTOR = None
+
+
+def get_detector():
+    """Feature detector, built once per process."""
+    global DETECTOR
+
+    if DETECTOR is None:
+        DETECTOR = cv2.xfeatures2d.SIFT_create() if USE_SIFT else cv2.ORB_create(1000)
+    return DETECTOR
+
+
+def warm_up():
+    get_detector()
+
 
 class FocusStacker(object):
     def __init__(
         self,
         laplacian_kernel_size: int = 5,
         gaussian_blur_kernel_size: int = 5,
+        focus_measure: str = DEFAULT_FOCUS_MEASURE,
+        precision: str = DEFAULT_PRECISION,
     ) -> None:
         """Focus stacking class.
         Args:
             laplacian_kernel_size: Size of the laplacian window. Must be odd.
-            gaussian_blur_kernel_size: How big of a kernel to use for the gaussian blur. Must be odd.
+            gaussian_blur_kernel_size: How big of a kernel to use for the gaussian
+                blur. Must be odd.
+            focus_measure: Sharpness measure, "log", "tenengrad" or "variance".
+            precision: Focus map type, "float32" or "int16".
         """
         self._laplacian_kernel_size = laplacian_kernel_size
         self._gaussian_blur_kernel_size = gaussian_blur_kernel_size
+        self._focus_measure = get_focus_measure(focus_measure)
+        self._precision = precision
+        self._dtype = get_dtype(precision)
 
     def focus_stack(
-        self, images: List[np.ndarray]
+        self, images: Iterable[np.ndarray], count: Optional[int] = None
     ) -> Tuple[np.ndarray, List[np.ndarray], np.ndarray]:
-        """Pipeline to focus stack a list of images."""
-        alignment_matrices = self._get_alignment_matrices(images)
-        images = self._align_images(images, alignment_matrices)
-        laplacian = self._compute_laplacian(images)
-        mask = self._find_focus_regions(laplacian)
-        focus_stacked = self._apply_focus_region(images, mask)
+        """Pipeline to focus stack images.
+
+        Each image is aligned and measured as it arrives, so ``images`` can
+        be an ``ImagePrefetcher`` decoding the next ones meanwhile. ``count``
+        is needed when ``images`` has no length.
+        """
+        count = len(images) if count is None else count
+        logger.info("aligning images and computing their focus measure")
+        reference = None
+        aligned_images = []
+        alignment_matrices = []
+        focus_maps = None
+        for i, image in enumerate(images):
+            if reference is None:
+                # image 0 is the "base" image, all the following are aligned to it
+                reference = self._find_features(image)
+            else:
+                alignment_matrix = self._find_alignment(reference, image)
+                alignment_matrices.append(alignment_matrix)
+                image = self._warp(image, alignment_matrix, i)
+            if focus_maps is None:
+                focus_maps = np.empty((count,) + image.shape[:2], dtype=self._dtype)
+            self._focus_map(image, focus_maps[i])
+            aligned_images.append(image)
+        mask = self._find_focus_regions(focus_maps)
+        focus_stacked = self._apply_focus_region(aligned_images, mask)
         return focus_stacked, alignment_matrices, mask
 
     def apply_focus_stacking(
         self,
-        images: List[np.ndarray],
+        images: Iterable[np.ndarray],
         alignment_matrices: List[np.ndarray],
         region_mask: np.ndarray,
     ):
@@ -57,119 +114,96 @@ class FocusStacker(object):
         return focus_stacked
 
     @staticmethod
-    def load_images(image_files: List[str]) -> List[np.ndarray]:
-        """Read the images into numpy arrays using OpenCV."""
+    def load_images(image_files: List[str]) -> ImagePrefetcher:
+        """Iterate over the decoded images, reading the next ones in the background."""
         logger.info("reading images")
-        return [cv2.imread(img) for img in image_files]
+        return ImagePrefetcher(image_files)
 
     @staticmethod
-    def _get_alignment_matrices(images: List[np.ndarray]) -> List[np.ndarray]:
-        """Align the images.  Changing the focus on a lens, even if the camera remains fixed,
-         causes a mild zooming on the images. We need to correct the images so they line up perfectly on top
-        of each other.
+    def _find_features(image: np.ndarray):
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        return get_detector().detectAndCompute(gray, None)
 
-        Args:
-            images: list of image data
-        """
-
-        def _find_homography(
-            _img1_key_points: np.ndarray, _image_2_kp: np.ndarray, _matches: List
-        ):
-            image_1_points = np.zeros((len(_matches), 1, 2), dtype=np.float32)
-            image_2_points = np.zeros((len(_matches), 1, 2), dtype=np.float32)
-
-            for j in range(0, len(_matches)):
-                image_1_points[j] = _img1_key_points[_matches[j].queryIdx].pt
-                image_2_points[j] = _image_2_kp[_matches[j].trainIdx].pt
-
-            homography, mask = cv2.findHomography(
-                image_1_points, image_2_points, cv2.RANSAC, ransacReprojThreshold=2.0
-            )
-
-            return homography
-
-        logger.info("aligning images")
-        aligned_imgs = []
+    @staticmethod
+    def _find_homography(
+        _img1_key_points: np.ndarray, _image_2_kp: np.ndarray, _matches: List
+    ):
+        image_1_points = np.zeros((len(_matches), 1, 2), dtype=np.float32)
+        image_2_points = np.zeros((len(_matches), 1, 2), dtype=np.float32)
 
-        detector = cv2.xfeatures2d.SIFT_create() if USE_SIFT else cv2.ORB_create(1000)
+        for j in range(0, len(_matches)):
+            image_1_points[j] = _img1_key_points[_matches[j].queryIdx].pt
+            image_2_points[j] = _image_2_kp[_matches[j].trainIdx].pt
 
-        # Assume that image 0 is the "base" image and align all the following images to it
-        aligned_imgs.append(images[0])
-        img0_gray = cv2.cvtColor(images[0], cv2.COLOR_BGR2GRAY)
-        img1_key_points, image1_desc = detector.detectAndCompute(img0_gray, None)
+        homography, mask = cv2.findHomography(
+            image_1_points, image_2_points, cv2.RANSAC, ransacReprojThreshold=2.0
+        )
 
-        alignment_matrices = []
+        return homography
+
+    @classmethod
+    def _find_alignment(cls, reference, image: np.ndarray) -> np.ndarray:
+        """Homography mapping ``image`` onto the reference image's features."""
+        img1_key_points, image1_desc = reference
+        img_i_key_points, image_i_desc = get_detector().detectAndCompute(image, None)
+
+        if USE_SIFT:
+            bf = cv2.BFMatcher()
+            # This returns the top two matches for each feature point (list of list)
+            pair_matches = bf.knnMatch(image_i_desc, image1_desc, k=2)
+            raw_matches = []
+            for m, n in pair_matches:
+                if m.distance < 0.7 * n.distance:
+                    raw_matches.append(m)
+        else:
+            bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
+            raw_matches = bf.match(image_i_desc, image1_desc)
 
-        for i in range(1, len(images)):
-            img_i_key_points, image_i_desc = detector.detectAndCompute(images[i], None)
-
-            if USE_SIFT:
-                bf = cv2.BFMatcher()
-                # This returns the top two matches for each feature point (list of list)
-                pair_matches = bf.knnMatch(image_i_desc, image1_desc, k=2)
-                raw_matches = []
-                for m, n in pair_matches:
-                    if m.distance < 0.7 * n.distance:
-                        raw_matches.append(m)
-            else:
-                bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
-                raw_matches = bf.match(image_i_desc, image1_desc)
+        sort_matches = sorted(raw_matches, key=lambda x: x.distance)
+        matches = sort_matches[0:128]
 
-            sort_matches = sorted(raw_matches, key=lambda x: x.distance)
-            matches = sort_matches[0:128]
+        return cls._find_homography(img_i_key_points, img1_key_points, matches)
 
-            homography_matrix = _find_homography(
-                img_i_key_points, img1_key_points, matches
-            )
-            alignment_matrices.append(homography_matrix)
-        return alignment_matrices
+    @staticmethod
+    def _warp(image: np.ndarray, alignment_matrix: np.ndarray, index: int = 0):
+        aligned_img = cv2.warpPerspective(
+            image,
+            alignment_matrix,
+            (image.shape[1], image.shape[0]),
+            flags=cv2.INTER_LINEAR,
+        )
+        if DEBUG:
+            # If you find that there's a large amount of ghosting,
+            # it may be because one or more of the input images gets misaligned.
+            cv2.imwrite(f"aligned_{index}.png", aligned_img)
+        return aligned_img
 
     def _align_images(
-        self, images: List[np.ndarray], alignment_matrices: List[np.ndarray]
-    ):
-        aligned_imgs = []
-        i = 0
-        for image, alignement_matrix in zip(images, alignment_matrices):
-            aligned_img = cv2.warpPerspective(
-                image,
-                alignement_matrix,
-                (image.shape[1], image.shape[0]),
-                flags=cv2.INTER_LINEAR,
-            )
-
-            aligned_imgs.append(aligned_img)
-            if DEBUG:
-                # If you find that there's a large amount of ghosting,
-                # it may be because one or more of the input images gets misaligned.
-                cv2.imwrite(f"aligned_{i}.png", aligned_img)
-            i += 1
-        return aligned_imgs
-
-    def _compute_laplacian(
-        self,
-        images: List[np.ndarray],
-    ) -> np.ndarray:
-        """Gaussian blur and compute the gradient map of the image. This is proxy for finding the focus regions.
-
-        Args:
-            images: image data
-        """
-        logger.info("Computing the laplacian of the blurred images")
-        laplacians = []
-        for image in images:
-            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-            blurred = cv2.GaussianBlur(
-                gray,
-                (self._gaussian_blur_kernel_size, self._gaussian_blur_kernel_size),
-                0,
-            )
-            laplacian_gradient = cv2.Laplacian(
-                blurred, cv2.CV_64F, ksize=self._laplacian_kernel_size
-            )
-            laplacians.append(laplacian_gradient)
-        laplacians = np.asarray(laplacians)
-        logger.debug(f"Shape of array of laplacian gradient: {laplacians.shape}")
-        return laplacians
+        self, images: Iterable[np.ndarray], alignment_matrices: List[np.ndarray]
+    ) -> Iterator[np.ndarray]:
+        """Yield the images aligned to the first, which is already in place."""
+        images = iter(images)
+        first = next(images, None)
+        if first is None:
+            return
+        yield first
+        for i, (image, alignment_matrix) in enumerate(
+            zip(images, alignment_matrices), 1
+        ):
+            yield self._warp(image, alignment_matrix, i)
+
+    def _focus_map(self, image: np.ndarray, out: np.ndarray) -> np.ndarray:
+        """Gaussian blur and write the image's focus measure into ``out``."""
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        blurred = cv2.GaussianBlur(
+            gray,
+            (self._gaussian_blur_kernel_size, self._gaussian_blur_kernel_size),
+            0,
+        )
+        kwargs = {}
+        if self._focus_measure is abs_log:
+            kwargs["ksize"] = self._laplacian_kernel_size
+        return self._focus_measure(blurred, out, self._precision, **kwargs)
 
     @staticmethod
     def _find_focus_regions(laplacian_gradient: np.ndarray) -> np.ndarray:
@@ -192,18 +226,19 @@ class FocusStacker(object):
             np.array image data of focus stacked image, size of orignal image
 
         """
-        logger.info("Using laplacian gradient to find regions of focus, and stack.")
-        abs_laplacian = np.absolute(laplacian_gradient)
-        maxima = abs_laplacian.max(axis=0)
-        bool_mask = np.array(abs_laplacian == maxima)
-        mask = bool_mask.astype(np.uint8)
+        logger.info("Using the focus measure to find regions of focus, and stack.")
+        # focus maps are already absolute
+        maxima = laplacian_gradient.max(axis=0)
+        mask = (laplacian_gradient == maxima).view(np.uint8)
 
         return mask
 
     @staticmethod
-    def _apply_focus_region(images: List[np.ndarray], mask: np.ndarray):
-        output = np.zeros(shape=images[0].shape, dtype=images[0].dtype)
+    def _apply_focus_region(images: Iterable[np.ndarray], mask: np.ndarray):
+        output = None
         for i, img in enumerate(images):
+            if output is None:
+                output = np.zeros(shape=img.shape, dtype=img.dtype)
             output = cv2.bitwise_not(img, output, mask=mask[i])
 
         return 255 - output
@@ -218,6 +253,9 @@ def sort_files(files):
             spec.append(file)
         else:
             diffuse.append(file)
+    # brackets can arrive in any order, the masks pair them up by position
+    diffuse.sort()
+    spec.sort()
     return diffuse, spec
 
 
@@ -240,34 +278,94 @@ def skip_focus_stacking(diffuse, spec):
         return False
 
 
-def focus_stack_process(files, extension=".png"):
+def crop_images(images, roi):
+    if roi is None:
+        return images
+    return (roi.crop(image) for image in images)
+
+
+def bracket_shares(mask: np.ndarray) -> List[float]:
+    """Share of the stacked pixels each image in the stack won.
+
+    A pixel counts once, for the first image at its maximum. Pixels every
+    image ties on, like a flat background, say nothing about focus and
+    aren't counted, or a fully blurred image would still win 1/N of them.
+    """
+    count = mask.shape[0]
+    contested = mask.sum(axis=0, dtype=np.int32) < count
+    winners = np.argmax(mask, axis=0)[contested]
+    counts = np.bincount(winners, minlength=count)
+    total = counts.sum() or 1
+    return [float(won / total) for won in counts]
+
+
+def write_focus_stats(root_dir, name, diffuse, mask):
+    """Record the share of the focus mask each bracket won for a position.
+
+    The capture app reads these back to stop shooting brackets that add
+    nothing to the stack.
+    """
+    brackets = {}
+    for file, share in zip(diffuse, bracket_shares(mask)):
+        brackets[Path(file).stem.rsplit("_", 1)[-1]] = share
+    stats_file = Path(root_dir, "focus_stats", f"{name}.json")
+    stats_file.parent.mkdir(exist_ok=True, parents=True)
+    with open(stats_file, "w") as f:
+        json.dump({"position": name, "brackets": brackets}, f)
+
+
+def focus_stack_process(
+    files,
+    extension=".png",
+    focus_measure=DEFAULT_FOCUS_MEASURE,
+    precision=DEFAULT_PRECISION,
+    encoder=None,
+):
     if not len(files):
         return files
-    root_dir = Path(
-        Path(files[0]).parent.parent,
-        "focus_stack",
-    )
+    root_dir = output_dir(files[0], "focus_stack")
     # {job name}_{capture number}_{focus bracket number}
     processed_files = []
-    stacker = FocusStacker(laplacian_kernel_size=5, gaussian_blur_kernel_size=5)
+    stacker = FocusStacker(
+        laplacian_kernel_size=5,
+        gaussian_blur_kernel_size=5,
+        focus_measure=focus_measure,
+        precision=precision,
+    )
     diffuse, spec = sort_files(files)
     name = Path(diffuse[0]).stem.rsplit("_", 1)[0]
-    diffuse_images = stacker.load_images(diffuse)
     if skip_focus_stacking(diffuse, spec):
         return files
-    stacked, alignment_matrices, mask = stacker.focus_stack(diffuse_images)
-    if files_have_spec(diffuse, spec):
-        spec_images = stacker.load_images(spec)
-        spec_stacked = stacker.apply_focus_stacking(
-            spec_images, alignment_matrices, mask
+    # only align and stack where the object is
+    roi = read_roi(job_root(files[0]), name)
+    if roi is not None:
+        logger.info(f"Stacking {name} inside {roi}")
+    with stacker.load_images(diffuse) as diffuse_images:
+        # the first frame is the canvas the stacked region goes back onto
+        canvas = next(diffuse_images)
+        stacked, alignment_matrices, mask = stacker.focus_stack(
+            crop_images(chain([canvas], diffuse_images), roi), count=len(diffuse)
         )
+    if roi is not None and ROI_OUTPUT == "canvas":
+        stacked = roi.paste(canvas, stacked)
+    write_focus_stats(job_root(files[0]), name, diffuse, mask)
+    root_dir.mkdir(exist_ok=True, parents=True)
+    if files_have_spec(diffuse, spec):
+        with stacker.load_images(spec) as spec_images:
+            canvas = next(spec_images)
+            spec_stacked = stacker.apply_focus_stacking(
+                crop_images(chain([canvas], spec_images), roi), alignment_matrices, mask
+            )
+        if roi is not None and ROI_OUTPUT == "canvas":
+            spec_stacked = roi.paste(canvas, spec_stacked)
         spec_output_file = Path(root_dir, f"{name}_spec{extension}")
-        cv2.imwrite(spec_output_file.as_posix(), spec_stacked)
-        processed_files.append(spec_output_file.as_posix())
+        processed_files.append(
+            get_writer().submit(spec_output_file, spec_stacked, "stacked", encoder)
+        )
     diffuse_output_file = Path(root_dir, name + extension)
-    diffuse_output_file.parent.mkdir(exist_ok=True, parents=True)
-    cv2.imwrite(diffuse_output_file.as_posix(), stacked)
-    processed_files.append(diffuse_output_file.as_posix())
+    processed_files.append(
+        get_writer().submit(diffuse_output_file, stacked, "stacked", encoder)
+    )
     return processed_files
 
 
@@ -0,0 +1,101 @@
+from pathlib import Path
+import hashlib
+import io
+import json
+import os
+import uuid
+
+from werkzeug.formparser import parse_form_data
+from werkzeug.utils import secure_filename
+
+PART_SUFFIX = ".part"
+
+
+class HashingFile(object):
+    """Write-only file that hashes what goes through it."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        self.hash = hashlib.sha256()
+        self._file = open(self.path, "wb")
+
+    def write(self, data):
+        self.hash.update(data)
+        return self._file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+class UploadIngest(object):
+    """Stream a multipart upload straight to ``<root>/<job>/source``.
+
+    Werkzeug normally spools every large part to a temp file which then gets
+    copied to its final location. Here each file part is written once, to a
+    ``.part`` file next to where it ends up, and hashed as it arrives. The
+    capture app sends the ``data`` part first so the job name is known
+    before any files start. Files that arrive before it are written to an
+    incoming folder on the same disk and renamed into place.
+    """
+
+    def __init__(self, upload_root):
+        self.upload_root = Path(upload_root)
+        self.data = None
+        self._data_part = None
+        self._files = []
+
+    def parse(self, environ):
+        parse_form_data(environ, stream_factory=self._stream_factory)
+        for _, part in self._files:
+            part.close()
+        if self._data_part is not None:
+            self.data = json.loads(self._data_part.getvalue() or b"{}")
+        else:
+            self.data = {}
+        return self
+
+    @property
+    def job_name(self):
+        return (self.data or {}).get("job_name", "default_job")
+
+    def save(self):
+        """Move finished parts into place, returns paths and their sha256."""
+        local_paths = []
+        hashes = {}
+        source_root = Path(self.upload_root, self.job_name, "source")
+        source_root.mkdir(exist_ok=True, parents=True)
+        for filename, part in self._files:
+            file_path = source_root / filename
+            os.replace(part.path, file_path)
+            local_paths.append(file_path.as_posix())
+            hashes[filename] = part.hash.hexdigest()
+        self._files = []
+        return local_paths, hashes
+
+    def discard(self):
+        for _, part in self._files:
+            part.close()
+            part.path.unlink(missing_ok=True)
+        self._files = []
+
+    def _stream_factory(
+        self, total_content_length, content_type, filename, content_length=None
+    ):
+        if filename == "data" and self._data_part is None:
+            self._data_part = io.BytesIO()
+            return self._data_part
+        filename = secure_filename(filename or "")
+        if not filename:
+            # nothing to keep, let werkzeug throw it away
+            return io.BytesIO()
+        if self._data_part is not None:
+            data = json.loads(self._data_part.getvalue() or b"{}")
+            part_root = Path(
+                self.upload_root, data.get("job_name", "default_job"), "source"
+            )
+        else:
+            part_root = Path(self.upload_root, ".incoming")
+        part = HashingFile(part_root / f"{filename}.{uuid.uuid4().hex}{PART_SUFFIX}")
+        self._files.append((filename, part))
+        return part
@@ -0,0 +1,82 @@
+"""Decode the next images in the background while the current one is used.
+
+Stages used to read every frame of a position one after another before
+doing anything with them. ``ImagePrefetcher`` is an iterator over the
+decoded images of a list of files that keeps up to ``depth`` decodes
+running ahead on a thread pool (OpenCV releases the GIL while decoding),
+so reading overlaps with alignment and focus measures.
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+from .logging_utils import logger
+from .writer import get_writer
+
+# Images decoded ahead of the one being used
+PREFETCH_DEPTH = int(os.getenv("PREFETCH_DEPTH") or 2)
+# Bytes of decoded images held ahead, fewer are read ahead for big frames
+PREFETCH_MEMORY = int(os.getenv("PREFETCH_MEMORY_MB") or 1024) * 2**20
+
+
+class ImagePrefetcher(object):
+    def __init__(self, files, depth=PREFETCH_DEPTH, memory_limit=PREFETCH_MEMORY):
+        self.files = list(files)
+        self.depth = max(depth, 1)
+        self.memory_limit = memory_limit
+        self._executor = None
+        self._queue = deque()
+        self._next = 0
+        # size of a decoded image, known once the first one is read
+        self._image_size = None
+
+    def __len__(self):
+        return len(self.files)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        self._fill()
+        if not self._queue:
+            self.close()
+            raise StopIteration
+        file, future = self._queue.popleft()
+        image = future.result()
+        if image is None:
+            self.close()
+            raise IOError(f"Could not read {file}")
+        self._image_size = image.nbytes
+        self._fill()
+        return image
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        for _, future in self._queue:
+            future.cancel()
+        self._queue.clear()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def ahead(self):
+        """How many images may be decoding or waiting to be used."""
+        if self._image_size is None:
+            return self.depth
+        return max(1, min(self.depth, self.memory_limit // self._image_size))
+
+    def _fill(self):
+        while self._next < len(self.files) and len(self._queue) < self.ahead():
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.depth, thread_name_prefix="prefetch"
+                )
+            file = self.files[self._next]
+            self._next += 1
+            logger.debug(f"Prefetching {file}")
+            self._queue.append((file, self._executor.submit(get_writer().read, file)))
@@ -0,0 +1,173 @@
+"""Find the part of the frame the object is in so later stages can skip the rest.
+
+The turntable object often covers less than half the frame. ``detect_roi``
+looks at 1/8 scale decodes of a position's frames, marks what is either
+sharp or differs from the colour around the frame edges, and records the
+padded bounding box in ``<job>/roi/<position>.json``. ``focus_stack`` and
+``extract_specular`` read it back and only work inside the box.
+"""
+from pathlib import Path
+from typing import NamedTuple, Optional
+import json
+import os
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from .storage import job_root, position_name
+from .writer import get_writer
+
+try:
+    from .logging_utils import logger
+except ImportError:
+    import logging
+
+    logger = logging.getLogger()
+
+# "canvas" pastes processed regions back into a full size frame, "crop"
+# writes only the region and leaves its offset in the roi file
+ROI_OUTPUT = os.getenv("ROI_OUTPUT") or "canvas"
+# Fraction of the box size added on every side
+ROI_PADDING = 0.05
+# Skip cropping when the box covers more than this fraction of the frame
+MAX_ROI_AREA = 0.8
+# Standard deviations above the mean for a pixel to count as sharp
+SHARPNESS_SIGMA = 2.0
+# Colour distance from the frame edges for a pixel to count as object
+BACKGROUND_DISTANCE = 30
+
+
+class Roi(NamedTuple):
+    x: int
+    y: int
+    width: int
+    height: int
+
+    @property
+    def slices(self):
+        return (
+            slice(self.y, self.y + self.height),
+            slice(self.x, self.x + self.width),
+        )
+
+    def crop(self, image):
+        # OpenCV wants contiguous arrays
+        return np.ascontiguousarray(image[self.slices])
+
+    def paste(self, canvas, region):
+        """Copy of ``canvas`` with ``region`` put back where it was cropped."""
+        canvas = canvas.copy()
+        canvas[self.slices] = region
+        return canvas
+
+
+def roi_path(job_root, name):
+    return Path(job_root, "roi", f"{name}.json")
+
+
+def read_small(file):
+    """Decode at 1/8 size, far cheaper than a full decode and resize."""
+    image = get_writer().read(file, cv2.IMREAD_REDUCED_COLOR_8)
+    if image is None:
+        raise IOError(f"Could not read {file}")
+    return image
+
+
+def object_mask(image):
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    sharpness = np.abs(cv2.Laplacian(cv2.GaussianBlur(gray, (3, 3), 0), cv2.CV_32F))
+    sharp = sharpness > sharpness.mean() + SHARPNESS_SIGMA * sharpness.std()
+
+    border = np.concatenate(
+        [image[0], image[-1], image[:, 0], image[:, -1]]
+    ).astype(np.float32)
+    background = np.median(border, axis=0)
+    distance = np.linalg.norm(image.astype(np.float32) - background, axis=2)
+    foreground = distance > BACKGROUND_DISTANCE
+
+    return (sharp | foreground).astype(np.uint8)
+
+
+def find_roi(files, padding=ROI_PADDING) -> Optional[Roi]:
+    """Padded bounding box of the object across a position's frames.
+
+    Returns None when the object fills most of the frame, or nothing stood
+    out, and the whole frame should be processed.
+    """
+    small = [read_small(file) for file in files]
+    mask = np.zeros(small[0].shape[:2], dtype=np.uint8)
+    for image in small:
+        mask |= object_mask(image)
+    # drop speckle then join up the object
+    mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, np.ones((3, 3), np.uint8))
+    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, np.ones((9, 9), np.uint8))
+    if not mask.any():
+        return None
+    x, y, width, height = cv2.boundingRect(mask)
+
+    full_width, full_height = frame_size(files[0])
+    scale_x = full_width / mask.shape[1]
+    scale_y = full_height / mask.shape[0]
+    pad_x = width * padding
+    pad_y = height * padding
+    left = max(int((x - pad_x) * scale_x), 0)
+    top = max(int((y - pad_y) * scale_y), 0)
+    right = min(int(np.ceil((x + width + pad_x) * scale_x)), full_width)
+    bottom = min(int(np.ceil((y + height + pad_y) * scale_y)), full_height)
+    roi = Roi(left, top, right - left, bottom - top)
+    if roi.width * roi.height > MAX_ROI_AREA * full_width * full_height:
+        return None
+    return roi
+
+
+def frame_size(file):
+    """Width and height from the file header, without decoding the pixels."""
+    get_writer().wait(file)
+    with Image.open(file) as im:
+        return im.size
+
+
+def write_roi(job_root, name, roi, size):
+    path = roi_path(job_root, name)
+    path.parent.mkdir(exist_ok=True, parents=True)
+    with open(path, "w") as f:
+        json.dump(
+            {
+                "position": name,
+                "roi": roi._asdict() if roi else None,
+                "frame_width": size[0],
+                "frame_height": size[1],
+                "output": ROI_OUTPUT,
+            },
+            f,
+        )
+
+
+def read_roi(job_root, name) -> Optional[Roi]:
+    path = roi_path(job_root, name)
+    if not path.exists():
+        return None
+    with open(path) as f:
+        roi = json.load(f)["roi"]
+    return Roi(**roi) if roi else None
+
+
+def detect_roi(files):
+    """Record the object's region for each position, files pass through as is."""
+    positions = {}
+    for file in files:
+        if Path(file).stem.lower().endswith("_spec"):
+            # the polarizer changes the look, not where the object is
+            continue
+        positions.setdefault(position_name(file), []).append(file)
+    for name, position_files in positions.items():
+        root = job_root(position_files[0])
+        try:
+            roi = find_roi(position_files)
+        except Exception as e:
+            logger.error(f"Could not find the object in {name}: {e}")
+            roi = None
+        write_roi(root, name, roi, frame_size(position_files[0]))
+        logger.info(f"Region of interest for {name}: {roi or 'full frame'}")
+    return files
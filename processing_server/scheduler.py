@@ -0,0 +1,252 @@
+"""Decide which job stage the processing workers run next.
+
+Jobs used to go through one FIFO queue and a worker ran all of a job's
+stages back to back, so a 60 position session queued first kept every
+worker busy until it was done. Now the pool hands out one stage at a time:
+
+* Jobs have a priority, ``interactive``, ``preview`` or ``batch``. A free
+  worker always takes a stage of the most urgent priority waiting.
+* Within a priority, sessions (``job_name``) share the workers. Each
+  session is charged the worker seconds its stages take and the session
+  served least goes next. A session with nothing queued starts level with
+  the least served one waiting, so it can't bank credit while idle.
+* Within a session, jobs run oldest first.
+
+Nothing is sent to a worker before it is free, so a stage that hasn't
+started can always be overtaken. A running stage is never interrupted, an
+interactive job waits at most for the shortest stage already running.
+
+A job can be cancelled by its id. A queued job is dropped, a running one
+stops at the end of its current stage. A new upload of a position that
+has a job already, a re-shoot, supersedes the old job the same way. The
+replacement takes the old job's place in its session and waits for the
+old stage to finish so the two never write the same files at once. The
+session isn't charged for a stage whose job was cancelled while it ran.
+"""
+from typing import Dict, List, Optional
+import itertools
+import threading
+import time
+
+from .storage import position_name
+
+PRIORITIES = ("interactive", "preview", "batch")
+DEFAULT_PRIORITY = "batch"
+# Charged for a stage until one has been timed
+DEFAULT_STAGE_SECONDS = 1.0
+# Weight of the latest run in a stage's average duration
+STAGE_SECONDS_SMOOTHING = 0.2
+
+
+def get_priority(name):
+    name = name or DEFAULT_PRIORITY
+    if name not in PRIORITIES:
+        raise ValueError(
+            f"Unknown priority {name}, expected one of {', '.join(PRIORITIES)}"
+        )
+    return name
+
+
+class ScheduledJob(object):
+    def __init__(self, job_id, job_name, stages, files, options, priority, sequence):
+        self.job_id = job_id
+        self.job_name = job_name
+        self.stages = list(stages)
+        self.files = list(files)
+        self.options = options or {}
+        self.priority = priority
+        self.sequence = sequence
+        self.positions = {position_name(file) for file in self.files}
+        # a running stage finishes but the job goes no further
+        self.cancelled = False
+        # job_id of a superseded job whose running stage this one waits for
+        self.replaces = None
+        self.submitted = time.time()
+        self.stage_index = 0
+        self.running = False
+        # seconds charged to the session when the running stage started
+        self.charged = 0.0
+
+    @property
+    def session(self):
+        return (self.priority, self.job_name)
+
+    @property
+    def stage(self):
+        return self.stages[self.stage_index]
+
+    @property
+    def done(self):
+        return self.stage_index >= len(self.stages)
+
+    def task(self):
+        """What a worker needs to run the next stage."""
+        return {
+            "job_id": self.job_id,
+            "job_name": self.job_name,
+            "stage": self.stage,
+            "files": self.files,
+            "options": self.options.get(self.stage, {}),
+            "last": self.stage_index == len(self.stages) - 1,
+        }
+
+    def status(self):
+        return {
+            "job_id": self.job_id,
+            "job_name": self.job_name,
+            "priority": self.priority,
+            "stage": None if self.done else self.stage,
+            "running": self.running,
+            "cancelled": self.cancelled,
+            "replaces": self.replaces,
+            "submitted": self.submitted,
+        }
+
+
+class JobScheduler(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        # job_id: job, for every job with stages left to run
+        self._jobs: Dict[str, ScheduledJob] = {}
+        # (priority, job_name): worker seconds charged to the session
+        self._served: Dict[tuple, float] = {}
+        # stage name: average seconds a run takes
+        self._stage_seconds: Dict[str, float] = {}
+        self._sequence = itertools.count()
+
+    def add(self, job_id, job_name, stages, files, options=None, priority=None):
+        """Queue a job, returns it and the ids of the jobs it superseded."""
+        job = ScheduledJob(
+            job_id,
+            job_name,
+            stages,
+            files,
+            options,
+            get_priority(priority),
+            next(self._sequence),
+        )
+        with self._lock:
+            if job.session not in self._served:
+                waiting = [
+                    served
+                    for session, served in self._served.items()
+                    if session[0] == job.priority
+                ]
+                self._served[job.session] = min(waiting, default=0.0)
+            superseded = [
+                other
+                for other in self._jobs.values()
+                if other.job_name == job_name
+                and not other.cancelled
+                and other.positions & job.positions
+            ]
+            self._jobs[job_id] = job
+            for other in superseded:
+                job.sequence = min(job.sequence, other.sequence)
+                if other.running:
+                    job.replaces = other.job_id
+                self._cancel(other)
+        return job, [other.job_id for other in superseded]
+
+    def next_task(self) -> Optional[dict]:
+        """Start the most urgent waiting stage, None when nothing is waiting."""
+        with self._lock:
+            waiting = [
+                job
+                for job in self._jobs.values()
+                if not job.running and job.replaces not in self._jobs
+            ]
+            if not waiting:
+                return None
+            job = min(
+                waiting,
+                key=lambda job: (
+                    PRIORITIES.index(job.priority),
+                    self._served[job.session],
+                    job.sequence,
+                ),
+            )
+            job.running = True
+            # charged up front so free workers don't all go to one session
+            job.charged = self._stage_seconds.get(job.stage, DEFAULT_STAGE_SECONDS)
+            self._served[job.session] += job.charged
+            return job.task()
+
+    def finish_stage(self, job_id, files, seconds) -> Optional[ScheduledJob]:
+        """Move a job past a stage that ran for ``seconds``."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            if job.cancelled:
+                # its output is thrown away, the session isn't charged for it
+                self._served[job.session] -= job.charged
+                self._remove(job)
+                return job
+            self._served[job.session] += seconds - job.charged
+            average = self._stage_seconds.get(job.stage)
+            self._stage_seconds[job.stage] = (
+                seconds
+                if average is None
+                else average + STAGE_SECONDS_SMOOTHING * (seconds - average)
+            )
+            job.files = list(files)
+            job.stage_index += 1
+            job.running = False
+            if job.done:
+                self._remove(job)
+            return job
+
+    def cancel(self, job_id) -> Optional[ScheduledJob]:
+        """Drop a queued job or stop a running one after its stage."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                self._cancel(job)
+            return job
+
+    def fail(self, job_id) -> Optional[ScheduledJob]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                self._remove(job)
+            return job
+
+    def queued_count(self):
+        """Jobs waiting for a worker."""
+        with self._lock:
+            return sum(not job.running for job in self._jobs.values())
+
+    def job_names(self):
+        """Sessions with stages queued or running."""
+        with self._lock:
+            return {job.job_name for job in self._jobs.values()}
+
+    def jobs(self) -> List[dict]:
+        with self._lock:
+            jobs = sorted(self._jobs.values(), key=lambda job: job.sequence)
+            return [job.status() for job in jobs]
+
+    def status(self):
+        with self._lock:
+            queued = {priority: 0 for priority in PRIORITIES}
+            sessions = {}
+            for job in self._jobs.values():
+                session = sessions.setdefault(job.job_name, {"queued": 0, "running": 0})
+                if job.running:
+                    session["running"] += 1
+                else:
+                    session["queued"] += 1
+                    queued[job.priority] += 1
+            return {"queued": queued, "sessions": sessions}
+
+    def _cancel(self, job):
+        job.cancelled = True
+        if not job.running:
+            self._remove(job)
+
+    def _remove(self, job):
+        del self._jobs[job.job_id]
+        if not any(other.session == job.session for other in self._jobs.values()):
+            # an idle session starts level with the others when it comes back
+            del self._served[job.session]
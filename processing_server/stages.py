@@ -0,0 +1,50 @@
+"""Post processing stages, imported on first use.
+
+Stages pull in rawpy, lensfunpy, ExifTool and OpenCV, none of which the
+Flask process needs. Looking them up by name here keeps those imports in
+the worker processes that actually run the stages.
+"""
+from importlib import import_module
+import time
+
+from .logging_utils import logger
+
+# stage name: (module, function)
+STAGES = {
+    "convert_raw": ("convert_raw", "convert_raw"),
+    "detect_roi": ("roi", "detect_roi"),
+    "focus_stack": ("focus_stack_process", "focus_stack_process"),
+    "extract_specular": ("extract_specular_map", "extract_specular"),
+}
+
+
+def get_module(name):
+    module_name, _ = STAGES[name]
+    return import_module(f".{module_name}", __package__)
+
+
+def get_stage(name):
+    """The function for a stage, or None for stages that don't exist."""
+    if name not in STAGES:
+        return None
+    return getattr(get_module(name), STAGES[name][1])
+
+
+def flush_outputs():
+    """Wait for the images stages queued on the writer to be on disk."""
+    import_module(".writer", __package__).flush_writer()
+
+
+def warm_up(names):
+    """Import stages and load what their first job would otherwise wait on."""
+    for name in names:
+        start = time.monotonic()
+        try:
+            module = get_module(name)
+            if hasattr(module, "warm_up"):
+                module.warm_up()
+        except Exception as e:
+            # the job will hit the same error and report it properly
+            logger.error(f"Could not warm up {name}: {e}")
+            continue
+        logger.info(f"Warmed up {name} in {time.monotonic() - start:.1f}s")
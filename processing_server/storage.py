@@ -0,0 +1,351 @@
+"""Keep the uploads volume from filling up.
+
+Every job leaves its ``source`` files, a folder per stage (``convert_raw``,
+``focus_stack``, ``extract_specular``) and ``final`` copies behind, so a
+session takes several times its final size. ``StorageManager`` runs in the
+server process and every ``STORAGE_GC_INTERVAL`` seconds:
+
+* deletes files older than their class's retention, by default
+  intermediates go after a day while sources and finals are kept
+* evicts the least recently used intermediate folders while a root is
+  over its quota
+* removes ``.part`` files left behind by uploads that never finished and
+  by writes a crashed worker cut off
+
+Sessions with jobs queued or running are never touched, and neither are
+resumable ones, sessions with positions that haven't reached ``final``
+and an upload in the last ``RESUMABLE_HOURS``.
+
+Intermediates can go on a separate, faster disk: with ``SCRATCH_ROOT`` set
+stages write their folders to ``<scratch>/<job>/<stage>`` instead.
+"""
+from pathlib import Path
+from typing import NamedTuple
+import os
+import re
+import shutil
+import threading
+import time
+
+from .ingest import PART_SUFFIX
+from .logging_utils import logger
+
+UPLOAD_ROOT = os.getenv("UPLOAD_ROOT") or "/uploads"
+# Faster disk for stage outputs, next to the sources when unset
+SCRATCH_ROOT = os.getenv("SCRATCH_ROOT") or None
+STORAGE_GC_INTERVAL = float(os.getenv("STORAGE_GC_INTERVAL") or 600)
+# Unfinished sessions stay untouched this long after their last upload
+RESUMABLE_HOURS = float(os.getenv("RESUMABLE_HOURS") or 48)
+# Upload parts and partial writes this old were abandoned
+STALE_PART_HOURS = 1.0
+
+INTERMEDIATE_FOLDERS = ("convert_raw", "focus_stack", "extract_specular")
+# folder name: storage class, folders not listed here are left alone
+STORAGE_CLASSES = {
+    "source": "source",
+    "final": "final",
+    **{folder: "intermediate" for folder in INTERMEDIATE_FOLDERS},
+}
+# Storage class: hours its files are kept, None keeps them
+DEFAULT_RETENTION = {"source": None, "intermediate": 24.0, "final": None}
+
+
+def parse_retention(value):
+    """STORAGE_RETENTION="intermediate=6,source=720" on top of the defaults.
+
+    ``keep`` or nothing after the ``=`` keeps a class forever.
+    """
+    retention = dict(DEFAULT_RETENTION)
+    for item in (value or "").split(","):
+        if not item.strip():
+            continue
+        storage_class, _, hours = item.partition("=")
+        storage_class = storage_class.strip()
+        if storage_class not in DEFAULT_RETENTION:
+            raise ValueError(
+                f"Unknown storage class {storage_class}, expected one of "
+                f"{', '.join(DEFAULT_RETENTION)}"
+            )
+        hours = hours.strip()
+        retention[storage_class] = None if hours in ("", "keep") else float(hours)
+    return retention
+
+
+def _gigabytes(name):
+    value = float(os.getenv(name) or 0)
+    return int(value * 2**30) if value > 0 else None
+
+
+RETENTION = parse_retention(os.getenv("STORAGE_RETENTION"))
+# Bytes each root may hold before folders are evicted, None for no limit
+UPLOAD_QUOTA = _gigabytes("UPLOAD_QUOTA_GB")
+SCRATCH_QUOTA = _gigabytes("SCRATCH_QUOTA_GB")
+# Storage classes eviction may delete to get back under quota
+QUOTA_EVICTS = tuple(
+    storage_class.strip()
+    for storage_class in (os.getenv("QUOTA_EVICTS") or "intermediate").split(",")
+    if storage_class.strip()
+)
+
+
+def position_name(file):
+    """{job name}_{position} from {job name}_{position}[_{bracket}][_spec]"""
+    stem = re.sub(r"_spec$", "", Path(file).stem)
+    return re.sub(r"(_\d{4})_\d{3}$", r"\1", stem)
+
+
+def job_root(file):
+    """The job's folder on the uploads volume, for a file on either root."""
+    path = Path(file)
+    for root in (SCRATCH_ROOT, UPLOAD_ROOT):
+        if root is None:
+            continue
+        try:
+            relative = path.relative_to(root)
+        except ValueError:
+            continue
+        if len(relative.parts) > 1:
+            return Path(UPLOAD_ROOT, relative.parts[0])
+    # {job}/{folder}/{file} outside the roots, as in the sandbox
+    return path.parent.parent
+
+
+def output_dir(file, folder):
+    """Where a stage writes ``folder`` for the job ``file`` belongs to."""
+    root = job_root(file)
+    on_uploads = root.parent == Path(UPLOAD_ROOT)
+    if SCRATCH_ROOT and on_uploads and folder in INTERMEDIATE_FOLDERS:
+        return Path(SCRATCH_ROOT, root.name, folder)
+    return root / folder
+
+
+class Folder(NamedTuple):
+    root: Path
+    session: str
+    storage_class: str
+    path: Path
+
+
+def _files(path):
+    for directory, _, names in os.walk(path):
+        for name in names:
+            file = os.path.join(directory, name)
+            try:
+                yield file, os.stat(file)
+            except FileNotFoundError:
+                continue
+
+
+def is_partial(file):
+    """Upload parts, ``<name>.part``, and writes in progress, ``<name>.part.png``."""
+    path = Path(file)
+    return PART_SUFFIX in (path.suffix, Path(path.stem).suffix)
+
+
+def _remove(file):
+    try:
+        size = os.path.getsize(file)
+        os.remove(file)
+    except FileNotFoundError:
+        return 0
+    return size
+
+
+def _remove_empty(path):
+    """Remove ``path``, the folders below it and its session if they're empty."""
+    directories = [directory for directory, _, _ in os.walk(path)]
+    for directory in sorted(directories, reverse=True) + [Path(path).parent]:
+        try:
+            os.rmdir(directory)
+        except OSError:
+            pass
+
+
+class StorageManager(object):
+    def __init__(
+        self,
+        upload_root=UPLOAD_ROOT,
+        scratch_root=SCRATCH_ROOT,
+        retention=RETENTION,
+        upload_quota=UPLOAD_QUOTA,
+        scratch_quota=SCRATCH_QUOTA,
+        evicts=QUOTA_EVICTS,
+        active_jobs=None,
+        interval=STORAGE_GC_INTERVAL,
+    ):
+        # root: quota in bytes
+        self.quotas = {Path(upload_root): upload_quota}
+        if scratch_root and Path(scratch_root) != Path(upload_root):
+            self.quotas[Path(scratch_root)] = scratch_quota
+        self.retention = retention
+        self.evicts = evicts
+        # job names with stages queued or running
+        self.active_jobs = active_jobs or set
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._last_collection = None
+
+    def start(self):
+        self._stop_event.clear()
+        self._thread = threading.Thread(
+            target=self._collect_loop, name="storage-gc", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def folders(self, root=None):
+        """Every folder with a storage class, for all sessions on ``root``."""
+        for session_root in [root] if root else self.quotas:
+            if not session_root.exists():
+                continue
+            for session in sorted(session_root.iterdir()):
+                if not session.is_dir() or session.name.startswith("."):
+                    continue
+                for folder in sorted(session.iterdir()):
+                    storage_class = STORAGE_CLASSES.get(folder.name)
+                    if storage_class and folder.is_dir():
+                        yield Folder(session_root, session.name, storage_class, folder)
+
+    def protected_sessions(self):
+        """Sessions whose files a running or resumable job may still need."""
+        protected = set(self.active_jobs())
+        upload_root = next(iter(self.quotas))
+        cutoff = time.time() - RESUMABLE_HOURS * 3600
+        if not upload_root.exists():
+            return protected
+        for session in upload_root.iterdir():
+            if session.name in protected or not session.is_dir():
+                continue
+            sources = list(_files(session / "source"))
+            if not sources or max(stat.st_mtime for _, stat in sources) < cutoff:
+                continue
+            finished = {position_name(file) for file, _ in _files(session / "final")}
+            if any(position_name(file) not in finished for file, _ in sources):
+                protected.add(session.name)
+        return protected
+
+    def usage(self):
+        """Bytes per root and storage class, from the last collection."""
+        with self._lock:
+            return self._last_collection
+
+    def collect(self):
+        """Apply the retention policy and quotas once, returns what was freed."""
+        with self._lock:
+            started = time.time()
+            protected = self.protected_sessions()
+            # cleared first so eviction doesn't count them against the quota
+            stale = self._remove_stale_parts(started)
+            expired = self._expire(started, protected)
+            evicted = self._evict(started, protected)
+            roots = {}
+            for root, quota in self.quotas.items():
+                classes = {storage_class: 0 for storage_class in DEFAULT_RETENTION}
+                for folder in self.folders(root):
+                    classes[folder.storage_class] += sum(
+                        stat.st_size for _, stat in _files(folder.path)
+                    )
+                roots[root.as_posix()] = {
+                    "bytes": self._used(root),
+                    "quota": quota,
+                    "free": shutil.disk_usage(root).free if root.exists() else None,
+                    "classes": classes,
+                }
+            self._last_collection = {
+                "collected": started,
+                "seconds": time.time() - started,
+                "protected": sorted(protected),
+                "expired_bytes": expired,
+                "evicted": evicted,
+                "stale_part_bytes": stale,
+                "roots": roots,
+            }
+            return self._last_collection
+
+    def _expire(self, started, protected):
+        freed = 0
+        for folder in list(self.folders()):
+            hours = self.retention.get(folder.storage_class)
+            if hours is None or folder.session in protected:
+                continue
+            # a job may have started since the scan
+            if folder.session in self.active_jobs():
+                continue
+            cutoff = started - hours * 3600
+            for file, stat in _files(folder.path):
+                if stat.st_mtime < cutoff:
+                    freed += _remove(file)
+            _remove_empty(folder.path)
+        if freed:
+            logger.info(f"Expired {freed / 1e6:.1f}MB past retention")
+        return freed
+
+    def _evict(self, started, protected):
+        evicted = []
+        for root, quota in self.quotas.items():
+            if quota is None:
+                continue
+            used = self._used(root)
+            if used <= quota:
+                continue
+            candidates = []
+            for folder in self.folders(root):
+                if folder.storage_class not in self.evicts:
+                    continue
+                if folder.session in protected:
+                    continue
+                files = list(_files(folder.path))
+                last_used = max(
+                    (max(stat.st_atime, stat.st_mtime) for _, stat in files),
+                    default=0,
+                )
+                candidates.append((last_used, folder))
+            candidates.sort(key=lambda candidate: candidate[0])
+            for _, folder in candidates:
+                if used <= quota:
+                    break
+                if folder.session in self.active_jobs():
+                    continue
+                freed = 0
+                for file, stat in _files(folder.path):
+                    # anything written since the collection started is in use
+                    if stat.st_mtime < started:
+                        freed += _remove(file)
+                _remove_empty(folder.path)
+                used -= freed
+                evicted.append({"path": folder.path.as_posix(), "bytes": freed})
+                logger.info(f"Evicted {folder.path} ({freed / 1e6:.1f}MB) for quota")
+            if used > quota:
+                logger.warning(f"{root} is still over its quota, {used / 1e9:.1f}GB")
+        return evicted
+
+    def _remove_stale_parts(self, started):
+        freed = 0
+        cutoff = started - STALE_PART_HOURS * 3600
+        for root in self.quotas:
+            if not root.exists():
+                continue
+            for file, stat in _files(root):
+                if is_partial(file) and stat.st_mtime < cutoff:
+                    freed += _remove(file)
+        return freed
+
+    def _used(self, root):
+        return sum(stat.st_size for _, stat in _files(root))
+
+    def _collect_loop(self):
+        while True:
+            try:
+                self.collect()
+            except Exception as e:
+                logger.error(f"Storage collection failed: {e}")
+            if self._stop_event.wait(self.interval):
+                break
+
@@ -1,88 +1,234 @@
 from typing import List
+from contextlib import suppress
 from pathlib import Path
 import shutil
-from threading import Event
 import multiprocessing
 import queue
+import threading
+import time
 import atexit
+import uuid
 
 from .logging_utils import logger
-from .convert_raw import convert_raw
-from .focus_stack_process import focus_stack_process
-from .extract_specular_map import extract_specular
+from .scheduler import JobScheduler
+from .stages import STAGES, flush_outputs, get_stage, warm_up
+from .storage import job_root
 
-PROCESSORS = {
-    "convert_raw": convert_raw,
-    "focus_stack": focus_stack_process,
-    "extract_specular": extract_specular,
-}
-DEFAULT_POST_PROCESSES = ["convert_raw", "focus_stack", "extract_specular"]
+DEFAULT_POST_PROCESSES = [
+    "convert_raw",
+    "detect_roi",
+    "focus_stack",
+    "extract_specular",
+]
+
+
+def copy_to_final(files):
+    for file in files:
+        final_path = Path(job_root(file), "final", Path(file).name)
+        Path(final_path).parent.mkdir(exist_ok=True, parents=True)
+        shutil.copy(file, final_path)
 
 
 class WorkerPool:
+    """Runs jobs a stage at a time, in the order ``JobScheduler`` picks.
+
+    Each worker has its own task queue and gets one stage when it is free.
+    A thread in this process collects finished stages, moves their jobs on
+    and hands out the next stage.
+    """
 
     def __init__(self, worker_count=5):
         self.worker_count = worker_count
         self.workers = []
-        self._queue = multiprocessing.Queue()
+        self.scheduler = JobScheduler()
+        self._results = multiprocessing.Queue()
+        self._lock = threading.Lock()
+        # worker index: job_id of the stage it is running
+        self._running = {}
+        self._stopping = threading.Event()
+        self._collector = None
 
     def add_to_pool(self, data):
-        self._queue.put(data)
+        """Queue a job, returns its id and the ids of the jobs it superseded."""
+        data.setdefault("job_id", uuid.uuid4().hex[:12])
+        stages = [
+            name
+            for name in data.get("post_processes") or DEFAULT_POST_PROCESSES
+            if name in STAGES
+        ]
+        if not stages:
+            logger.info(f"Nothing to run for {data['job_name']}")
+            copy_to_final(data["files"])
+            return data["job_id"], []
+        _, superseded = self.scheduler.add(
+            data["job_id"],
+            data["job_name"],
+            stages,
+            data["files"],
+            options=data.get("options"),
+            priority=data.get("priority"),
+        )
+        for job_id in superseded:
+            logger.info(f"Job {data['job_id']} supersedes {job_id}")
+        self._dispatch()
+        return data["job_id"], superseded
+
+    def cancel(self, job_id):
+        """Cancel a job, returns it or None when it isn't queued or running.
+
+        A running job stops once its current stage is done.
+        """
+        job = self.scheduler.cancel(job_id)
+        if job is not None and not job.running:
+            self._finish(job)
+        return job
+
+    def ready_count(self):
+        """Workers that have loaded their stages and can run jobs at full speed."""
+        return sum(worker.ready.is_set() for worker in self.workers)
+
+    def is_ready(self):
+        return bool(self.workers) and self.ready_count() == len(self.workers)
+
+    def queue_depth(self):
+        return self.scheduler.queued_count()
 
     def start(self):
         if len(self.workers):
             raise Exception("Pool already has members")
-        for x in range(self.worker_count):
-            worker = Worker(queue=self._queue)
+        for index in range(self.worker_count):
+            worker = Worker(index=index, results=self._results)
             self.workers.append(worker)
             worker.start()
+        # started after the workers so none of them is forked with it running
+        self._stopping.clear()
+        self._collector = threading.Thread(
+            target=self._collect, name="worker-pool", daemon=True
+        )
+        self._collector.start()
         atexit.register(self.stop)
 
     def stop(self):
+        self._stopping.set()
         for worker in self.workers:
             if worker.is_alive():
                 worker.stop()
                 worker.join()
+        if self._collector is not None:
+            self._collector.join()
+            self._collector = None
         for worker in self.workers:
             del worker
         self.workers = []
 
+    def _dispatch(self):
+        """Give every free worker the most urgent stage waiting."""
+        with self._lock:
+            for worker in self.workers:
+                if worker.index in self._running:
+                    continue
+                task = self.scheduler.next_task()
+                if task is None:
+                    break
+                self._running[worker.index] = task["job_id"]
+                logger.info(
+                    f"Queued {task['stage']} for {task['job_name']} on {worker.name}"
+                )
+                worker.tasks.put(task)
+
+    def _collect(self):
+        while not self._stopping.is_set():
+            try:
+                result = self._results.get(timeout=1)
+            except queue.Empty:
+                self._check_workers()
+                continue
+            with self._lock:
+                self._running.pop(result["worker"], None)
+            if result["error"]:
+                logger.error(
+                    f"{result['stage']} failed for job {result['job_id']}: "
+                    f"{result['error']}"
+                )
+                self._finish(self.scheduler.fail(result["job_id"]))
+            else:
+                job = self.scheduler.finish_stage(
+                    result["job_id"], result["files"], result["seconds"]
+                )
+                if job is not None and (job.done or job.cancelled):
+                    self._finish(job)
+            self._dispatch()
+
+    def _check_workers(self):
+        """Fail the stages of workers that died while running them."""
+        for worker in self.workers:
+            with self._lock:
+                job_id = self._running.get(worker.index)
+            if job_id is None or worker.is_alive():
+                continue
+            logger.error(f"{worker.name} exited while running job {job_id}")
+            with self._lock:
+                # stays taken, nothing more is sent to a dead worker
+                self._running[worker.index] = None
+            self._finish(self.scheduler.fail(job_id))
+
+    def _finish(self, job):
+        if job is None:
+            return
+        if job.cancelled:
+            logger.info(f"Cancelled job {job.job_id} for {job.job_name}")
+        else:
+            logger.info(f"Finished job {job.job_id} for {job.job_name}")
+
 
 class Worker(multiprocessing.Process):
-    def __init__(
-        self,
-        queue=None,
-    ):
+    def __init__(self, index=0, results=None):
         super().__init__()
-        self._stopped = Event()
-        self._queue = queue
+        self.index = index
+        self.tasks = multiprocessing.Queue()
+        # set from the pool's process, a threading.Event wouldn't reach the worker
+        self._stopped = multiprocessing.Event()
+        self._results = results
+        self.ready = multiprocessing.Event()
 
     def run(self):
         logger.info(f"Starting thread: {self.name}")
+        warm_up(DEFAULT_POST_PROCESSES)
+        self.ready.set()
         while not self.stopped:
             try:
-                data = self._queue.get(timeout=1)
-                files = data["files"]
-                post_process_names = data["post_processes"] or DEFAULT_POST_PROCESSES
-                job_name = data["job_name"]
-                logger.info(f"Running {', '.join(post_process_names)} for {job_name}")
-                for post_process_name in post_process_names:
-                    post_process = PROCESSORS.get(post_process_name)
-                    if post_process:
-                        logger.info(f"Executing {post_process_name}")
-                        files = post_process(files)
-
-                for file in files:
-                    final_path = Path(
-                        Path(file).parent.parent, "final", Path(file).name
-                    )
-                    Path(final_path).parent.mkdir(exist_ok=True, parents=True)
-                    shutil.copy(file, final_path)
-
+                task = self.tasks.get(timeout=1)
             except queue.Empty:
-                pass
+                continue
+            self._results.put(self.run_stage(task))
         del self._target, self._args, self._kwargs
 
+    def run_stage(self, task):
+        start = time.monotonic()
+        files = task["files"]
+        error = None
+        try:
+            logger.info(f"Executing {task['stage']} for {task['job_name']}")
+            files = get_stage(task["stage"])(files, **task["options"])
+            # stages only queue their images, the stage is done once written
+            flush_outputs()
+            if task["last"]:
+                copy_to_final(files)
+        except Exception as e:
+            logger.exception(f"{task['stage']} failed for {task['job_name']}")
+            error = f"{type(e).__name__}: {e}"
+            # the next stage's flush shouldn't report this one's writes
+            with suppress(Exception):
+                flush_outputs()
+        return {
+            "worker": self.index,
+            "job_id": task["job_id"],
+            "stage": task["stage"],
+            "files": files,
+            "seconds": time.monotonic() - start,
+            "error": error,
+        }
+
     def stop(self):
         self._stopped.set()
 
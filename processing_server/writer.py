@@ -0,0 +1,276 @@
+"""Write stage outputs in the background so stages don't wait on encoding.
+
+Encoding a full frame PNG takes longer than most of the processing that
+produced it. Stages hand their images to ``OutputWriter.submit`` and move
+on while a small thread pool encodes and writes them. At most
+``WRITER_MAX_PENDING`` images are held in memory, past that ``submit``
+blocks until a write finishes, so a fast stage can't pile up frames.
+
+Stages read through ``OutputWriter.read`` which returns an image still
+waiting to be written straight from memory, or waits for the file. The
+worker calls ``flush`` at the end of every stage, a stage is only done
+once everything it wrote is on disk, since the job's next stage may run
+in another worker process. Reads from memory only help within a stage,
+for images the stage itself submitted.
+
+Each output class (intermediate files, stacked frames, specular maps) has
+its own encoder, set with ``OUTPUT_ENCODERS`` or a stage's ``encoder``
+option.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, NamedTuple
+import os
+import threading
+
+# OpenCV only enables its EXR codec when asked before the first EXR write
+os.environ.setdefault("OPENCV_IO_ENABLE_OPENEXR", "1")
+
+import cv2
+import numpy as np
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+from .ingest import PART_SUFFIX
+from .logging_utils import logger
+
+WRITER_THREADS = int(os.getenv("WRITER_THREADS") or 2)
+# Images held in memory waiting to be written before submit blocks
+WRITER_MAX_PENDING = int(os.getenv("WRITER_MAX_PENDING") or 4)
+PNG_COMPRESSION = int(os.getenv("PNG_COMPRESSION") or 3)
+FAST_PNG_COMPRESSION = 1
+TIFF_TILE = (256, 256)
+TIFF_THREADS = int(os.getenv("TIFF_THREADS") or 4)
+
+
+def to_uint16(image):
+    if image.dtype == np.uint16:
+        return image
+    if image.dtype == np.uint8:
+        return image.astype(np.uint16) * 257
+    return (np.clip(image, 0, 1) * 65535 + 0.5).astype(np.uint16)
+
+
+def to_float32(image):
+    if image.dtype == np.float32:
+        return image
+    if np.issubdtype(image.dtype, np.integer):
+        return image.astype(np.float32) / np.iinfo(image.dtype).max
+    return image.astype(np.float32)
+
+
+def _imwrite(path, image, params=()):
+    if not cv2.imwrite(path, image, list(params)):
+        raise IOError(f"Could not write {path}")
+
+
+def write_png(path, image):
+    _imwrite(path, image, [cv2.IMWRITE_PNG_COMPRESSION, PNG_COMPRESSION])
+
+
+def write_fast_png(path, image):
+    _imwrite(path, image, [cv2.IMWRITE_PNG_COMPRESSION, FAST_PNG_COMPRESSION])
+
+
+def write_png16(path, image):
+    _imwrite(
+        path, to_uint16(image), [cv2.IMWRITE_PNG_COMPRESSION, FAST_PNG_COMPRESSION]
+    )
+
+
+def write_tiff(path, image):
+    """Tiled, deflate compressed TIFF, tiles are compressed in parallel."""
+    if tifffile is None:
+        # OpenCV writes stripped TIFFs on one thread, still readable everywhere
+        _imwrite(path, image)
+        return
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    tifffile.imwrite(
+        path,
+        image,
+        photometric="rgb" if image.ndim == 3 else "minisblack",
+        tile=TIFF_TILE,
+        compression="zlib",
+        compressionargs={"level": FAST_PNG_COMPRESSION},
+        maxworkers=TIFF_THREADS,
+    )
+
+
+def write_tiff16(path, image):
+    write_tiff(path, to_uint16(image))
+
+
+def write_exr(path, image):
+    _imwrite(path, to_float32(image))
+
+
+class Encoder(NamedTuple):
+    suffix: str
+    write: Callable
+
+
+ENCODERS = {
+    "png": Encoder(".png", write_png),
+    "png_fast": Encoder(".png", write_fast_png),
+    "png16": Encoder(".png", write_png16),
+    "tiff": Encoder(".tif", write_tiff),
+    "tiff16": Encoder(".tif", write_tiff16),
+    "exr": Encoder(".exr", write_exr),
+}
+
+# Output class: encoder. Intermediate files are read again by later stages
+# and deleted with the job, so they favour speed over size.
+DEFAULT_OUTPUT_ENCODERS = {
+    "intermediate": "png_fast",
+    "stacked": "png",
+    "specular": "png",
+}
+
+
+def parse_output_encoders(value):
+    """OUTPUT_ENCODERS="stacked=tiff16,specular=png16" on top of the defaults."""
+    encoders = dict(DEFAULT_OUTPUT_ENCODERS)
+    for item in (value or "").split(","):
+        if not item.strip():
+            continue
+        output_class, _, encoder = item.partition("=")
+        encoders[output_class.strip()] = encoder.strip()
+    return encoders
+
+
+OUTPUT_ENCODERS = parse_output_encoders(os.getenv("OUTPUT_ENCODERS"))
+
+
+def get_encoder(name):
+    try:
+        encoder = ENCODERS[name]
+    except KeyError:
+        raise ValueError(
+            f"Unknown encoder {name}, expected one of {', '.join(ENCODERS)}"
+        )
+    if not cv2.haveImageWriter(encoder.suffix):
+        raise ValueError(f"This OpenCV build can't write {encoder.suffix} files")
+    return encoder
+
+
+def encoder_for(output_class, encoder=None):
+    return get_encoder(encoder or OUTPUT_ENCODERS.get(output_class, "png"))
+
+
+class OutputWriter(object):
+    def __init__(self, threads=WRITER_THREADS, max_pending=WRITER_MAX_PENDING):
+        self._executor = ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix="writer"
+        )
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        # path: (image, future) for writes that haven't finished yet
+        self._pending = {}
+        self._errors = []
+
+    def submit(self, path, image, output_class, encoder=None):
+        """Queue ``image`` to be written, returns the path it will have.
+
+        The image is kept as is until written, don't modify it afterwards.
+        Blocks while the writer already holds its limit of images.
+        """
+        encoder = encoder_for(output_class, encoder)
+        path = Path(path).with_suffix(encoder.suffix)
+        path.parent.mkdir(exist_ok=True, parents=True)
+        path = path.as_posix()
+        self.wait(path)
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(self._write, path, image, encoder)
+        except BaseException:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._pending[path] = (image, future)
+        future.add_done_callback(lambda _: self._done(path, future))
+        return path
+
+    def read(self, path, flags=cv2.IMREAD_COLOR):
+        """``cv2.imread`` that doesn't wait for images still being written."""
+        path = Path(path).as_posix()
+        with self._lock:
+            image, _ = self._pending.get(path, (None, None))
+        if image is not None and image.dtype == np.uint8:
+            if flags == cv2.IMREAD_COLOR and image.ndim == 3:
+                return image
+            if flags == cv2.IMREAD_REDUCED_COLOR_8 and image.ndim == 3:
+                height, width = image.shape[:2]
+                return cv2.resize(
+                    image,
+                    ((width + 7) // 8, (height + 7) // 8),
+                    interpolation=cv2.INTER_AREA,
+                )
+        self.wait(path)
+        return cv2.imread(path, flags)
+
+    def wait(self, path):
+        """Block until ``path`` is on disk, if it is being written."""
+        with self._lock:
+            _, future = self._pending.get(Path(path).as_posix(), (None, None))
+        if future is not None:
+            future.exception()
+
+    def pending_count(self):
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self):
+        """Wait for every queued write, raising the first one that failed."""
+        with self._lock:
+            futures = [future for _, future in self._pending.values()]
+        for future in futures:
+            future.exception()
+        with self._lock:
+            errors, self._errors = self._errors, []
+        if errors:
+            raise errors[0]
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+    def _write(self, path, image, encoder):
+        # write next to the destination and rename, nothing ever sees half a file
+        part_path = Path(path).with_suffix(PART_SUFFIX + encoder.suffix).as_posix()
+        try:
+            encoder.write(part_path, image)
+            os.replace(part_path, path)
+        except Exception as e:
+            Path(part_path).unlink(missing_ok=True)
+            logger.error(f"Could not write {path}: {e}")
+            # recorded here, flush can return before done callbacks run
+            with self._lock:
+                self._errors.append(e)
+            raise
+        logger.info(f"Image written to {path}")
+
+    def _done(self, path, future):
+        with self._lock:
+            if self._pending.get(path, (None, None))[1] is future:
+                del self._pending[path]
+        self._slots.release()
+
+
+WRITER = None
+
+
+def get_writer():
+    """The worker process's writer, shared by every stage."""
+    global WRITER
+
+    if WRITER is None:
+        WRITER = OutputWriter()
+    return WRITER
+
+
+def flush_writer():
+    if WRITER is not None:
+        WRITER.flush()